@@ -6,7 +6,8 @@
 #Straub, S.C.K., M. Fishbein, T. Livshultz, Z. Foster, M. Parks, K. Weitemier, R.C. Cronn, A. Liston. 2011. Building a model: Developing genomic resources for common milkweed (Asclepias syriaca) with low coverage genome sequencing. BMC Genomics 12:211.
 
 ### Imports ###
-import os, string, sys, time, copy, logging, tempfile, re
+import os, string, sys, time, copy, logging, tempfile, re, ast, shutil, threading, multiprocessing
+from multiprocessing.pool import ThreadPool
 from optparse import *
 from subprocess import *
 ######
@@ -20,7 +21,11 @@ def import_file(full_path_to_module, name=None):
         save_cwd = os.getcwd()
         if module_dir == '': module_dir = os.getcwd()
         os.chdir(module_dir)
-        module_obj = __import__(module_name)
+        sys.path.insert(0, module_dir) #the folder of the script, not the working directory, is in the search path
+        try:
+            module_obj = __import__(module_name)
+        finally:
+            del sys.path[0]
         module_obj.__file__ = full_path_to_module
         if name is None:
             globals()[module_name] = module_obj
@@ -82,21 +87,191 @@ def getOptCmndLine(args,converterKey):
                 for opt in option: out.append(str(opt))
     return out
 
-def mvFiles(sourcePath, destinationPath):
-    '''Version 1.1
-    Moves all of the files from one directory to another.'''
+def mvFiles(sourcePath, destinationPath, exclude = ()):
+    '''Version 1.3
+    Moves all of the files, except those named in exclude, from one directory to another.'''
     fileList = os.listdir(sourcePath)
     os.mkdir(destinationPath)
     for path in fileList:
-        if os.path.isdir(path) == False:
-            old = './' + path
-            new = './' + os.path.basename(destinationPath) + '/' + path
-            os.rename(old,new)
+        old = os.path.join(sourcePath, path)
+        if os.path.isdir(old) == False and path not in exclude:
+            os.rename(old, os.path.join(destinationPath, path))
+
+def get_option_values(args, converter_key):
+    '''Returns the values of the options set (see getOptCmndLine) by their alignreads option names, to compare runs regardless of
+    the order of their command lines (see readtools.StageManifest).'''
+    return dict([(name, getattr(args, name)) for name in converter_key if getattr(args, name) != False and getattr(args, name) != None])
 
 def saveCommandLine(path, commandLine):
     with open(path, 'a') as cmndLineOut:
         cmndLineOut.write(' '.join(commandLine) + '\n')
 
+def get_sam_path(runyasra_folder, query_path, reference_path):
+    '''Returns the path of the SAM file made by runyasra in its folder.'''
+    return os.path.join(runyasra_folder, 'alignments_%s_%s.sam' % (os.path.basename(query_path), os.path.basename(reference_path)))
+
+def find_yasra_folder(search_paths, input_paths, parameters):
+    '''Returns the most recent alignreads folder in the directories given in which YASRA was completed on files with the same contents as
+    the input files with the same parameters, according to its stage manifest (see readtools.StageManifest), or None if there is none.'''
+    folders = []
+    for search_path in set([os.path.abspath(path) for path in search_paths]):
+        folders += [os.path.join(search_path, name) for name in os.listdir(search_path) if os.path.isfile(os.path.join(search_path, name, readtools.StageManifest.fileName))]
+    for folder in sorted(folders, key = os.path.getmtime, reverse = True):
+        if readtools.StageManifest.forFolder(folder).isCurrent('yasra', input_paths, parameters): return folder
+    return None
+
+def read_sample_sheet(sheet_path):
+    '''Returns the (reads path, reference path, run id, overrides, problem) of each sample in a sample sheet. Each line of a sample sheet
+    is a sample: the paths of its read and reference files and its run id, followed by any options of the configuration file to change
+    for that sample as name=value, separated by tabs. Blank lines and lines starting with "#" are ignored. Relative paths are relative to
+    the folder of the sample sheet. Values are read as python literals if possible (e.g. True or 20) and otherwise as text. The problem
+    of a sample that can not be run (e.g. one of its files does not exist or an option name is misspelled) is the reason why, and is
+    otherwise None; a sample without a unique run id is named after its line (e.g. "line 3").'''
+    sheet_folder = os.path.dirname(os.path.abspath(sheet_path))
+    samples = []
+    with open(sheet_path, 'r') as sheet_handle:
+        for line_number, line in enumerate(sheet_handle, 1):
+            if line.strip() == '' or line.startswith('#'): continue
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) < 3:
+                samples.append((None, None, 'line %d' % line_number, [], 'Line %d does not have a read file, a reference file and a run id.' % line_number))
+                continue
+            reads_path, reference_path, run_id = [os.path.join(sheet_folder, field) for field in fields[:2]] + [fields[2]]
+            if run_id in ('', '.', '..') or os.sep in run_id or run_id in [sample[2] for sample in samples]:
+                samples.append((reads_path, reference_path, 'line %d' % line_number, [], 'The run id "%s" on line %d is not a unique folder name.' % (run_id, line_number)))
+                continue
+            problems = ['The file "%s" does not exist.' % input_path for input_path in (reads_path, reference_path) if os.path.isfile(input_path) is False]
+            overrides = []
+            for field in fields[3:]:
+                if field.strip() == '': continue
+                if '=' not in field or hasattr(configuration, field.split('=', 1)[0].strip()) is False:
+                    problems.append('"%s" is not name=value with the name of a configuration file option.' % field)
+                    continue
+                name, value = [part.strip() for part in field.split('=', 1)]
+                try:
+                    value = ast.literal_eval(value)
+                except (ValueError, SyntaxError):
+                    pass
+                if name in batch_path_options and isinstance(value, str) and value != '': value = os.path.join(sheet_folder, value)
+                if name == 'sample_memory' and (type(value) not in (int, long) or value <= 0):
+                    problems.append('"%s" is not a whole number of megabytes above 0.' % field)
+                    continue
+                overrides.append((name, value))
+            samples.append((reads_path, reference_path, run_id, overrides, ' '.join(problems) if len(problems) > 0 else None))
+    return samples
+
+def run_batch(sheet_path, command_line_options, jobs = None, memory_limit = None, total_memory = None):
+    '''Runs alignreads on every sample of a sample sheet (see read_sample_sheet), with at most the number of samples given by jobs
+    (Default: the number of CPUs) running at a time. Each sample is run in a folder named after its run id in the output directory,
+    in a separate process with a configuration file made of the current configuration file, the options given on the command line
+    and the options of the sample, in that order. The CPUs are divided among the samples running at a time: each makes its consensus
+    with that many worker processes, unless the workers option is given. If the memory of a sample is given (memory_limit megabytes,
+    or the sample_memory option of the sample), it is reserved while the sample runs: a sample is only started while the memory
+    reserved by the running samples and its own is within total_memory megabytes (Default: the physical memory), and no process of
+    the sample may use more. A sample that fails or can not be run (e.g. its line of the sample sheet is wrong) does not stop the
+    others. The status of every sample is logged and kept in a table next to the samples. Returns the run ids of the samples that failed.'''
+    samples = read_sample_sheet(sheet_path)
+    cpu_count = multiprocessing.cpu_count()
+    if jobs is None: jobs = cpu_count
+    batch_defaults = [('workers', max(cpu_count // jobs, 1))] #replaced by the workers option if it is given
+    if total_memory is None: total_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    memory_condition = threading.Condition()
+    reserved_memory = [0] #the megabytes reserved by the running samples
+    with open(options.config_file, 'r') as config_handle:
+        config_text = config_handle.read()
+    status_path = os.path.join(options.output_directory, os.path.splitext(os.path.basename(sheet_path))[0] + '_status.txt')
+    statuses = dict([(sample[2], ['waiting', '', '', '' if sample[4] else os.path.join(os.path.abspath(options.output_directory), sample[2]), sample[4] or ''])
+                     for sample in samples])
+    status_lock = threading.Lock()
+    running = {}
+    def set_status(run_id, status, return_code = '', minutes = ''):
+        with status_lock:
+            statuses[run_id][:3] = [status, return_code, minutes]
+            with open(status_path + '.tmp', 'w') as status_handle:
+                status_handle.write('#run id\tstatus\texit code\trun time (m)\tfolder\tproblem\n')
+                for sample in samples:
+                    status_handle.write('%s\t%s\n' % (sample[2], '\t'.join([str(value) for value in statuses[sample[2]]])))
+            os.rename(status_path + '.tmp', status_path)
+    def reserve_memory(megabytes):
+        '''Waits until the memory of a sample fits within the total memory with that of the running samples; a sample that needs more
+        than the total memory is run once no other sample is running.'''
+        if megabytes is None: return
+        with memory_condition:
+            while reserved_memory[0] > 0 and reserved_memory[0] + megabytes > total_memory: memory_condition.wait()
+            reserved_memory[0] += megabytes
+    def release_memory(megabytes):
+        if megabytes is None: return
+        with memory_condition:
+            reserved_memory[0] -= megabytes
+            memory_condition.notify_all()
+    def limit_memory(megabytes):
+        if megabytes is not None:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, (megabytes * 1024 * 1024, megabytes * 1024 * 1024))
+    def run_sample(sample):
+        '''Returns True if the sample is complete. Any error only fails this sample, so the other samples are still run.'''
+        reads_path, reference_path, run_id, overrides, problem = sample
+        try:
+            sample_folder = statuses[run_id][3]
+            sample_memory = dict(overrides).get('sample_memory', memory_limit)
+            reserve_memory(sample_memory)
+            try:
+                return start_sample(reads_path, reference_path, run_id, overrides, sample_folder, sample_memory)
+            finally:
+                release_memory(sample_memory)
+        except:
+            logger.exception('An error occured while running sample "%s".' % run_id)
+            set_status(run_id, 'failed')
+            return False
+    def start_sample(reads_path, reference_path, run_id, overrides, sample_folder, sample_memory):
+        sample_start_time = time.time()
+        try:
+            if os.path.isdir(sample_folder) is False: os.makedirs(sample_folder)
+            sample_config_path = os.path.join(sample_folder, 'sample_configuration.py')
+            with open(sample_config_path, 'w') as config_handle:
+                config_handle.write(config_text)
+                config_handle.write('\n\n### Batch Options of Sample %s ###\n' % run_id)
+                for name, value in batch_defaults + command_line_options + overrides: config_handle.write('%s = %r\n' % (name, value))
+                config_handle.write('######\n')
+            sample_command_line = [sys.executable, os.path.abspath(program_arguments[0]), '--config-file', sample_config_path, '--run-id', run_id,
+                                   '--output-directory', sample_folder, reads_path, reference_path]
+            set_status(run_id, 'running')
+            logger.info('Running sample "%s" with the following command line:\n %s' % (run_id, ' '.join(sample_command_line)))
+            with open(os.path.join(sample_folder, 'alignreads_output.txt'), 'w') as output_handle:
+                with status_lock:
+                    process = Popen(sample_command_line, stdout = output_handle, stderr = STDOUT, cwd = sample_folder, preexec_fn = lambda: limit_memory(sample_memory))
+                    running[run_id] = process
+                return_code = process.wait()
+        except:
+            logger.exception('An error occured while starting sample "%s".' % run_id)
+            return_code = None
+        with status_lock:
+            running.pop(run_id, None)
+        minutes = '%0.2f' % ((time.time() - sample_start_time) / 60)
+        if return_code == 0:
+            set_status(run_id, 'complete', return_code, minutes)
+            logger.info('Sample "%s" is complete.' % run_id)
+        else:
+            set_status(run_id, 'failed', '' if return_code is None else return_code, minutes)
+            logger.error('Sample "%s" failed; see "%s".' % (run_id, os.path.join(sample_folder, 'alignreads_output.txt')))
+        return return_code == 0
+    invalid_samples = [sample for sample in samples if sample[4] is not None]
+    valid_samples = [sample for sample in samples if sample[4] is None]
+    for sample in invalid_samples:
+        set_status(sample[2], 'failed')
+        logger.error('Sample "%s" can not be run: %s' % (sample[2], sample[4]))
+    for sample in valid_samples: set_status(sample[2], 'waiting')
+    logger.info('Running %d samples from "%s", %d at a time.' % (len(valid_samples), sheet_path, jobs))
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.map_async(run_sample, valid_samples, chunksize = 1).get(sys.maxint) #a timeout lets the wait be interrupted
+    finally:
+        pool.terminate()
+        with status_lock:
+            for process in running.values(): process.terminate()
+    failed_samples = [sample[2] for sample in invalid_samples] + [sample[2] for sample, result in zip(valid_samples, results) if result is False]
+    return [sample[2] for sample in samples if sample[2] in failed_samples]
+
 def validate_config(config_path, options):
     '''Checks if every option is in the configuration file path supplied. Raises an exception if any options are missing.'''
     try:
@@ -211,13 +386,16 @@ accepted_nucmer_versions = ['3.1']
 installation_location = os.path.split(sys.argv[0])[0]
 runyasra_arguments = {'output_directory' : '--output-directory', 'lastz_location' : '--lastz-binary-path', 'yasra_location' : '--yasra-binary-path',\
                       'read_type' : '--read-type', 'read_orientation' : '--orientation', 'percent_identity' : '--percent-identity', 'single_step' : '--single-step',\
-                      'external_makefile' : '--make-path'}
+                      'external_makefile' : '--make-path', 'yasra_timeout' : '--timeout'}
 nucmer_arguments = {'break_length' : '--break-len', 'min_cluster' : '--min-cluster', 'diag_factor' : '--diag-factor', 'no_extend' : '--no-extend',\
                     'forward_only' : '--forward-only','max_gap' : '--max-gap', 'coords' : '--coords', 'no_optimize' : '--no-optimize', \
                     'no_simplify' : '--no-simplify', 'min_match' : '--min-match'}
 makeconsensus_arguments = {'depth_position_filter' : '--depth-position-filter', 'quality_read_filter' : '--quality-read-filter',\
                            'depth_position_masking' : '--depth-position-masking', 'proportion_base_filter' : '--proportion-base-filter',\
-                           'nucmer_location' : '--nucmer-location'}
+                           'nucmer_location' : '--nucmer-location', 'sweep' : '--sweep'}
+configuration_names = {'alternate_ref' : 'alternate_reference'} #options whose name in the configuration file is not their option name
+batch_options = ('config_file', 'run_id', 'output_directory', 'sample_sheet', 'batch_jobs', 'sample_memory', 'batch_memory') #options not passed to the samples of a batch
+batch_path_options = ('sweep', 'external_makefile', 'alternate_reference', 'yasra_location', 'lastz_location', 'nucmer_location')
 run_id_default = None
 print_log = []
 ######
@@ -231,6 +409,14 @@ command_line_parser.add_option("-i", "--run-id", action="store", default=run_id_
                                help="Used to identify the alignment generated. Is used in the folder names for each alignment. (Default: %s)" % run_id_default)
 command_line_parser.add_option("-c", "--config-file", action="store", default=None, type="string",\
                                help="Supply the path to a alignreads configuration file to use its default parameters. (Default: Use default installation file)")
+command_line_parser.add_option("-s", "--sample-sheet", action="store", default=configuration.sample_sheet, type="string", dest="sample_sheet", metavar="FILEPATH",\
+                               help="Run alignreads on every sample of a tab-separated file instead of on the arguments: one sample per line with its read file, reference file, run id and any configuration file options to change as name=value. The output of each sample is saved in a folder named after its run id in the output directory. (Default: %s)" % configuration.sample_sheet)
+command_line_parser.add_option("-k", "--batch-jobs", action="store", default=configuration.batch_jobs, type="int", dest="batch_jobs", metavar="INT",\
+                               help="The number of samples of a sample sheet run at the same time. (Default: the number of CPUs)")
+command_line_parser.add_option("-u", "--sample-memory", action="store", default=configuration.sample_memory, type="int", dest="sample_memory", metavar="MEGABYTES",\
+                               help="The memory each sample of a sample sheet is given. It is reserved while the sample runs (see --batch-memory) and no process of the sample may use more. Can be changed for a sample in the sample sheet. (Default: %s)" % configuration.sample_memory)
+command_line_parser.add_option("--batch-memory", action="store", default=configuration.batch_memory, type="int", dest="batch_memory", metavar="MEGABYTES",\
+                               help="The memory all the samples of a sample sheet running at the same time are given together: a sample is only started while its memory and that of the running samples is within it. (Default: the physical memory)")
 command_line_parser.add_option("-y", "--output-directory", action="store", default=configuration.output_directory, type="string", metavar="PATH",\
                                help="Specify where the output directory will be made. NOTE: this option only applies to new alignreads directoies. (Default: %s)" % configuration.output_directory)
 yasra_group.add_option("-t", "--read-type", action="store", default=configuration.read_type, type="choice", dest="read_type", choices=["454","solexa"], metavar="454 or solexa",\
@@ -245,6 +431,8 @@ yasra_group.add_option("-e", '--yasra-location', action='store', default=configu
                        help="Specify path binaries used by YASRA. (Default: %s)" % configuration.yasra_location)
 yasra_group.add_option("-l", '--lastz-location', action='store', default=configuration.lastz_location, type='string', metavar='PATH',\
                        help="Specify path binaries used by lastz. (Default: %s)" % configuration.lastz_location)
+yasra_group.add_option("--yasra-timeout", action="store", default=configuration.yasra_timeout, type="float", dest="yasra_timeout", metavar="MINUTES",\
+                       help="Stop YASRA if it has not finished after MINUTES minutes. (Default: %s)" % configuration.yasra_timeout)
 yasra_group.add_option("-E", "--external-makefile", action="store", default=configuration.external_makefile, type="string", dest="external_makefile", metavar="FILEPATH",\
                        help="Specify path to external makefile used by YASRA. (Default: use the makefile built in to runyasra)")
 nucmer_group.add_option("-q", "--break-length", action="store", default=configuration.break_length, type="int", dest="break_length", metavar="INT",\
@@ -279,6 +467,12 @@ makeconsensus_group.add_option("-b", "--proportion-base-filter", action="callbac
                                help="Set the acceptable range(s) for the proportion of bases at a given position that support a given call. Nucleotides with outside of this range will be ignored when condensing the position to an IUPAC character. (Default: %s)" % configuration.proportion_base_filter)
 makeconsensus_group.add_option("-d", "--depth-position-filter", action="callback", default=configuration.depth_position_filter, callback=multRangeCallback, dest='depth_position_filter',\
                                help="Set the depth range(s) for position filtering. Positions outside this range will not be included in the consensus sequences. (Default: %s)" % configuration.depth_position_filter)
+makeconsensus_group.add_option("-w", "--sweep", action="store", default=configuration.sweep, type="string", dest="sweep", metavar="FILEPATH",\
+                               help="Make the consensus with each filter configuration in a file, one per line as options of makeconsensus.py (e.g. '-d 5- -p 0.2-'), reading the alignments once. The output of the Nth configuration is saved in the folder sweep_N of the alignment folder. (Default: %s)" % configuration.sweep)
+makeconsensus_group.add_option("--nucmer-timeout", action="store", default=configuration.nucmer_timeout, type="float", dest="nucmer_timeout", metavar="MINUTES",\
+                               help="Stop nucmer if it has not finished after MINUTES minutes. (Default: %s)" % configuration.nucmer_timeout)
+makeconsensus_group.add_option("--workers", action="store", default=configuration.workers, type="int", dest="workers", metavar="INT",\
+                               help="Make the consensus in INT processes at once (see makeconsensus.py -W). The samples of a sample sheet divide the CPUs among those running at the same time, unless this is given. (Default: %s)" % configuration.workers)
 makeconsensus_group.add_option("-n",   "--nucmer-location",       action="store",      default=configuration.nucmer_location,\
                           help="Specify the location of the nucmer executable.")
 command_line_parser.add_option_group(yasra_group)
@@ -287,6 +481,8 @@ command_line_parser.add_option_group(makeconsensus_group)
 (options, arguments) = command_line_parser.parse_args(sys.argv[1:])
 if options.output_directory is None:
     options.output_directory = os.getcwd()
+if options.sweep is not None:
+    options.sweep = os.path.abspath(options.sweep) #makeconsensus is run in the alignment folder
 if options.config_file is None:
     options.config_file = os.path.join(installation_location, "default_configuration.py")
     if os.path.exists(options.config_file) is False:
@@ -295,6 +491,31 @@ if options.config_file is None:
         raise Exception(error_text)
 ######
 
+### Batch Execution ###
+if options.sample_sheet is not None:
+    if len(arguments) > 0:
+        error = '[alignreads] Arguments can not be used with a sample sheet. %s arguments supplied...' % str(len(arguments))
+        logger.fatal(error)
+        raise ValueError(error)
+    explicit_options = command_line_parser.parse_args(program_arguments[1:], Values())[0] #only the options on the command line
+    if not os.path.isdir(options.output_directory): os.makedirs(options.output_directory) #the status table and log are saved there
+    batch_command_line_options = []
+    for name, value in sorted(explicit_options.__dict__.items()):
+        if name in batch_options: continue
+        name = configuration_names.get(name, name)
+        if name in batch_path_options and isinstance(value, str) and value != '': value = os.path.abspath(value)
+        batch_command_line_options.append((name, value))
+    try:
+        failed_samples = run_batch(options.sample_sheet, batch_command_line_options, options.batch_jobs, options.sample_memory, options.batch_memory)
+    except:
+        logger.exception('An error occured while running the sample sheet "%s".' % options.sample_sheet)
+        failed_samples = None
+    if failed_samples: logger.error('%d samples failed: %s' % (len(failed_samples), ', '.join(failed_samples)))
+    logging.shutdown()
+    shutil.move(temporary_log_file, os.path.join(options.output_directory, os.path.splitext(os.path.basename(options.sample_sheet))[0] + '_log.txt'))
+    sys.exit(0 if failed_samples == [] else 1)
+######
+
 ### Help Menu ###
 if len(arguments) == 0: #if no arguments are supplied
     command_line_parser.print_help()
@@ -385,28 +606,37 @@ logger.debug('Version %s of LASTZ found at %s.' % (nucmer_version, options.nucme
 ### Execution of Runyasra ###
 try:
     if len(arguments) == 2: #if runyasra is to be used...
-        logger.debug('Executing runyasra...')
         yasra_query_path = os.path.abspath(arguments[0])
         yasra_reference_path = os.path.abspath(arguments[1])
-        runyasra_command_line = ['runyasra.py'] + getOptCmndLine(options,runyasra_arguments) + [yasra_query_path, yasra_reference_path]
-        sys.argv = runyasra_command_line
-        logger.info('Implimenting YASRA with runyasra.py using the following command line:\n %s' % ' '.join(runyasra_command_line))
-        try:
-            reload(runyasra)
-        except readtools.InputValidationError as error:
-            raise
-        except readtools.YasraFailure as error:
-            raise
-        except:
-            logger.exception("An unknown error occured during runyasra.")
-            raise
-        else: #if runyasra completed
-            alignreads_folder = runyasra.outDirPath
+        yasra_parameters = get_option_values(options, [key for key in runyasra_arguments if key not in ('output_directory', 'yasra_timeout')])
+        alignreads_folder = find_yasra_folder([options.output_directory, original_cwd], [yasra_query_path, yasra_reference_path], yasra_parameters)
+        if alignreads_folder is not None: #the output of a previous run on the same files with the same options is used instead of running yasra again
+            logger.info('YASRA was already run on the same files with the same options; its output in "%s" will be used.' % alignreads_folder)
             runyasra_folder = os.path.join(alignreads_folder, configuration.yasra_subfolder_name)
-            command_line_record_file_path = os.path.join(runyasra_folder, configuration.command_line_record_file_name)
-            saveCommandLine(configuration.command_line_record_file_name, runyasra_command_line)    
-            mvFiles(alignreads_folder, runyasra_folder)
-        logger.debug('Execution of runyasra complete...')
+        else:
+            logger.debug('Executing runyasra...')
+            runyasra_command_line = ['runyasra.py'] + getOptCmndLine(options,runyasra_arguments) + [yasra_query_path, yasra_reference_path]
+            logger.info('Implimenting YASRA with runyasra.py using the following command line:\n %s' % ' '.join(runyasra_command_line))
+            (runyasra_options, unused_arguments) = runyasra.cmndLineParser.parse_args(runyasra_command_line[1:-2])
+            alignreads_folder = runyasra.outputFolderPath(yasra_query_path, yasra_reference_path, runyasra_options.output_directory)
+            os.mkdir(alignreads_folder)
+            manifest = readtools.StageManifest.forFolder(alignreads_folder)
+            manifest.start('yasra', [yasra_query_path, yasra_reference_path], yasra_parameters)
+            try:
+                (alignreads_folder, yasra_output_paths) = runyasra.run(yasra_query_path, yasra_reference_path, alignreads_folder, **vars(runyasra_options))
+            except readtools.InputValidationError as error:
+                raise
+            except readtools.YasraFailure as error:
+                raise
+            except:
+                logger.exception("An unknown error occured during runyasra.")
+                raise
+            else: #if runyasra completed
+                runyasra_folder = os.path.join(alignreads_folder, configuration.yasra_subfolder_name)
+                saveCommandLine(os.path.join(alignreads_folder, configuration.command_line_record_file_name), runyasra_command_line)
+                mvFiles(alignreads_folder, runyasra_folder, exclude = [readtools.StageManifest.fileName])
+                manifest.complete('yasra', [get_sam_path(runyasra_folder, yasra_query_path, yasra_reference_path)])
+            logger.debug('Execution of runyasra complete...')
 ######
 
 ### Determination of read and reference files from previous runyasra output ###
@@ -414,67 +644,84 @@ try:
         logger.debug('Extracting information from previous alignreads run...')
         alignreads_folder = os.path.abspath(arguments[0])
         runyasra_folder = os.path.join(alignreads_folder, configuration.yasra_subfolder_name)
-        makefile_path = os.path.join(runyasra_folder, 'Makefile') #reads makefile
-        with open(makefile_path, 'r') as makefile_handle:
-            makefile = makefile_handle.readlines()
-        for line in makefile: #the makefile used in the previously run yasra folder is searched to find the names of the input files
-            if line.find('READS=') == 0:
-                yasra_query_path = line.strip().replace('READS=','')
-            elif line.find('TEMPLATE=') == 0:
-                yasra_reference_path = line.strip().replace('TEMPLATE=','')
-                break
+        manifest = readtools.StageManifest.forFolder(alignreads_folder)
+        if 'yasra' in manifest.records and manifest.records['yasra']['status'] == 'complete': #the input files are recorded in the manifest
+            yasra_query_path, yasra_reference_path = [path for path, digest in manifest.records['yasra']['inputs']]
+        else: #folders made before manifests were kept
+            makefile_path = os.path.join(runyasra_folder, 'Makefile') #reads makefile
+            with open(makefile_path, 'r') as makefile_handle:
+                makefile = makefile_handle.readlines()
+            for line in makefile: #the makefile used in the previously run yasra folder is searched to find the names of the input files
+                if line.find('READS=') == 0:
+                    yasra_query_path = line.strip().replace('READS=','')
+                elif line.find('TEMPLATE=') == 0:
+                    yasra_reference_path = line.strip().replace('TEMPLATE=','')
+                    break
         logger.debug('Extraction of information from previous alignreads run complete.')
 ######
 
+### Reuse of Previous makeconsensus Output ###
+    yasra_query_link_path = os.path.join(runyasra_folder, os.path.basename(yasra_query_path))
+    yasra_reference_link_path = os.path.join(runyasra_folder, os.path.basename(yasra_reference_path))
+    sam_path = get_sam_path(runyasra_folder, yasra_query_link_path, yasra_reference_link_path)
+    makeconsensus_parameters = get_option_values(options, makeconsensus_arguments.keys() + nucmer_arguments.keys())
+    makeconsensus_inputs = [sam_path, yasra_reference_link_path] + ([options.sweep] if options.sweep is not None else [])
+    manifest = readtools.StageManifest.forFolder(alignreads_folder)
+    current_stages = [name for name in manifest.stages if name.startswith('makeconsensus ') and\
+                      manifest.isCurrent(name, makeconsensus_inputs, makeconsensus_parameters)]
+    if len(current_stages) > 0:
+        logger.info('makeconsensus was already run on the same alignments with the same options; its output is in "%s".' %\
+                    os.path.join(alignreads_folder, current_stages[-1].split(' ', 1)[1]))
+        new_folder_path = alignreads_folder #the execution information of this run is saved here instead of replacing that of the previous run
+######
+
 ### Generation of New Alignment Folder ###
-    try:
-        logger.debug('Preparing output folder for post-yasra anaylsis....')
-        alignment_folders = [name for name in os.listdir(alignreads_folder) if os.path.isdir(os.path.join(alignreads_folder, name)) and\
-                             re.match("%s_(\S+_)?\d+" % configuration.make_consensus_sub_folder_name, name) is not None]
-        if len(alignment_folders) > 0:
-            highest_count = max([int(re.match("%s_(\S+_)?(\d+)" % configuration.make_consensus_sub_folder_name, name).groups()[1]) for name in alignment_folders])
-        else:
-            highest_count = 0
-        new_folder_name = '%s' % configuration.make_consensus_sub_folder_name
-        if options.run_id is not None:
-            new_folder_name = '%s_%s_%d' % (configuration.make_consensus_sub_folder_name, options.run_id, highest_count + 1)
-            count = 2
-            while new_folder_name in alignment_folders:
-                new_folder_name = '%s_%s(%d)_%d' % (configuration.make_consensus_sub_folder_name, options.run_id, count, highest_count + 1)
-                count += 1
-        else:
-            new_folder_name = '%s_%d' % (configuration.make_consensus_sub_folder_name, highest_count + 1)
-        new_folder_path = os.path.join(alignreads_folder, new_folder_name)
-        os.mkdir(new_folder_path)
-    except:
-        logger.exception('An unknown error occured during creation of new alignment folder')
-        raise
     else:
-        logger.debug('Prepartion of output folder for post-yasra anaylsis complete.')
+        try:
+            logger.debug('Preparing output folder for post-yasra anaylsis....')
+            alignment_folders = [name for name in os.listdir(alignreads_folder) if os.path.isdir(os.path.join(alignreads_folder, name)) and\
+                                 re.match("%s_(\S+_)?\d+" % configuration.make_consensus_sub_folder_name, name) is not None]
+            if len(alignment_folders) > 0:
+                highest_count = max([int(re.match("%s_(\S+_)?(\d+)" % configuration.make_consensus_sub_folder_name, name).groups()[1]) for name in alignment_folders])
+            else:
+                highest_count = 0
+            new_folder_name = '%s' % configuration.make_consensus_sub_folder_name
+            if options.run_id is not None:
+                new_folder_name = '%s_%s_%d' % (configuration.make_consensus_sub_folder_name, options.run_id, highest_count + 1)
+                count = 2
+                while new_folder_name in alignment_folders:
+                    new_folder_name = '%s_%s(%d)_%d' % (configuration.make_consensus_sub_folder_name, options.run_id, count, highest_count + 1)
+                    count += 1
+            else:
+                new_folder_name = '%s_%d' % (configuration.make_consensus_sub_folder_name, highest_count + 1)
+            new_folder_path = os.path.join(alignreads_folder, new_folder_name)
+            os.mkdir(new_folder_path)
+        except:
+            logger.exception('An unknown error occured during creation of new alignment folder')
+            raise
+        else:
+            logger.debug('Prepartion of output folder for post-yasra anaylsis complete.')
 ######
 
 ### Execution of makeconsensus.py ###
-    logger.debug('Executing makeconsensus...')
-    yasra_query_link_path = os.path.join(runyasra_folder, os.path.basename(yasra_query_path))
-    yasra_reference_link_path = os.path.join(runyasra_folder, os.path.basename(yasra_reference_path))
-    sam_path = os.path.join(runyasra_folder, 'alignments_%s_%s.sam' % (os.path.basename(yasra_query_link_path), os.path.basename(yasra_reference_link_path)))
-    makeconsensus_command_line = ['makeConsensus.py'] + [sam_path, yasra_reference_link_path] +\
-                                 getOptCmndLine(options,makeconsensus_arguments) +\
-                                 getOptCmndLine(options,nucmer_arguments)    
-    try:
-        os.chdir(new_folder_path)
-        sys.argv = makeconsensus_command_line
-        reload(makeconsensus)
-    except:
-        logger.fatal('An error occured during execution of makeconsensus.py:')
-        raise
-    else:
-        sys.argv = program_arguments
-        os.chdir(original_cwd)
-    finally:
-        os.chdir(original_cwd)
-        sys.argv = program_arguments
-        logger.debug('Execution of makeconsensus complete.')
+        logger.debug('Executing makeconsensus...')
+        makeconsensus_command_line = ['makeConsensus.py'] + [sam_path, yasra_reference_link_path] + getOptCmndLine(options,makeconsensus_arguments) + getOptCmndLine(options,nucmer_arguments) +\
+                                     ['--nucmer-cache', os.path.join(alignreads_folder, configuration.nucmer_cache_folder_name), '--pileup-cache'] +\
+                                     getOptCmndLine(options, {'nucmer_timeout' : '--nucmer-timeout'}) + ['--workers', str(options.workers)] #contigs unchanged since a previous run are not aligned again and the reads are not parsed again; the time limit and workers are not parameters of the output
+        logger.info('Implimenting makeconsensus with the following command line:\n %s' % ' '.join(makeconsensus_command_line))
+        (makeconsensus_options, unused_arguments) = makeconsensus.cmndLineParser.parse_args(makeconsensus_command_line[3:])
+        stage_name = 'makeconsensus %s' % new_folder_name
+        manifest.start(stage_name, makeconsensus_inputs, makeconsensus_parameters)
+        try:
+            makeconsensus_outputs = makeconsensus.run(sam_path, yasra_reference_link_path, new_folder_path, **vars(makeconsensus_options))
+        except:
+            logger.fatal('An error occured during execution of makeconsensus.py:')
+            raise
+        else:
+            contig_paths = [contig_path for contig_path, aligned_contig_path, contigs, aligned_pileups in makeconsensus_outputs]
+            manifest.complete(stage_name, contig_paths + [path + '_aligned.fa' for path in contig_paths])
+        finally:
+            logger.debug('Execution of makeconsensus complete.')
 ######
 
 ### Log File and Clean Up ###
@@ -11,6 +11,7 @@ single_step = False
 yasra_location = ""
 lastz_location = ""
 external_makefile = False
+yasra_timeout = None
 ######
 
 ### Nucmer Options ###
@@ -33,12 +34,23 @@ quality_read_filter = None
 depth_position_masking = None
 proportion_base_filter = None
 depth_position_filter = None 
+sweep = None
 nucmer_location = ""
+nucmer_timeout = None
+workers = 1
 python_location = ""
 ######
 
+### Batch Options ###
+sample_sheet = None
+batch_jobs = None
+sample_memory = None
+batch_memory = None
+######
+
 yasra_subfolder_name = 'YASRA_related_files'
 make_consensus_sub_folder_name = 'alignment'
+nucmer_cache_folder_name = 'nucmer_cache'
 command_line_record_file_name = 'Command_Line_Record.txt'
 execution_info_file_name = 'Execution_info.txt'
 
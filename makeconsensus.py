@@ -2,7 +2,9 @@
 
 ###Imports and Import Validation###
 import readtools
-import os, sys, copy
+import numpy as np
+import os, sys, copy, re, multiprocessing, shlex
+from Bio.Seq import Seq
 from optparse import *
 from datetime import *
 import logging
@@ -26,13 +28,12 @@ argList     = sys.argv #argumen list supplied by user
 argNum      = len(argList) #the number of arguments supplied
 debugLog    = ['***********DEBUG LOG***********\n'] #where all errors/anomalies are recorded; saved if the -d modifier is supplied
 timeStamp = datetime.now().ctime().replace(' ','-').replace(':','-').replace('--','-')  #Ex: 'Mon-Jun-14-11-08-55-2010'
-cwd         = os.getcwd()
 program_name, program_version, progArgNum = ('makeConsensus.py','1.1.1', 2)
 progDescription =\
 '''
-Makes a consensus sequence for each reference to which reads are aligned to in a SAM file.
+Makes a consensus sequence for each reference to which reads are aligned to in a SAM file. BAM files (ending in '.bam') are also read.
 '''
-progUsage = 'python %s <SAM file> <Reference FASTA file> [options]' % program_name
+progUsage = 'python %s <SAM/BAM file> <Reference FASTA file> [options]' % program_name
 spacingCharacters = ['-','~']
 printLog = []
 
@@ -121,6 +122,10 @@ cmndLineParser.add_option("-r",   "--quality-read-filter",       action="callbac
 ##Base filtering
 cmndLineParser.add_option("-p",   "--proportion-base-filter",       action="callback",      default=[[None, None]],    callback=multRangeCallback,    dest='proportion_base_filter',\
                           help="Set the acceptable range(s) for the proportion of bases at a given position that support a given call. Nucleotides with outside of this range will be ignored when condensing the position to an IUPAC character.")
+cmndLineParser.add_option("-q",   "--minimum-base-quality",       action="store",      default=None,     type="int",     dest='minimum_base_quality',     metavar="INT",\
+                          help="Ignore bases with a phred quality below INT. Bases of reads without qualities are always used. (Default: use all bases)")
+cmndLineParser.add_option("-Q",   "--quality-weighted",       action="store_true",      default=False,     dest='quality_weighted',\
+                          help="Call each position by the summed quality of the bases supporting each call instead of their number. (Default: call by number)")
 #cmndLineParser.add_option("-s",   "--SNP-quality-masking",       action="callback",      default=[],    callback=multRangeCallback,    dest='SNP_quality_masking',\
 #                          help="Set the acceptable quality range(s) for masking. Bases outside this range will be masked")
 ##Position filtering
@@ -134,6 +139,18 @@ cmndLineParser.add_option("-u",   "--include-unaligned",       action="store_tru
                           help="Include the unaligned portions of the sequence in the output (Default: only output aligned regions.")
 cmndLineParser.add_option("-N",   "--nucmer-location",       action="store",      default='nucmer',\
                           help="Specify the location of the nucmer executable.")
+cmndLineParser.add_option("-R",   "--region",       action="store",      default=None,     type="string",     dest='region',     metavar="REFERENCE[:START-END]",\
+                          help="Only make the consensus of the reads aligned to the reference specified that overlap the region between START and END (inclusive). An index of the SAM file is used to read only those reads; it is saved as <SAM file>.sri and remade when the SAM file changes. BAM files are read in full. (Default: use all references)")
+cmndLineParser.add_option("-w",   "--window-size",       action="store",      default=0,     type="int",     dest='window_size',     metavar="INT",\
+                          help="Make the consensus of each reference in windows of INT positions, keeping only the reads that overlap the current window in memory. Requires the reads of each reference to be sorted by position. (Default: 0, make the consensus of one whole reference at a time)")
+cmndLineParser.add_option("-W",   "--workers",       action="store",      default=1,     type="int",     dest='workers',     metavar="INT",\
+                          help="Make the consensus in INT processes at once. References are divided among the processes; a single reference is divided into windows. The output is the same as with one process. (Default: 1)")
+cmndLineParser.add_option(      "--bam-output",       action="store_true",      default=False,     dest='bam_output',\
+                          help="Also save the alignments of the reads to the contigs as <SAM file>.fa_reads.bam and of the contigs to the reference as <SAM file>.fa_aligned.bam, sorted and compressed. Can not be used with --window-size. (Default: only save FASTA)")
+cmndLineParser.add_option(      "--sweep",       action="store",      default=None,     type="string",     dest='sweep',     metavar="FILE",\
+                          help="Make the consensus with each filter configuration in FILE, one per line as filtering options of this program (-r, -p, -q, -Q, -f and -d, e.g. '-d 5- -p 0.2-'); options not given on a line keep the values of the command line. The reads are parsed once and each read filter is applied and padded once. The output of the Nth configuration is saved in the folder sweep_N, and contigs are aligned with a nucmer cache ('nucmer_cache' unless --nucmer-cache is given), so contigs shared by configurations are aligned once. Can not be used with --window-size or --bam-output. (Default: use the filters of the command line)")
+cmndLineParser.add_option(      "--pileup-cache",       action="store_true",      default=False,     dest='pileup_cache',\
+                          help="Save the parsed reads of the SAM file next to it as <SAM file>.pileups, so later runs on the same file load them instead of parsing it again. A current cache is always used. (Default: do not save a cache)")
 cmndLineParser.add_option(      '--touch',       action='store_true',    default=False,\
                           help='Load silently and do nothing.')
 nucmerGroup.add_option(     "-n",   "--prefix",             action="store",         default="out",      type="string",  dest="prefix",          metavar="STRING",   help="Set the output file prefix (Default: out)")
@@ -148,91 +165,281 @@ nucmerGroup.add_option(     "-m",   "--min-match",          action="store",
 nucmerGroup.add_option(     "-c",   "--coords",             action="store_true",    default=False,                      dest="coords",                              help="Automatically generate the <prefix>.coords file using the 'show-coords' program with the -r option. (Default: dont)")
 nucmerGroup.add_option(     "-o",   "--no-optimize",        action="store_true",    default=False,                      dest="nooptimize",                          help="Toggle alignment score optimization. Setting --nooptimize will prevent alignment score optimization and result in sometimes longer, but lower scoring alignments (default: optimize)")
 nucmerGroup.add_option(     "-s",   "--no-simplify",        action="store_true",    default=False,                      dest="nosimplify",                          help="Simplify alignments by removing shadowed clusters. Turn this option off if aligning a sequence to itself to look for repeats. (Default: simplify)")
+nucmerGroup.add_option(             "--nucmer-cache",       action="store",         default=None,       type="string",  dest="nucmer_cache",    metavar="DIRECTORY",help="Keep the nucmer alignments of each contig in DIRECTORY and only align the contigs that are not there for the same reference and nucmer options. The cache can be shared by runs with different consensus options. (Default: align every contig)")
+nucmerGroup.add_option(             "--nucmer-timeout",     action="store",         default=None,       type="float",   dest="nucmer_timeout",  metavar="MINUTES",  help="Stop nucmer if it has not finished after MINUTES minutes. (Default: no limit)")
 
 cmndLineParser.add_option_group(nucmerGroup)
-(options, args) = cmndLineParser.parse_args(argList)
-if options.touch is False:
-    if len(args) == 1:
-        cmndLineParser.print_help()
-        sys.exit(0)
-    argNum = len(args) - 1   #counts the amount of arguments, negating the script name at the start of the command line
-    if argNum != progArgNum: errorExit('%s takes exactly %d argument(s); %d supplied' % (program_name, progArgNum, argNum), 0)
-    samPath, referencePath = args[-2], args[-1]
+###
+
+def _initBlockWorker(makeBlockContigs):
+    '''Keeps the function that makes the contigs of a block of the SAM index in a worker process. Each run starts its own pool with
+    its own function, which the forked workers are given as an argument, so runs on different threads do not share it.'''
+    multiprocessing.current_process().makeBlockContigs = makeBlockContigs
+
+def _makeBlockContigs(blockIndex):
+    '''Makes the contigs of a block of the SAM index in a worker process with the function of the run that started its pool.'''
+    return multiprocessing.current_process().makeBlockContigs(blockIndex)
+
+def run(samPath, referencePath, outputDirectory = None, **optionValues):
+    '''Version 1.0
+    Makes the consensus of the reads aligned to each reference in a SAM or BAM file and aligns the consensus sequences (contigs) to the
+    sequences of a reference FASTA file with nucmer, saving the output in outputDirectory (Default: the current working directory).
+    The options are given by the names the command line options are saved as (e.g. depth_position_filter or breaklen), with the values
+    the command line parser makes of them (e.g. [[5, None]] for '-f 5-'); options not given have their default values. Errors in the
+    input or the options raise readtools.InputValidationError. Returns the (contig FASTA path, aligned contigs FASTA path, contigs,
+    aligned contig pileups) of each filter configuration: one, unless a sweep is given.'''
+    options = cmndLineParser.get_default_values()
+    for name, value in optionValues.iteritems():
+        if not hasattr(options, name): raise TypeError("run() got an unexpected keyword argument '%s'" % name)
+        setattr(options, name, value)
+    if outputDirectory is None: outputDirectory = os.getcwd()
+    outputDirectory = os.path.abspath(outputDirectory)
+    isBam = samPath.lower().endswith('.bam')
+    sweepFilterOptions = ('quality_read_filter', 'proportion_base_filter', 'minimum_base_quality', 'quality_weighted', 'depth_position_filter', 'depth_position_masking')
+    sweepOptions, sweepLines = None, []
+    if options.sweep is not None:
+        if options.window_size > 0 or options.bam_output: raise readtools.InputValidationError("option 'sweep' can not be used with option 'window-size' or 'bam-output'.")
+        sweepOptions = []
+        with open(options.sweep, 'r') as sweepHandle:
+            for line in sweepHandle:
+                if line.strip() == '' or line.lstrip().startswith('#'): continue
+                (lineOptions, lineArgs) = cmndLineParser.parse_args(shlex.split(line), copy.copy(options))
+                changed = [name for name in vars(options) if name not in sweepFilterOptions and getattr(lineOptions, name) != getattr(options, name)]
+                if len(lineArgs) > 0 or len(changed) > 0: raise readtools.InputValidationError("the sweep file '%s' can only give filtering options; '%s' supplied." % (options.sweep, line.strip()))
+                sweepOptions.append(lineOptions)
+                sweepLines.append(line.strip())
+        if len(sweepOptions) == 0: raise readtools.InputValidationError("the sweep file '%s' has no filter configurations." % options.sweep)
+        if options.nucmer_cache is None: options.nucmer_cache = os.path.join(outputDirectory, 'nucmer_cache')
     ###
 
 
     ###Filtering and masking functions###
-    def baseProportionFilter(positionData, proportionRanges = [[None, None]]):
-        #NOTE: not efficient
-        def removeAll(refList, delList, entry):
-            for index in reversed(range(0,len(refList))):
-                if refList[index] == entry:
-                    del refList[index], delList[index]
-        bases, baseIndexes = [], []
-        for read, index, cigar in positionData:
-            if cigar in readtools.cigarInsertTypes:
-                bases.append(readtools.cigarInsertTypes[cigar])
-            else:
-                bases.append(read.seq[index])
-        typeFrequency = readtools.getVariantFrequency(bases)
-        depth = len(bases)
-        for count, nucleotide in typeFrequency:
-            proportion = float(count) / float(depth)
-            if readtools.withinRanges(proportion, proportionRanges) == False:
-                removeAll(bases, positionData, nucleotide)
-        return positionData
+    def baseProportionFilter(counts, proportionRanges = [[None, None]]):
+        '''Removes the symbols of a column whose proportion of the column depth is outside the ranges supplied.'''
+        depth = float(counts.sum())
+        counts = counts.copy()
+        for symbolIndex in counts.nonzero()[0]:
+            if readtools.withinRanges(counts[symbolIndex] / depth, proportionRanges) == False:
+                counts[symbolIndex] = 0
+        return counts
+
+    def baseProportionColumnFilter(counts, proportionRanges = [[None, None]]):
+        '''baseProportionFilter applied to every column of a ColumnCounts matrix at once.'''
+        depths = counts.sum(axis = 1).astype(float)[:, np.newaxis]
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            passes = readtools.rangesMask(counts / depths, proportionRanges)
+        return np.where(passes | (counts == 0), counts, 0).astype(counts.dtype)
 
     def getReadQuality(read):
         return read.quality
 
-    def getPositionDepth(positionData):
-        length = 0
-        for read, index, cigar in positionData:
-            if cigar in readtools.cigarAlignedTypes:
-                length += 1
-        return length
+    def getPositionDepth(counts):
+        return counts[readtools.sequenceSymbolCodes].sum()
+
+    def getColumnDepths(counts):
+        return counts[:, readtools.sequenceSymbolCodes].sum(axis = 1)
 
 
     ###
 
     ###Filter and masking initialization###
-    readFilters     = [readtools.AttributeFilter(getReadQuality, options.quality_read_filter)]
-    baseFilters     = [readtools.CustomizedFunction(baseProportionFilter, proportionRanges = options.proportion_base_filter)]
-    positionFilters = [readtools.AttributeFilter(getPositionDepth, options.depth_position_filter)]
-    positionMasking = [readtools.AttributeFilter(getPositionDepth, options.depth_position_masking)]
+    def makeFilters(filterOptions):
+        '''Returns the read, base, position and masking filters and the base quality options set by the options given.'''
+        readFilters     = [readtools.AttributeFilter(getReadQuality, filterOptions.quality_read_filter)]
+        baseFilters     = [readtools.CustomizedFunction(baseProportionFilter, columnFunction = baseProportionColumnFilter, proportionRanges = filterOptions.proportion_base_filter)]
+        positionFilters = [readtools.AttributeFilter(getPositionDepth, filterOptions.depth_position_filter, columnFunction = getColumnDepths)]
+        positionMasking = [readtools.AttributeFilter(getPositionDepth, filterOptions.depth_position_masking, columnFunction = getColumnDepths)]
+        qualityOptions  = {'minimumQuality' : filterOptions.minimum_base_quality, 'qualityWeighted' : filterOptions.quality_weighted}
+        return (readFilters, baseFilters, positionFilters, positionMasking, qualityOptions)
+    readFilters, baseFilters, positionFilters, positionMasking, qualityOptions = makeFilters(options)
     ###
 
     ###Implimentation###
-    contigPath = os.path.join(cwd, os.path.basename(samPath) + '.fa')
-    pileups = list(readtools.PileupIO.parse(samPath, 'sam', applyPadding = False)) 
-    ##Apply read filtering
-    for pileup in pileups:
-        for readFilter in readFilters:
-            pileup.alignments = filter(readFilter, pileup.alignments)
-        pileup.padAlignments()
-    alignedContigsPath = contigPath + '_aligned.fa'
-    #readtools.PileupIO.write(pileups, alignedContigsPath, 'fasta')
-    ##Make contigs and save for nucmer
-    contigs = [pileup.makeConsensus(baseFilters, positionFilters, positionMasking, IUPAC = False) for pileup in pileups]
-    readtools.PileupAlignmentIO.write(contigs, contigPath, 'fasta')
-    ##Align contigs with nucmer
-    options.prefix = os.path.basename(contigPath)
-    readtools.runNucmer(contigPath, referencePath, nucmer_path=options.nucmer_location, breaklen=options.breaklen, mincluster=options.mincluster, diagfactor=options.diagfactor, noextend=options.noextend,\
-                        maxgap=options.maxgap, minmatch=options.minmatch, coords=options.coords, nooptimize=options.nooptimize, prefix=options.prefix,\
-                        nosimplify=options.nosimplify, forward=options.forward)
-    ##Apply nucmer alignments to contigs
-    reference = list(readtools.PileupAlignmentIO.parse(referencePath, 'fasta'))[0] #Loads reference from file
-    reference = readtools.PileupAlignment.fromAlignment(reference, cigar = '%dM' % len(reference.seq), start = 1)
-    alignedContigsPath = contigPath + '_aligned.fa'
-    alignedContigs = readtools.Pileup.fromNucmer(os.path.basename(contigPath) + '.delta', alignments = contigs)
-    ##Save FASTA output
-    #readtools.PileupIO.write(pileups, alignedContigsPath, 'fasta')
-    if alignedContigs is not None:
-        alignedContigs.alignments = [reference] + alignedContigs.alignments
-        alignedContigs.padAlignments() #aligns to reference
-        alignedContigs.alignments = alignedContigs.alignments[1:] #removes reference 
-        contigsConsensus = alignedContigs.makeConsensus([], [], [], IUPAC = True)
-        contigsConsensus.id = 'Consensus'
-        alignedContigs.alignments = [reference, contigsConsensus] + alignedContigs.alignments
-        readtools.PileupIO.write([alignedContigs], alignedContigsPath, 'fasta', includeUnalignedSequence = options.include_unaligned)
-    ###
+    contigPath = os.path.join(outputDirectory, os.path.basename(samPath) + '.fa')
+    if options.bam_output and options.window_size > 0: raise readtools.InputValidationError("option 'bam-output' can not be used with option 'window-size'; the reads of a whole reference are needed to align them to its contig.")
+    readsWriter = readtools.BamWriter(contigPath + '_reads.bam', threads = options.workers) if options.bam_output else None
+    if options.region is None:
+        regionReference = None
+    else:
+        regionMatch = re.match('^(.+?)(?::([0-9]+)-([0-9]+))?$', options.region)
+        if regionMatch is None: raise readtools.InputValidationError("option 'region' requires a reference name, optionally followed by a range such as ':1000-3000'; '%s' supplied." % options.region)
+        regionReference, regionStart, regionEnd = regionMatch.groups()
+        if regionStart is not None: regionStart, regionEnd = int(regionStart), int(regionEnd)
+
+    def makeContigs(pileups, workers = 1):
+        '''Yields the consensus of each pileup after read filtering, holding the reads of only one reference at a time. Each consensus
+        is made by the number of worker processes given (see readtools.Pileup.parallelConsensus).'''
+        for pileup in pileups:
+            for readFilter in readFilters:
+                pileup.alignments = filter(readFilter, pileup.alignments)
+            if len(pileup.alignments) == 0: continue #no reads of this reference passed the read filters
+            pileup.padAlignments()
+            contig = pileup.makeConsensus(baseFilters, positionFilters, positionMasking, IUPAC = False, workers = workers, **qualityOptions)
+            if readsWriter is not None:
+                sequence = str(contig.seq)
+                readsWriter.addReference(contig.id, len(sequence) - sum([sequence.count(spacer) for spacer in readtools.cigarInsertTypes.values()]))
+                readsWriter.write(pileup.realign(sequence, contig.start, contig.id))
+            yield contig
+
+    def makeSweepContigs(pileups, workers = 1):
+        '''Yields the consensus of each pileup made with every filter configuration of the sweep, as a list in configuration order (None
+        where no reads pass the read filter). Configurations with the same read filter share one filtered and padded pileup, and those
+        that also have the same quality options share its column counts (see readtools.Pileup.makeConsensusVariants).'''
+        sweepFilters = [makeFilters(sweepOption) for sweepOption in sweepOptions]
+        readFilterGroups = [] #the indexes of the configurations with each read filter
+        for index, sweepOption in enumerate(sweepOptions):
+            for group in readFilterGroups:
+                if sweepOptions[group[0]].quality_read_filter == sweepOption.quality_read_filter:
+                    group.append(index)
+                    break
+            else:
+                readFilterGroups.append([index])
+        for pileup in pileups:
+            alignments, contigs = pileup.alignments, [None] * len(sweepOptions)
+            for group in readFilterGroups:
+                pileup.alignments = alignments
+                for readFilter in sweepFilters[group[0]][0]:
+                    pileup.alignments = filter(readFilter, pileup.alignments)
+                if len(pileup.alignments) == 0: continue #no reads of this reference passed the read filter
+                pileup.padAlignments()
+                filterSets = [dict(baseFilters = sweepFilters[index][1], positionFilters = sweepFilters[index][2], maskingFilters = sweepFilters[index][3], **sweepFilters[index][4])
+                              for index in group]
+                for index, contig in zip(group, pileup.makeConsensusVariants(filterSets, IUPAC = False)): contigs[index] = contig
+            yield contigs
+
+    def makeWindowedContigs(samRecords):
+        '''Yields the consensus of each reference, holding the reads of only one window at a time. Windows are padded separately;
+        since every read with an insertion after a position overlaps it, joining the consensus of the windows gives the same sequence.'''
+        samRecords = (samRecord for samRecord in samRecords if False not in [readFilter(samRecord) for readFilter in readFilters])
+        contigName = None
+        for pileup, start, end in readtools.PileupIO.readSamWindows(samRecords, options.window_size):
+            if pileup.name != contigName:
+                if contigName is not None: yield readtools.PileupAlignment(Seq(''.join(sequences)), start = contigStart, id = contigName)
+                contigName, contigStart, previousEnd, sequences = pileup.name, start, None, []
+            if previousEnd is not None and start > previousEnd + 1: #positions between windows that no read covers
+                sequences.append(readtools.ColumnCounts.empty(start - previousEnd - 1).consensus(baseFilters, positionFilters, positionMasking, IUPAC = False))
+            paddedStart, paddedEnd = pileup.paddedRegion(start, end)
+            sequences.append(str(pileup.makeConsensus(baseFilters, positionFilters, positionMasking, IUPAC = False, start = paddedStart, end = paddedEnd, **qualityOptions).seq))
+            previousEnd = end
+        if contigName is not None: yield readtools.PileupAlignment(Seq(''.join(sequences)), start = contigStart, id = contigName)
+
+    def makeBlockContigs(blockIndex):
+        '''Makes the consensus of the reads in one block of the SAM index (see readtools.SamIndex). Called by the worker processes.'''
+        startOffset, endOffset = samIndex.blocks[blockIndex][1:3]
+        samRecords = readtools.AlignmentIO.readSamRange(samPath, startOffset, endOffset)
+        if options.window_size > 0: return (blockIndex, list(makeWindowedContigs(samRecords)))
+        return (blockIndex, list(makeContigs([readtools.PileupIO.fromSamRecords(samRecords, applyPadding = False)])))
+
+    def makeParallelContigs():
+        '''Yields the consensus of each reference in file order, made by a pool of worker processes. The largest references are
+        started first so that one long reference does not finish after all the others.'''
+        blockIndexes = sorted(range(len(samIndex.blocks)), key = lambda blockIndex: -samIndex.blocks[blockIndex][5])
+        pool = multiprocessing.Pool(options.workers, _initBlockWorker, (makeBlockContigs,)) #the workers are forked, so the function is not pickled
+        try:
+            blockContigs = dict(pool.imap_unordered(_makeBlockContigs, blockIndexes))
+        finally:
+            pool.terminate()
+        for blockIndex in range(len(samIndex.blocks)):
+            for contig in blockContigs.pop(blockIndex): yield contig
+
+    def fetchBamRecords():
+        '''Yields the records of the BAM file that overlap the region; BAM files have no SAM index, so every record is read.'''
+        for samRecord in readtools.BamReader(samPath, options.workers).samRecords():
+            if samRecord.reference != regionReference: continue
+            if regionStart is not None and (samRecord.start > regionEnd or samRecord.end() < regionStart): continue
+            yield samRecord
+
+    def alignContigs(contigs, contigPath, prefix):
+        '''Aligns the contigs saved at contigPath to the reference with nucmer, saving its output with the prefix given, and saves
+        the contigs aligned to each reference sequence with their consensus. Returns the (contigPath, aligned contigs path, contigs,
+        aligned contig pileups).'''
+        ##Align contigs with nucmer
+        nucmerOptions = dict(nucmer_path=options.nucmer_location, breaklen=options.breaklen, mincluster=options.mincluster, diagfactor=options.diagfactor, noextend=options.noextend,\
+                             maxgap=options.maxgap, minmatch=options.minmatch, coords=options.coords, nooptimize=options.nooptimize, prefix=prefix,\
+                             nosimplify=options.nosimplify, forward=options.forward, timeout=None if options.nucmer_timeout is None else options.nucmer_timeout * 60)
+        if options.nucmer_cache is not None:
+            readtools.runCachedNucmer(contigPath, referencePath, options.nucmer_cache, **nucmerOptions)
+        else:
+            readtools.runNucmer(contigPath, referencePath, **nucmerOptions)
+        ##Apply nucmer alignments to contigs
+        referenceFasta = readtools.IndexedFasta(referencePath) #reads the reference sequences from the file through its index when used
+        alignedContigsPath = contigPath + '_aligned.fa'
+        alignedPileups = readtools.Pileup.fromNucmerByReference(prefix + '.delta', alignments = contigs)
+        ##Save FASTA output; each reference sequence with contigs aligned to it is a separate pileup
+        alignedBamRecords = []
+        for alignedContigs in alignedPileups:
+            reference = referenceFasta.alignment(alignedContigs.name)
+            alignedContigs.alignments = [reference] + alignedContigs.alignments
+            alignedContigs.padAlignments() #aligns to reference
+            if options.bam_output:
+                alignedBamRecords += alignedContigs.realign(reference.paddedSequence(), reference.alignedStart(), reference.id, alignedContigs.alignments[1:])
+            alignedContigs.alignments = alignedContigs.alignments[1:] #removes reference 
+            contigsConsensus = alignedContigs.makeConsensus([], [], [], IUPAC = True)
+            contigsConsensus.id = 'Consensus'
+            alignedContigs.alignments = [reference, contigsConsensus] + alignedContigs.alignments
+            readtools.PileupIO.write([alignedContigs], alignedContigsPath, 'fasta', includeUnalignedSequence = options.include_unaligned)
+        if options.bam_output and len(alignedPileups) > 0:
+            readtools.AlignmentIO.writeBam(alignedBamRecords, contigPath + '_aligned.bam', referenceFasta.references(), options.workers)
+        referenceFasta.close()
+        return (contigPath, alignedContigsPath, contigs, alignedPileups)
+
+    ##Make contigs and save for nucmer; each is written as soon as it is made
+    makePileupContigs = makeContigs if sweepOptions is None else makeSweepContigs
+    if regionReference is not None:
+        if isBam: regionRecords = fetchBamRecords()
+        else: regionRecords = readtools.AlignmentIO.fetchSamRecords(samPath, regionReference, regionStart, regionEnd)
+        if options.window_size > 0:
+            contigSource = makeWindowedContigs(regionRecords)
+        else:
+            regionRecords = list(regionRecords)
+            if len(regionRecords) == 0: raise readtools.InputValidationError("no reads in '%s' overlap the region '%s'." % (samPath, options.region))
+            contigSource = makePileupContigs([readtools.PileupIO.fromSamRecords(regionRecords, applyPadding = False)], options.workers)
+    elif isBam:
+        if options.window_size > 0: contigSource = makeWindowedContigs(readtools.BamReader(samPath, options.workers).samRecords())
+        else: contigSource = makePileupContigs(readtools.PileupIO.parse(samPath, 'bam', applyPadding = False), options.workers)
+    elif options.workers > 1 and not options.bam_output and sweepOptions is None and len(readtools.SamIndex.forFile(samPath).blocks) > 1: #one reference is split into windows instead
+        samIndex = readtools.SamIndex.forFile(samPath)
+        contigSource = makeParallelContigs()
+    elif options.window_size > 0:
+        contigSource = makeWindowedContigs(readtools.AlignmentIO.readSamRecords(samPath))
+    else:
+        contigSource = makePileupContigs(readtools.PileupIO.parse(samPath, 'sam', applyPadding = False, writeCache = options.pileup_cache), options.workers)
+    if sweepOptions is not None:
+        ##Save the contigs of each configuration in its own folder, then align them
+        sweepContigPaths = [os.path.join(outputDirectory, 'sweep_%d' % (index + 1), os.path.basename(contigPath)) for index in range(len(sweepOptions))]
+        for sweepContigPath, sweepLine in zip(sweepContigPaths, sweepLines):
+            if not os.path.isdir(os.path.dirname(sweepContigPath)): os.mkdir(os.path.dirname(sweepContigPath))
+            for stalePath in (sweepContigPath, sweepContigPath + '_aligned.fa'): #contigs are added to the files as they are made
+                if os.path.exists(stalePath): os.remove(stalePath)
+            with open(os.path.join(os.path.dirname(sweepContigPath), 'sweep_options.txt'), 'w') as handle: handle.write(sweepLine + '\n')
+        sweepContigs = [[] for sweepContigPath in sweepContigPaths]
+        for contigs in contigSource:
+            for contig, sweepContigPath, configurationContigs in zip(contigs, sweepContigPaths, sweepContigs):
+                if contig is None: continue
+                readtools.PileupAlignmentIO.write([contig], sweepContigPath, 'fasta')
+                configurationContigs.append(contig)
+        return [alignContigs(configurationContigs, sweepContigPath, sweepContigPath) for sweepContigPath, configurationContigs in zip(sweepContigPaths, sweepContigs)]
+    else:
+        contigs = []
+        for contig in contigSource:
+            readtools.PileupAlignmentIO.write([contig], contigPath, 'fasta')
+            contigs.append(contig)
+        if readsWriter is not None: readsWriter.close()
+        if len(contigs) == 0 and regionReference is not None: raise readtools.InputValidationError("no reads in '%s' overlap the region '%s'." % (samPath, options.region))
+        return [alignContigs(contigs, contigPath, contigPath)]
+###
+
+###Command Line Interface###
+if __name__ == '__main__':
+    (options, args) = cmndLineParser.parse_args(argList)
+    if options.touch is False:
+        if len(args) == 1:
+            cmndLineParser.print_help()
+            sys.exit(0)
+        argNum = len(args) - 1   #counts the amount of arguments, negating the script name at the start of the command line
+        if argNum != progArgNum: errorExit('%s takes exactly %d argument(s); %d supplied' % (program_name, progArgNum, argNum), 0)
+        try:
+            run(args[-2], args[-1], **vars(options))
+        except readtools.InputValidationError as error:
+            errorExit(error.value)
+###
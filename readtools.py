@@ -1,7 +1,9 @@
 #!/usr/bin/env python
     
 ###Imports and Variable Initalizations###
-import re, copy, os, sys, subprocess, logging
+import re, copy, os, sys, subprocess, logging, itertools, bisect, heapq, multiprocessing, struct, zlib, shutil, mmap, operator, hashlib, threading, time, signal
+from multiprocessing.pool import ThreadPool
+import numpy as np
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio.Alphabet import IUPAC
@@ -26,6 +28,21 @@ cigarAbsentTypes = ('H',) #cigar types that are not present in an alignment or t
 cigarTypes = tuple(cigarInsertTypes.keys()) + cigarAlignedTypes + cigarIgnoredTypes + cigarAbsentTypes
 cigarPresentTypes = tuple(cigarInsertTypes.keys()) + cigarAlignedTypes
 gapPlaceholder = cigarInsertTypes['N']
+cigarOperations = 'MIDNSHP=X' #cigar types in the order of their numeric codes in the BAM format
+cigarPattern = re.compile('([0-9]+)([MIDNSHP=X])')
+
+consensusSymbols = 'ACGTN' + cigarInsertTypes['D'] + cigarInsertTypes['P'] + cigarInsertTypes['N'] + 'acgtn' #the columns of a ColumnCounts matrix
+sequenceSymbols = 'ACGTNacgtn' #symbols that represent a base of a read rather than a spacer
+symbolCodes = np.zeros(256, dtype = np.uint8) #converts a character code to its column in a ColumnCounts matrix; unrecognized characters are counted as 'N' or 'n'
+symbolCodes[:] = consensusSymbols.index('N')
+symbolCodes[ord('a'):ord('z') + 1] = consensusSymbols.index('n')
+for symbolIndex, symbol in enumerate(consensusSymbols): symbolCodes[ord(symbol)] = symbolIndex
+sequenceSymbolCodes = np.array([consensusSymbols.index(symbol) for symbol in sequenceSymbols])
+cigarOperationCodes = np.zeros(256, dtype = np.uint8) #converts a cigar character code to its index in cigarOperations
+for operationIndex, letter in enumerate(cigarOperations): cigarOperationCodes[ord(letter)] = operationIndex
+cigarLetters = np.array(list(cigarOperations)) #the cigar type of each numeric code
+cigarReferenceCodes = np.array([letter in 'MDN=X' for letter in cigarOperations]) #cigar types that consume positions of the reference
+cigarQueryCodes = np.array([letter in 'MIS=X' for letter in cigarOperations]) #cigar types that consume bases of the read
 
 
 ### Logging
@@ -45,6 +62,36 @@ def iterateGenerators(generators):
     for index in closedGenerators: del generators[index] #removes read interator objects that have ended
     else: return zip(*output)
 
+def sweepAlignments(alignments, start, end):
+    '''Version 1.0
+    Sweeps the pileup positions from start to end (inclusive) over a list of PileupAlignments sorted by alignedStart. Reads become
+    active when the sweep reaches their start and are kept in a heap keyed by their end, so they are dropped when it passes their end.
+    Yields column batches, one for each run of positions over which the active reads do not change:
+        (batchStart, batchEnd, alignments, indexLists)
+    where alignments are the active reads, in the order given, and indexLists holds the slice of each read's aligned indexes
+    (unaligned_sequence_index, cigar_letter) for the positions of the batch. Batches without reads have empty lists.'''
+    starts = [alignment.alignedStart() for alignment in alignments]
+    heap, active, activeIndexs, nextIndex, position = [], [], {}, 0, start
+    while position <= end:
+        while nextIndex < len(alignments) and starts[nextIndex] <= position:
+            alignedEnd = alignments[nextIndex].alignedEnd()
+            if alignedEnd >= position:
+                heapq.heappush(heap, (alignedEnd, nextIndex))
+                active.append(nextIndex)
+                activeIndexs[nextIndex] = alignments[nextIndex].alignedIndexs
+            nextIndex += 1
+        while len(heap) > 0 and heap[0][0] < position:
+            index = heapq.heappop(heap)[1]
+            del active[bisect.bisect_left(active, index)]
+            del activeIndexs[index]
+        batchEnd = end
+        if nextIndex < len(alignments): batchEnd = min(batchEnd, starts[nextIndex] - 1)
+        if len(heap) > 0: batchEnd = min(batchEnd, heap[0][0])
+        batchAlignments = [alignments[index] for index in active]
+        indexLists = [activeIndexs[index][position - starts[index] : batchEnd - starts[index] + 1] for index in active]
+        yield (position, batchEnd, batchAlignments, indexLists)
+        position = batchEnd + 1
+
 def withinRange(number, aRange):
     if aRange[0] != None and number < aRange[0]: return False
     if aRange[1] != None and number > aRange[1]: return False
@@ -55,18 +102,84 @@ def withinRanges(value, ranges):
         if withinRange(value, aRange): return True
     return False
 
-def getVariantFrequency(sequences):
+def rangesMask(values, ranges):
+    '''Version 1.0
+    Array version of withinRanges: returns a boolean array that is True where a value is within any of the ranges.'''
+    values = np.asarray(values)
+    mask = np.zeros(values.shape, dtype = bool)
+    for aRange in ranges:
+        inRange = np.ones(values.shape, dtype = bool)
+        if aRange[0] != None: inRange &= values >= aRange[0]
+        if aRange[1] != None: inRange &= values <= aRange[1]
+        mask |= inRange
+    return mask
+
+def cigarArrays(cigars):
     '''Version 1.0
+    Parses a list of cigar strings into numpy arrays of operation codes (indexes of cigarOperations) and operation lengths.
+    Also returns the number of operations in each cigar string.'''
+    operations, lengths, operationCounts = [], [], []
+    for cigar in cigars:
+        pairs = cigarPattern.findall(cigar)
+        operationCounts.append(len(pairs))
+        for length, letter in pairs:
+            lengths.append(length)
+            operations.append(letter)
+    operations = np.frombuffer(''.join(operations), dtype = np.uint8)
+    operations = cigarOperationCodes[operations]
+    lengths = np.array(lengths, dtype = np.int64)
+    return operations, lengths, np.array(operationCounts, dtype = np.int64)
+
+def expandRuns(starts, lengths):
+    '''Version 1.0
+    Returns every integer of every run described by a start and a length, concatenated in order. Equivalent to, but much faster than:
+    [start + offset for start, length in zip(starts, lengths) for offset in range(length)]'''
+    lengths = np.asarray(lengths, dtype = np.int64)
+    runOffsets = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum(), dtype = np.int64) + np.repeat(np.asarray(starts, dtype = np.int64) - runOffsets, lengths)
+
+def parseSamTags(text):
+    '''Version 1.0
+    Parses the tab-delimited optional fields of a SAM line (or the binary fields of a BAM record, see BamTagData) into a dictionary.'''
+    if isinstance(text, BamTagData): text = bamTagsToSam(text)
+    optionalTypeParsingFuncs = {'A':str, 'i':int, 'f':float, 'Z':str, 'H':str, 'B': str}
+    output = {}
+    for option in text.split('\t'):
+        tag, optionType, value = option.split(':', 2)
+        output[tag] = optionalTypeParsingFuncs[optionType](value)
+    return output
+
+def placeCigarOperations(starts, operations, lengths, operationCounts):
+    '''Version 1.0
+    Places the cigar operations of many reads on the reference at once. Takes the reference start of each read, the operation codes and
+    lengths of every read concatenated and the number of operations of each read. Returns, for each operation, the index of its read,
+    the index of the first operation of its read, the reference position it starts at, whether it is an insertion (I or P) and its
+    offset within the insertion columns it belongs to; also returns the last reference position of each read. Each insertion follows
+    the last reference position consumed before it. Insertions that precede the first reference position of a read are treated as
+    unaligned sequence.'''
+    readIndexes = np.repeat(np.arange(len(starts)), operationCounts)
+    firstOperations = (np.cumsum(operationCounts) - operationCounts)[readIndexes]
+    isReference = cigarReferenceCodes[operations]
+    referenceSteps = np.where(isReference, lengths, 0)
+    referenceBefore = np.cumsum(referenceSteps) - referenceSteps
+    referenceBefore = referenceBefore - referenceBefore[firstOperations]
+    operationStarts = starts[readIndexes] + referenceBefore
+    ends = starts + np.bincount(readIndexes, weights = referenceSteps, minlength = len(starts)).astype(np.int64) - 1
+    isInsertion = ((operations == cigarOperations.index('I')) | (operations == cigarOperations.index('P'))) & (referenceBefore > 0)
+    insertionSteps = np.where(isInsertion, lengths, 0)
+    insertionsBefore = np.cumsum(insertionSteps) - insertionSteps
+    isRunStart = isReference | (np.arange(len(operations)) == firstOperations)
+    slots = insertionsBefore - np.maximum.accumulate(np.where(isRunStart, insertionsBefore, 0))
+    return readIndexes, firstOperations, operationStarts, ends, isInsertion, slots
+
+def getVariantFrequency(sequences):
+    '''Version 1.1
     Takes a list of strings and counts the number of repetative strings. Returns a list of tuples in the format [(count, variant), ...]
     and sorts them based on frequency.'''
-    encounteredSequences, sequenceCount = [], []
+    sequenceCount = {}
     for sequence in sequences:
-        if sequence in encounteredSequences:
-            sequenceCount[encounteredSequences.index(sequence)] += 1 #if sequence has already been found
-        else:
-            encounteredSequences.append(sequence)
-            sequenceCount.append(1)
-    output = zip(sequenceCount, encounteredSequences)
+        sequenceCount[sequence] = sequenceCount.get(sequence, 0) + 1
+    output = [(count, sequence) for sequence, count in sequenceCount.iteritems()]
     output.sort()
     output.reverse()
     return output
@@ -79,12 +192,6 @@ def getMajority(bases):
         return baseFrequencies[0][1]
 
 def getIUPAC(baseValues, deletionCharacter = '*', paddingCharacter = '_', skippedCharacter = '~'):
-    def removeRepeats(aList):
-        for entry in aList:
-            if aList.count(entry) > 1:
-                aList.remove(entry)
-                return removeRepeats(aList)
-        return aList
     def IUPAC(bases):
         conversion = {'CT':'Y','AG':'R','AT':'W','CG':'S','GT':'K','AC':'M','AGT':'D','ACG':'V','ACT':'H','CGT':'B','ACGT':'N'}
         bases.sort()  #['A', 'C', 'G', 'T']
@@ -93,7 +200,7 @@ def getIUPAC(baseValues, deletionCharacter = '*', paddingCharacter = '_', skippe
             return str.lower(conversion[''.join(bases)])
         else:
             return conversion[''.join(bases)]
-    chars = removeRepeats(list(baseValues))
+    chars = list(set(baseValues))
     chars.sort()  #['-', 'A', 'C', 'G', 'N', 'T', 'a', 'c', 'g', 'n', 't', '~']
     if len(chars) == 0: return gapPlaceholder
     if len(chars) == 1: return chars[0]
@@ -107,29 +214,144 @@ def getIUPAC(baseValues, deletionCharacter = '*', paddingCharacter = '_', skippe
         elif len(matchs) == 1: return matchs[0]
         else: return IUPAC(matchs)
 
+#the IUPAC code of every combination of consensusSymbols, indexed by a bitmask of the symbols present
+iupacTable = np.array([ord(getIUPAC([symbol for bit, symbol in enumerate(consensusSymbols) if mask >> bit & 1],
+                                    deletionCharacter = cigarInsertTypes['D'], paddingCharacter = cigarInsertTypes['P'], skippedCharacter = cigarInsertTypes['N']))
+                       for mask in range(2 ** len(consensusSymbols))], dtype = np.uint8)
+majorityOrder = np.array(sorted(range(len(consensusSymbols)), key = lambda index: consensusSymbols[index], reverse = True)) #ties are won by the greater character, as in getMajority
+
+def callConsensus(counts, IUPAC = True):
+    '''Version 1.0
+    Takes a positions x symbols matrix of counts (see ColumnCounts) and returns the consensus character of every position as a string.
+    Equivalent to calling getIUPAC or getMajority on the bases of each position, but done for all positions at once.'''
+    counts = np.asarray(counts)
+    if len(counts) == 0: return ''
+    if IUPAC:
+        masks = np.dot(counts > 0, 1 << np.arange(len(consensusSymbols)))
+        calls = iupacTable[masks]
+    else:
+        calls = np.frombuffer(consensusSymbols, dtype = np.uint8)[majorityOrder[counts[:, majorityOrder].argmax(axis = 1)]]
+        calls = np.where(counts.any(axis = 1), calls, ord(gapPlaceholder)).astype(np.uint8)
+    return calls.tostring()
+
+spacerCodes = np.zeros(256, dtype = bool) #true for the character codes of the spacers of padded sequences
+for spacer in cigarInsertTypes.values(): spacerCodes[ord(spacer)] = True
+
+def readNucmerDeltaBatches(filePath, batchBytes = 1 << 22):
+    '''Version 1.0
+    Reads a nucmer delta file in batches of about batchBytes, parsing the numbers of each batch at once; only one batch is held in
+    memory. Yields (queryNames, referenceNames, referenceLengths, queryLengths, alignmentStats, deltas, deltaCounts) for the alignments of
+    each batch, where alignmentStats holds the seven numbers of the header line of each alignment and deltas are the deltas of every
+    alignment concatenated, with deltaCounts the number of each alignment.'''
+    isDigit = np.zeros(256, dtype = bool)
+    isDigit[[ord(character) for character in '-0123456789']] = True
+    with open(filePath, 'r') as handle:
+        handle.readline() #the paths of the reference and query files
+        handle.readline() #the program that made the file
+        header, pending = None, ''
+        while True:
+            text = handle.read(batchBytes)
+            if text == '':
+                if pending.strip() == '': break
+                text, pending = pending, ''
+            else:
+                text = pending + text
+                end = text.rfind('\n0\n') #the batch ends with the last complete alignment
+                if end < 0:
+                    pending = text
+                    continue
+                text, pending = text[:end + 3], text[end + 3:]
+            if text[-1] != '\n': text += '\n'
+            ##Find the lines, blank out the sequence name lines and parse every number of the batch at once
+            characters = np.frombuffer(text, dtype = np.uint8)
+            lineEnds = np.nonzero(characters == ord('\n'))[0]
+            lineStarts = np.concatenate(([0], lineEnds[:-1] + 1))
+            isHeader = characters[lineStarts] == ord('>')
+            headerStarts, headerEnds = lineStarts[isHeader], lineEnds[isHeader]
+            headers = [header] + [text[start + 1 : end].split() for start, end in itertools.izip(headerStarts.tolist(), headerEnds.tolist())]
+            header = headers[-1]
+            numericCharacters = characters.copy()
+            numericCharacters[expandRuns(headerStarts, headerEnds - headerStarts)] = ord(' ')
+            values = np.fromstring(numericCharacters.tostring(), dtype = np.int64, sep = ' ')
+            ##Count the numbers of each line: seven on the header line of an alignment and one on each delta line
+            isDigitCharacter = isDigit[numericCharacters]
+            tokenStarts = np.nonzero(isDigitCharacter & ~np.concatenate(([False], isDigitCharacter[:-1])))[0]
+            if len(tokenStarts) != len(values):
+                raise InputValidationError('"%s" is not a nucmer delta file; it has a line that is not a sequence name line or numbers.' % filePath)
+            tokenCounts = np.bincount(np.searchsorted(lineEnds, tokenStarts), minlength = len(lineEnds))
+            isStats, isValue = tokenCounts == 7, tokenCounts == 1
+            if np.any(~isStats & ~isValue & ~isHeader & (tokenCounts > 0)):
+                raise InputValidationError('"%s" is not a nucmer delta file; alignment header lines must have seven numbers.' % filePath)
+            lineOffsets = np.cumsum(tokenCounts) - tokenCounts
+            alignmentStats = values[lineOffsets[isStats][:, np.newaxis] + np.arange(7)]
+            isDelta = isValue & (values[np.minimum(lineOffsets, max(len(values) - 1, 0))] != 0)
+            alignmentIndexes = np.cumsum(isStats) - 1
+            deltaCounts = np.bincount(alignmentIndexes[isDelta], minlength = len(alignmentStats))
+            ##The sequence names of each alignment; alignments before the first name line of the batch belong to the last one of the previous batch
+            if len(alignmentStats) == 0: continue
+            referenceNames, queryNames, referenceLengths, queryLengths = zip(*map(headers.__getitem__, np.cumsum(isHeader)[isStats].tolist()))[:4]
+            yield (list(queryNames), list(referenceNames), np.array(map(int, referenceLengths), dtype = np.int64), np.array(map(int, queryLengths), dtype = np.int64),
+                   alignmentStats, values[lineOffsets[isDelta]], deltaCounts)
+
+def readNucmerDelta(filePath):
+    '''Version 1.0
+    Reads a nucmer delta file one alignment at a time (see readNucmerDeltaBatches). Yields
+    (queryName, referenceName, referenceLength, queryLength, alignmentStats, deltas) for each alignment, where alignmentStats are the
+    seven numbers of its header line and deltas is an integer array.'''
+    for queryNames, referenceNames, referenceLengths, queryLengths, alignmentStats, deltas, deltaCounts in readNucmerDeltaBatches(filePath):
+        deltaEnds = np.cumsum(deltaCounts).tolist()
+        for index, (deltaEnd, deltaCount) in enumerate(zip(deltaEnds, deltaCounts.tolist())):
+            yield (queryNames[index], referenceNames[index], int(referenceLengths[index]), int(queryLengths[index]), alignmentStats[index].tolist(),
+                   deltas[deltaEnd - deltaCount : deltaEnd])
+
 def parseNucmer(filePath):
-    '''Version 1.0'''
-    fileHandle = open(filePath, 'r')
-    fileData = fileHandle.read()
-    fileHandle.close()
-    nucInPaths = fileData[0]
-    #a '>' appears before the name of every contig and each match is sepeated by a '0' on its own line (i.e. '\n0\n')
-    #data is parsed by contig ('>'), match ('\n0\n'), and line '\n'. 
-    contigData = [[cntg.split('\n') for cntg in group.split('\n0\n')[:-1]] for group in fileData[1:].split('>')][1:]
-    if len(contigData) == 0: return None
-    for cIndex in range(0,len(contigData)):
-        if len(contigData[cIndex]) > 1:
-            for gIndex in range(1,len(contigData[cIndex])):
-                cntgHeadParts = contigData[cIndex][0][0].split()
-                #cntgHeadParts[1] += '(%d)' % (gIndex + 1)
-                contigData[cIndex][gIndex].insert(0,' '.join(cntgHeadParts))   #adds contigs information to each sub contig
-    contigData = [cntg for group in contigData for cntg in group]   #makes into one contig list
-    headers = zip(*[cntg[0].split(' ') for cntg in contigData])
-    refHeads, cntgHeads, refLenghts, cntgLengths = (headers[0],list(headers[1]),map(int,headers[2]),map(int,headers[3]))
-    alignStats = [map(int,cntg[1].split()) for cntg in contigData]
-    deltas = [map(int,cntg[2:]) for cntg in contigData]
-    outList = (cntgHeads, refHeads, refLenghts, cntgLengths, alignStats, deltas)
-    return outList
+    '''Version 2.0
+    Returns the fields of every alignment of a nucmer delta file (see readNucmerDelta) as parallel tuples, or None if there are none.'''
+    alignments = [(queryName, referenceName, referenceLength, queryLength, alignmentStats, deltas.tolist())
+                  for queryName, referenceName, referenceLength, queryLength, alignmentStats, deltas in readNucmerDelta(filePath)]
+    if len(alignments) == 0: return None
+    return tuple(map(list, zip(*alignments)))
+
+def deltaCigarArrays(deltas, deltaCounts, queryStarts, queryEnds, queryLengths):
+    '''Version 1.0
+    Converts the deltas of many nucmer alignments at once to cigar operations in the format of cigarArrays. Takes the deltas of every
+    alignment concatenated, the number of deltas of each alignment and the first and last aligned base and length of each query.
+    Each delta is the distance to the next indel: a positive delta is a deletion from the query and a negative one an insertion.
+    Unaligned bases of the query are soft clipped.'''
+    deltas, deltaCounts = np.asarray(deltas, dtype = np.int64), np.asarray(deltaCounts, dtype = np.int64)
+    queryStarts, queryEnds, queryLengths = [np.asarray(values, dtype = np.int64) for values in (queryStarts, queryEnds, queryLengths)]
+    M, I, D, S = [cigarOperations.index(letter) for letter in 'MIDS']
+    alignmentCount = len(deltaCounts)
+    deltaAlignments = np.repeat(np.arange(alignmentCount), deltaCounts)
+    distances = np.abs(deltas)
+    deletionCounts = np.bincount(deltaAlignments[deltas > 0], minlength = alignmentCount)
+    distanceSums = np.bincount(deltaAlignments, weights = distances, minlength = alignmentCount).astype(np.int64)
+    ##Each alignment has the slots: leading clip, match if there are no deltas, (match, indel) per delta, last match, trailing clip
+    slotCounts = 2 * deltaCounts + 4
+    slotStarts = np.cumsum(slotCounts) - slotCounts
+    operations, lengths = np.zeros(slotCounts.sum(), dtype = np.uint8) + M, np.zeros(slotCounts.sum(), dtype = np.int64)
+    operations[slotStarts], lengths[slotStarts] = S, np.where(queryStarts != 1, queryStarts - 1, 0)
+    lengths[slotStarts + 1] = np.where(deltaCounts == 0, queryEnds - queryStarts + 1, 0)
+    deltaSlots = slotStarts[deltaAlignments] + 2 + 2 * (np.arange(len(deltas)) - (np.cumsum(deltaCounts) - deltaCounts)[deltaAlignments])
+    lengths[deltaSlots] = distances - 1
+    operations[deltaSlots + 1], lengths[deltaSlots + 1] = np.where(deltas < 0, I, D), 1
+    lengths[slotStarts + slotCounts - 2] = np.where(deltaCounts > 0, queryEnds + deletionCounts - queryStarts - distanceSums, 0)
+    operations[slotStarts + slotCounts - 1], lengths[slotStarts + slotCounts - 1] = S, np.maximum(queryLengths - queryEnds, 0)
+    ##Drop empty operations and merge adjacent operations of the same type (e.g. runs of single base indels)
+    slotAlignments = np.repeat(np.arange(alignmentCount), slotCounts)
+    present = lengths > 0
+    operations, lengths, slotAlignments = operations[present], lengths[present], slotAlignments[present]
+    if len(operations) == 0: return operations, lengths, np.zeros(alignmentCount, dtype = np.int64)
+    isRunStart = np.ones(len(operations), dtype = bool)
+    isRunStart[1:] = (operations[1:] != operations[:-1]) | (slotAlignments[1:] != slotAlignments[:-1])
+    runStarts = np.nonzero(isRunStart)[0]
+    return operations[runStarts], np.add.reduceat(lengths, runStarts), np.bincount(slotAlignments[runStarts], minlength = alignmentCount)
+
+def cigarStrings(operations, lengths, operationCounts):
+    '''Converts cigar operation codes and lengths (see cigarArrays) to the cigar string of each read; reads without operations get None.'''
+    pairs = map(operator.add, map(str, lengths.tolist()), cigarLetters[operations].tolist())
+    ends = np.cumsum(operationCounts).tolist()
+    return [''.join(pairs[end - count : end]) if count > 0 else None for end, count in zip(ends, np.asarray(operationCounts).tolist())]
 
 def interpretFastaAlignment(query, reference, deletionCharacter = '*', paddingCharacter = '_', skippedCharacter = '~', lowerCaseIsUnaligned = True):
     query.padding = 0
@@ -185,22 +407,50 @@ def interpretFastaAlignment(query, reference, deletionCharacter = '*', paddingCh
     return query
 
 ###Sequence Object Classes###
+class LazyAttribute(object):
+    '''Version 1.0
+    Decorator for a method that computes an attribute the first time it is used. The result is stored in the instance, so later uses
+    are ordinary attribute lookups; deleting it from the instance makes it be computed again.'''
+    def __init__(self, function):
+        self.function = function
+        self.__doc__ = function.__doc__
+    def __get__(self, instance, owner):
+        if instance is None: return self
+        value = self.function(instance)
+        instance.__dict__[self.function.__name__] = value
+        return value
+
 class AttributeFilter(object):
-    '''Version 1.0'''
-    def __init__(self, function, acceptableRanges):
+    '''Version 1.1
+    Passes a value if function(value) is within any of the acceptable ranges. When used as a position or masking filter on a ColumnCounts
+    matrix, columnFunction, if given, is called on the whole matrix instead of function being called on each column; it must return the
+    value of function for every column as an array.'''
+    def __init__(self, function, acceptableRanges, columnFunction = None):
         self.function = function
         self.acceptableRanges = acceptableRanges
+        self.columnFunction = columnFunction
     def __call__(self, *arguments):
         value = self.function(*arguments)
         return withinRanges(value, self.acceptableRanges)
+    def columnMask(self, counts):
+        '''Returns a boolean array that is True for each column (row of counts) that passes.'''
+        if self.columnFunction is None: return np.array([self(columnCounts) for columnCounts in counts], dtype = bool)
+        return rangesMask(self.columnFunction(counts), self.acceptableRanges)
 
 class CustomizedFunction(object):
-    '''Version 1.0'''
-    def __init__(self, function, **kwargs):
+    '''Version 1.1
+    Calls function with the keyword arguments given. When used as a base filter on a ColumnCounts matrix, columnFunction, if given,
+    is called on the whole matrix, with the same keyword arguments, instead of function being called on each column.'''
+    def __init__(self, function, columnFunction = None, **kwargs):
         self.function = function
+        self.columnFunction = columnFunction
         self.kwargs = kwargs
     def __call__(self, *arguments):
         return self.function(*arguments, **self.kwargs)
+    def filterCounts(self, counts):
+        '''Returns the filtered counts of every column (row of counts).'''
+        if self.columnFunction is None: return np.array([self(columnCounts) for columnCounts in counts]).reshape(counts.shape)
+        return self.columnFunction(counts, **self.kwargs)
 
     
 class Alignment(SeqRecord):
@@ -239,9 +489,39 @@ class Alignment(SeqRecord):
         '''Alternate constructor function that makes an instance of alignment using the information from a seq Record object. '''
         instance = Alignment(record.seq, **kwargs)
         for key, value in record.__dict__.iteritems(): instance.__dict__[key] = value #Overrides keyword arguments that are the same as record data.
+        instance.annotations = record.annotations
         if instance.cigar == None:
             instance.cigar = str(len(instance.seq)) + 'M'
         return instance
+    @classmethod
+    def fromSamRecord(cls, samRecord):
+        '''Alternate constructor function that makes an instance of alignment from a SamRecord. The optional fields and base qualities
+        of the record are only decoded when the annotations or letter_annotations of the alignment are first used. Base qualities
+        are kept as a numpy array of unsigned bytes rather than a list of integers.'''
+        instance = cls.__new__(cls)
+        SeqRecord.__init__(instance, Seq(samRecord.sequence), id = samRecord.id)
+        instance.start, instance.reference, instance.cigar = samRecord.start, samRecord.reference, samRecord.cigar
+        instance.mate, instance.mateStart, instance.flag, instance.quality = samRecord.mate, samRecord.mateStart, samRecord.flag, samRecord.quality
+        instance.templateLength = samRecord.templateLength
+        instance.sortAttr = 'start'
+        instance.samRecord = samRecord
+        instance._annotations, instance._undecodedQualities = None, True
+        return instance
+    def _getAnnotations(self):
+        if self._annotations is None:
+            self._annotations = self.samRecord.tags()
+        return self._annotations
+    def _setAnnotations(self, annotations):
+        self._annotations = annotations
+    annotations = property(_getAnnotations, _setAnnotations)
+    def _getLetterAnnotations(self):
+        if self.__dict__.get('_undecodedQualities', False):
+            self._undecodedQualities = False
+            qualities = self.samRecord.phredQualities()
+            if qualities is not None:
+                self._per_letter_annotations['phred_quality'] = qualities
+        return self._per_letter_annotations
+    letter_annotations = property(_getLetterAnnotations, SeqRecord.letter_annotations.fset)
     def _compare(self, other, func):
         try:
             attributeA = getattr(self, self.sortAttr)
@@ -352,10 +632,17 @@ class Alignment(SeqRecord):
             return ''
 
 class PileupAlignment(Alignment):
-    '''Version 2.1'''
+    '''Version 2.2
+    The aligned indexes are made from the cigar string when they are first used. If the alignment belongs to a padded pileup,
+    insertionColumns is the table of the pileup and the aligned indexes include the padding it describes.'''
+    insertionColumns = None
     def alignedStart(self):
         return self.start + self.padding
     def alignedEnd(self):
+        if 'alignedIndexs' not in self.__dict__: #avoids making the aligned indexes just to find their length
+            if self.insertionColumns is not None:
+                return self.alignedStart() + self.insertionColumns.paddedLength(self.start, self.cigar) - 1
+            return self.alignedStart() + sum([length for length, letter in self.cigarIter() if letter in cigarPresentTypes]) - 1
         return self.alignedStart() + len(self.alignedIndexs) - 1
     def relToAbsIndex(self, index):
         return index - self.alignedStart()
@@ -385,9 +672,13 @@ class PileupAlignment(Alignment):
     def selfIndexIter(self, start = None, end = None):
         for index, cigarType in PileupAlignment.indexIter(self, start, end):
             yield (self, index, cigarType)
+    @LazyAttribute
+    def alignedIndexs(self):
+        if self.insertionColumns is None:
+            return list(Alignment.indexIter(self))
+        return self.insertionColumns.alignedIndexs(self.start, self.cigar)
     def refreshAlignment(self):
-        self.alignedIndexs = list(Alignment.indexIter(self))
-        #self.insertionIndexes = [index for index, letter in self.alignedIndexs if letter == 'I']
+        self.__dict__.pop('alignedIndexs', None)
     def __initialize__(self, **kwargs):
         varDefaults = {'padding' : 0}
         for name, value in varDefaults.iteritems(): #For every new variable to be added to this instance..
@@ -418,7 +709,7 @@ class PileupAlignment(Alignment):
         if index is None:
             return 0
         else:
-            return self._per_letter_annotations[attributeName][index]
+            return self.letter_annotations[attributeName][index]
     def getBase(self, index):
         '''Version 1.1
         Returns the base value at the reference index specified.'''
@@ -432,13 +723,20 @@ class PileupAlignment(Alignment):
         index = self.relToAbsIndex(index)
         return self.alignedIndexs[index][1]
     def alignedSeq(self, start = None, end = None):
-        '''Version 1.1
+        '''Version 1.2
         Returns the aligned portions of the sequence.'''
         if start is None:
             start = 0
         if end is None:
             end  = len(self.alignedIndexs)
-        return [self.__getitem__(index) for index in range(start, end)]
+        sequence = str(self.seq)
+        return [cigarInsertTypes[cigarType] if index is None else sequence[index] for index, cigarType in self.alignedIndexs[start:end]]
+    def paddedSequence(self):
+        '''Version 1.0
+        Returns the aligned sequence as a string, made from the insertion column table if the aligned indexes have not been made.'''
+        if self.insertionColumns is None or 'alignedIndexs' in self.__dict__:
+            return ''.join(self.alignedSeq())
+        return self.insertionColumns.paddedSequence(self.start, self.cigar, str(self.seq))
     def unpaddedAlignedSeq(self):
         return Alignment.alignedSeq(self)
     def identityCount(self, caseSensitive = True, reference = None):
@@ -550,96 +848,71 @@ class Cluster(object):
             yield bases
         
 class Pileup(Cluster):
-    '''Version 1.1'''
+    '''Version 1.2'''
+    _intervalIndex = None
     def start(self):
         return self.alignments[0].alignedStart()
     def end(self):
-        return max([alignment.alignedEnd() for alignment in self.alignments])
+        return self.intervalIndex().end()
     def span(self):
         return self.end() - self.start() + 1
     def __len__(self):
         return self.span()
+    def intervalIndex(self):
+        '''Version 1.1
+        Returns the IntervalIndex of the aligned positions of the alignments. It is made once and remade if the alignment list is
+        replaced, changes length or is padded, or a row of the ReadStore of an alignment view is changed (see ReadStore.rowChanged);
+        other alignments moved by other means require refreshIntervalIndex.'''
+        if self._intervalIndex is None or self._indexedAlignments is not self.alignments or len(self._intervalIndex) != len(self.alignments) or\
+           any([store.changeCount != changeCount for store, changeCount in self._indexedStores]):
+            self._intervalIndex = IntervalIndex.fromAlignments(self.alignments)
+            self._indexedAlignments = self.alignments
+            stores = dict([(id(alignment.store), alignment.store) for alignment in self.alignments if isinstance(alignment, PileupAlignmentView)])
+            self._indexedStores = [(store, store.changeCount) for store in stores.values()]
+        return self._intervalIndex
+    def refreshIntervalIndex(self):
+        self._intervalIndex = None
     def alignmentsInRange(self, start = None, end = None):
-        '''Version 1.2
+        '''Version 1.3
         Return a list of all the alignments that have at least one base in the specified range.'''
         if start is None: start = 0
-        alignmentsInRange = []
-        if end is None:
-            for index in range(0, len(self.alignments)):
-                if self.alignments[index].alignedEnd() < start: continue
-                alignmentsInRange.append(index)
-        else:
-            for index in range(0, len(self.alignments)):
-                if self.alignments[index].alignedEnd() < start: continue
-                if self.alignments[index].alignedStart() > end: break
-                alignmentsInRange.append(index)
-        return alignmentsInRange
+        return self.intervalIndex().overlapping(start, end)
     def alignmentsWithIndex(self, pos):
-        '''Version 1.0
+        '''Version 1.1
         Return a list of all the alignments that have at least one base at the specified position.'''        
-        return [index for index in range(0, len(self.alignments)) if pos >= self.alignments[index].alignedStart() and pos <= self.alignments[index].alignedEnd()]
+        return self.intervalIndex().overlapping(pos, pos)
+    def columnBatches(self, start = None, end = None):
+        '''Version 1.0
+        Returns the reads of the pileup positions between start and end (inclusive) in batches of positions covered by the same reads (see sweepAlignments).'''
+        if start is None: start = self.start()
+        if end is None: end = self.end()
+        return sweepAlignments([self.alignments[index] for index in self.alignmentsInRange(start, end)], start, end)
     def indexIter(self, pileupStart = None, pileupEnd = None):
-        '''Verison 2.0'''
-        def getYield(generators):
-            output = iterateGenerators(generators)
-            if output == []: output = ((), (), ())
-            return output            
-        if pileupStart is None: pileupStart = self.start()
-        if pileupEnd is None: pileupEnd = self.end()
-        position = pileupStart
-        alignmentIndexes = self.alignmentsInRange(pileupStart, pileupEnd)
-        firstAlignmentIndexes = self.alignmentsWithIndex(pileupStart) #finds the set of alignments that have a base at the start position to initialize the iteration
-        inbetweenIndexes = [index for index in alignmentIndexes if index not in firstAlignmentIndexes]
-        generators = [self.alignments[index].selfIndexIter(start = pileupStart, end = pileupEnd) for index in firstAlignmentIndexes]
-        if len(inbetweenIndexes) > 0:
-            ##iterate from the start point to the start of the first Alignment that dosent have a base at the start position
-            firstDelta = self.alignments[inbetweenIndexes[0]].alignedStart() - pileupStart
-            for count in range(0, firstDelta): yield getYield(generators)
-            position += firstDelta
-            ##iterate through the sections between adjacent reads
-            for currentIndex, nextIndex in zip(inbetweenIndexes[:-1], inbetweenIndexes[1:]): 
-                delta = self.alignments[nextIndex].alignedStart() - self.alignments[currentIndex].alignedStart()
-                generators.append(self.alignments[currentIndex].selfIndexIter(end = pileupEnd))
-                for count in range(0, delta): yield getYield(generators) #for every base until the start of the next alignment
-                position += delta
-            generators.append(self.alignments[inbetweenIndexes[-1]].selfIndexIter(end = pileupEnd)) 
-        ##iterate from the start of the last read to the end point
-        if pileupEnd is None:
-            output = getYield(generators)
-            while output != ((), (), ()):
-                yield output
-                output = getYield(generators)
-        else:
-            lastDelta = pileupEnd - position + 1
-            for count in range(0, lastDelta): yield getYield(generators)
+        '''Verison 3.0
+        Yields the alignments with a base at each position, with the unaligned sequence index and cigar letter of that base in each.
+        Output: [(alignments...), (unaligned_sequence_indexes...), (cigar_letters...)]'''
+        for batchStart, batchEnd, alignments, indexLists in self.columnBatches(pileupStart, pileupEnd):
+            if len(alignments) == 0:
+                for position in range(batchStart, batchEnd + 1): yield ((), (), ())
+            else:
+                alignments = tuple(alignments)
+                for column in zip(*indexLists): yield [alignments] + zip(*column)
     def padAlignments(self, removeExtraPadding = True):
-        '''Version 1.1'''
-        position = self.start()
-        paddingToBeRemoved = []
-        for alignments, relBaseIndexes, cigarTypes in Cluster.indexIter(self, saveRefPadding = True):
-            if 'I' in cigarTypes:
-                for alignment, cigarType in zip(alignments, cigarTypes):
-                    insertIndex = alignment.relToAbsIndex(position)
-                    if cigarType not in cigarExtraTypes:
-                        alignment.alignedIndexs.insert(insertIndex, (None, 'P'))
-            elif removeExtraPadding:
-                for alignment, cigarType in zip(alignments, cigarTypes):
-                    if cigarType == 'P':
-                        paddingToBeRemoved.append([alignment, alignment.relToAbsIndex(position)]) 
-            position += 1
-        ##remove extra padding
-        if removeExtraPadding:
-            for alignment, index in reversed(paddingToBeRemoved):
-                del alignment.alignedIndexs[index]
-        ##replace padding in the sequence, at the start, with an offset of the start position
-        for alignment in self.alignments: 
-            if alignment.alignedIndexs[0] == (None, 'P'):
-                del alignment.alignedIndexs[0]
-                alignment.padding += 1
+        '''Version 2.0
+        Pads the alignments so that inserted bases line up. The insertion columns are kept in a table shared by the alignments
+        instead of being inserted into each of them; the padded view of an alignment is made from it when used. Columns with
+        no inserted bases are never added, so removeExtraPadding is only kept for compatibility.'''
+        self.insertionColumns = InsertionColumns.fromAlignments(self.alignments)
+        for alignment in self.alignments:
+            alignment.insertionColumns = self.insertionColumns
+            alignment.padding = self.insertionColumns.paddedPosition(alignment.start) - alignment.start
+            alignment.refreshAlignment()
+        self.refreshIntervalIndex()
     def getCigarAtPos(self, index, alignments):
         return [alignment.getCigarAtPos(index) for alignment in alignments]
     def padPosition(self, position):
         for alignment in self.alignments: alignment.alignedIndexs.insert(position, (None, 'P'))
+        self.refreshIntervalIndex()
     def addAlignment(self, newAlignment, align = False, padAlignment = False):
         '''Version 1.0
         Adds an alignment to the pileup in the correct position.
@@ -662,162 +935,1872 @@ class Pileup(Cluster):
                     return
     def __init__(self, alignments = None, name = None, padAlignments = True, startOffset = 0):
         self.name = name
+        self.insertionColumns = None
         if alignments is None: self.alignments = []
         else: self.alignments = alignments
         for alignment in alignments:
-            alignment.start += startOffset
+            if startOffset != 0: alignment.start += startOffset #changing a start clears the column cache of a ReadStore
             alignment.sortAttr = 'alignedStart'
         self.alignments.sort()
         if padAlignments: self.padAlignments()
     @classmethod
+    def nucmerAlignments(cls, nucmerOutputPath, alignments):
+        '''Version 2.0
+        Places alignments (e.g. contigs) by the nucmer alignments of a delta file. Each nucmer alignment becomes a PileupAlignmentView
+        of a ReadStore row with its own reference, start and cigar string, sharing the sequence and qualities of its query with every
+        other alignment of the same query (see ReadStore.placedCopies); the alignments given are not changed. Their sequences are copied
+        into a ReadStore once, unless they are already views of one. Returns the placed alignments in the order of the file, or None if
+        the file has no alignments. The cigar strings of each batch of the file (see readNucmerDeltaBatches) are made together.'''
+        storeRows = PileupAlignmentView.storeRows(alignments)
+        if storeRows is None: store, rows = ReadStore.fromAlignments(alignments), np.arange(len(alignments))
+        else: store, rows = storeRows
+        rowsById = dict(zip([alignment.id for alignment in alignments], rows.tolist()))
+        ##Apply Nucmer alignment information to the rows of the queries
+        placements, found = [], False
+        for queryNames, referenceNames, referenceLengths, queryLengths, alignmentStats, deltas, deltaCounts in readNucmerDeltaBatches(nucmerOutputPath):
+            found = True
+            hits = [index for index, queryName in enumerate(queryNames) if queryName in rowsById]
+            if len(hits) == 0: continue
+            operations, lengths, operationCounts = deltaCigarArrays(deltas, deltaCounts, alignmentStats[:, 2], alignmentStats[:, 3], queryLengths)
+            operationIndexes = expandRuns((np.cumsum(operationCounts) - operationCounts)[hits], operationCounts[hits])
+            placements.append(([rowsById[queryNames[hit]] for hit in hits], [referenceNames[hit] for hit in hits], alignmentStats[hits, 0],
+                               operations[operationIndexes], lengths[operationIndexes], operationCounts[hits]))
+        if not found: return None
+        if len(placements) == 0: return []
+        hitRows, references, starts, operations, lengths, operationCounts = zip(*placements)
+        placedStore = store.placedCopies(sum(hitRows, []), sum(references, []), np.concatenate(starts), np.concatenate(operations),
+                                         np.concatenate(lengths), np.concatenate(operationCounts))
+        return placedStore.alignments()
+    @classmethod
     def fromNucmer(cls, nucmerOutputPath, **kwargs):
-        def deltaToCigar(deltas, start, end, length):
-            '''Version 1.0
-            Converts a delta series (what NUCMER outputs) to a cigar sequence (SAM format)'''
-            if start != 1:
-                cigar = [[start - 1, 'S']]
-            else:
-                cigar = []
-            if len(deltas) == 0:
-                cigar.append([end - start + 1, 'M'])
-            currentAlignedLength = start
-            deletionCount, insertionCount = 0, 0
-            for delta in deltas: 
-                if delta < 0:
-                    indelType = 'I'
-                    insertionCount += 1
-                else:
-                    indelType = 'D'
-                    deletionCount += 1
-                if abs(delta) == 1 and cigar[-1][1] == indelType:
-                    cigar[-1][0] += 1
-                else:
-                    cigar += [[abs(delta) - 1, 'M'], [1, indelType]]
-                currentAlignedLength += abs(delta)
-            if len(deltas) > 0:
-                alignedEndLength = end + deletionCount - currentAlignedLength
-                cigar.append([alignedEndLength, 'M'])
-            unalignedEndLength = length - end
-            if unalignedEndLength > 0:
-                cigar.append([unalignedEndLength, 'S'])
-            return ''.join(['%d%s' % (part[0], part[1]) for part in cigar])
-        ##Apply Nucmer alignment information to alignments
+        '''Version 1.1
+        Makes one Pileup of alignments placed by a nucmer delta file (see nucmerAlignments), whatever sequence they are aligned to.'''
         try:
             alignments = kwargs['alignments']
         except KeyError:
             raise TypeError('Pileup.fromNucmer requires the keyword argument "alignments."') 
-        for alignment in alignments: alignment.cigar = None
-        alignmentsDict = dict([[alignment.id, [alignment]] for alignment in alignments])
-        nucmerOutput = parseNucmer(nucmerOutputPath)
-        if nucmerOutput is None: return None
-        for queryName, referenceName, referenceLength, queryLength, alignmentStats, deltas in zip(*nucmerOutput):
-            referenceStart, referenceEnd, queryStart, queryEnd = alignmentStats[:4]
-            cigar = deltaToCigar(deltas, queryStart, queryEnd, queryLength)
-            #print queryName, deltas, queryStart, queryEnd, queryLength, cigar
-            if queryName in alignmentsDict:
-                if alignmentsDict[queryName][0].cigar is not None: #if this is not the first instance of an alignment with this query
-                    alignmentsDict[queryName].append(copy.deepcopy(alignmentsDict[queryName][0]))
-                alignmentsDict[queryName][-1].cigar = cigar
-                alignmentsDict[queryName][-1].start = referenceStart
-                alignmentsDict[queryName][-1].refreshAlignment()
-        kwargs['alignments'] = [alignment for alignments in alignmentsDict.values() for alignment in alignments if alignment.cigar is not None]   #combines alignments into one list
+        kwargs['alignments'] = cls.nucmerAlignments(nucmerOutputPath, alignments)
+        if kwargs['alignments'] is None: return None
         ##make new Pileup instance
         instance = Pileup(**kwargs)
         return instance
-    def makeConsensus(self, baseFilters = None, positionFilters = None, maskingFilters = None, maskingChar = 'N', IUPAC = True):
-        '''Version 1.0'''
-        consensus = []
+    @classmethod
+    def fromNucmerByReference(cls, nucmerOutputPath, alignments, **kwargs):
+        '''Version 1.0
+        Returns a Pileup of the alignments placed on each reference sequence by a nucmer delta file (see nucmerAlignments), named
+        after the sequence, in the order the sequences first appear in the file.'''
+        placedAlignments = cls.nucmerAlignments(nucmerOutputPath, alignments)
+        if placedAlignments is None: return []
+        names = []
+        for alignment in placedAlignments:
+            if alignment.reference not in names: names.append(alignment.reference)
+        return [Pileup(alignments = [alignment for alignment in placedAlignments if alignment.reference == name], name = name, **kwargs) for name in names]
+    def columnCounts(self, start = None, end = None, minimumQuality = None, qualityWeighted = False):
+        '''Version 1.2
+        Returns a ColumnCounts matrix of the symbols in each column of the pileup between the positions specified (inclusive).
+        Bases with a quality below minimumQuality are not counted; see ColumnCounts.fromArrays for qualityWeighted.'''
+        counts = ColumnCounts.fromAlignments(self.alignments, self.insertionColumns, minimumQuality, qualityWeighted)
+        return counts.region(start, end)
+    def baseIter(self, start = None, end = None):
+        '''Version 2.0
+        Returns a list of bases for each position searched. Bases are grouped by symbol rather than listed in alignment order.'''
+        for bases in self.columnCounts(start, end).baseIter(): yield bases
+    def paddedRegion(self, start, end):
+        '''Version 1.0
+        Returns the first and last pileup positions of the columns of the reference positions specified, including the insertion
+        columns that follow the last one.'''
+        if self.insertionColumns is None: return (start, end)
+        return (self.insertionColumns.paddedPosition(start), self.insertionColumns.paddedPosition(end + 1) - 1)
+    windowsPerWorker = 4
+    def makeConsensus(self, baseFilters = None, positionFilters = None, maskingFilters = None, maskingChar = 'N', IUPAC = True, start = None, end = None, workers = 1,
+                      minimumQuality = None, qualityWeighted = False):
+        '''Version 1.5
+        Filters are called on the symbol counts of each column (a row of a ColumnCounts matrix). Base filters return the filtered counts and
+        position and masking filters return True if the position passes. The consensus of part of the pileup can be made by giving
+        the pileup positions it starts and ends at (Default: the whole pileup). If more than one worker is given, the consensus of
+        the whole pileup is made in windows by that many processes (see parallelConsensus).
+        Bases with a phred quality below minimumQuality are left out of the columns before any filter is applied. If qualityWeighted is True,
+        majority calls are made on the summed qualities of each symbol instead of their counts (see ColumnCounts.fromArrays).'''
+        consensusArguments = (baseFilters, positionFilters, maskingFilters, maskingChar, IUPAC)
+        qualityArguments = (minimumQuality, qualityWeighted)
+        if workers > 1 and start is None and end is None and PileupAlignmentView.storeRows(self.alignments) is not None:
+            return PileupAlignment(Seq(self.parallelConsensus(workers, consensusArguments, qualityArguments)), start = self.start(), id=self.name)
+        if start is None: start = self.start()
+        consensus = self.columnCounts(start, end, *qualityArguments).consensus(*consensusArguments)
+        return PileupAlignment(Seq(consensus), start = start, id=self.name)
+    def makeConsensusVariants(self, filterSets, maskingChar = 'N', IUPAC = True, start = None, end = None):
+        '''Version 1.0
+        Returns the consensus of the pileup made with each of a list of filter sets (see makeConsensus), in the same order. Each filter set
+        is a dictionary of any of the arguments baseFilters, positionFilters, maskingFilters, minimumQuality and qualityWeighted. The
+        column counts are made once for each pair of quality arguments and shared by every filter set using it.'''
+        if start is None: start = self.start()
+        columnCounts, variants = {}, []
+        for filterSet in filterSets:
+            qualityArguments = (filterSet.get('minimumQuality'), filterSet.get('qualityWeighted', False))
+            if qualityArguments not in columnCounts: columnCounts[qualityArguments] = self.columnCounts(start, end, *qualityArguments)
+            consensus = columnCounts[qualityArguments].consensus(filterSet.get('baseFilters'), filterSet.get('positionFilters'), filterSet.get('maskingFilters'), maskingChar, IUPAC)
+            variants.append(PileupAlignment(Seq(consensus), start = start, id=self.name))
+        return variants
+    def parallelConsensus(self, workers, consensusArguments, qualityArguments = (None, False)):
+        '''Version 1.1
+        Returns the consensus of a pileup of ReadStore views, made in windows of the reference by a pool of worker processes. The windows
+        start at read starts chosen so that each has about the same number of reads. Each window is counted with the insertion columns
+        of the whole pileup, so its columns are in the same padded coordinates as the serial consensus, and is limited to the columns of
+        its own reference positions (including the insertion columns after its last one); reads crossing a boundary are counted in each
+        window they overlap. The reads are given to the workers in shared memory (see ReadStore.toShared).'''
+        store, rows = PileupAlignmentView.storeRows(self.alignments)
+        rows = rows[store.cigarCounts[rows] > 0]
+        insertionColumns = self.insertionColumns
+        if insertionColumns is None: insertionColumns = store.insertionColumns(rows)
+        starts = np.sort(store.starts[rows])
+        windowCount = min(workers * self.windowsPerWorker, len(starts))
+        boundaries = np.unique(starts[(len(starts) * np.arange(windowCount)) // windowCount]).tolist()
+        windows = []
+        for index, referenceStart in enumerate(boundaries):
+            if index + 1 < len(boundaries):
+                referenceEnd = boundaries[index + 1] - 1
+                windows.append((referenceStart, referenceEnd, insertionColumns.paddedPosition(referenceStart), insertionColumns.paddedPosition(referenceEnd + 1) - 1))
+            else:
+                windows.append((referenceStart, None, insertionColumns.paddedPosition(referenceStart), None))
+        sharedArrays = store.sharedArrays
+        if qualityArguments != (None, False): sharedArrays += ('qualities',)
+        pool = multiprocessing.Pool(workers, _initializeConsensusWorker, (store.toShared(sharedArrays), rows, insertionColumns, consensusArguments, qualityArguments))
+        try:
+            sequences = pool.map(_windowConsensus, windows, chunksize = 1)
+        finally:
+            pool.terminate()
+        return ''.join(sequences)
+    def realign(self, sequence, start, name, alignments = None):
+        '''Version 1.0
+        Returns the alignments of the pileup (Default: all of them) aligned to a sequence laid out in the columns of the pileup, such as
+        its consensus (see makeConsensus) or a reference padded with it, that starts at the pileup position specified and is named name.
+        The columns where that sequence has a spacer are not part of the new reference, so bases in them become insertions. The new
+        alignments are views of a new ReadStore (see ReadStore.realigned).'''
+        if alignments is None: alignments = self.alignments
+        storeRows = PileupAlignmentView.storeRows(alignments)
+        if storeRows is None: store, rows = ReadStore.fromAlignments(alignments), None
+        else: store, rows = storeRows
+        return store.realigned(rows, self.insertionColumns, sequence, start, name).alignments()
+        
+
+###Pileup Column Classes###
+class ColumnLayout(object):
+    '''Version 1.0
+    The placement of reads described by arrays (see ColumnCounts.fromArrays) in the columns of a padded pileup. Columns are numbered
+    from 0 at the first reference position of the reads, which is the pileup position columnStart. The insertion columns of the reads,
+    and of an InsertionColumns table if one is supplied, are placed after the reference position they follow.'''
+    def __init__(self, starts, operations, lengths, operationCounts, insertionColumns = None):
+        self.operations, self.lengths = operations, lengths
+        self.readIndexes, self.firstOperations, self.operationStarts, self.ends, self.isInsertion, self.slots = placeCigarOperations(starts, operations, lengths, operationCounts)
+        self.referenceStart = referenceStart = starts.min()
+        referenceEnd = max(self.ends.max(), referenceStart)
+        self.size = referenceEnd - referenceStart + 1
+        self.insertionPoints = self.operationStarts[self.isInsertion] - 1 - referenceStart
+        self.widths = np.zeros(self.size, dtype = np.int64)
+        np.maximum.at(self.widths, self.insertionPoints, self.slots[self.isInsertion] + lengths[self.isInsertion])
+        self.columnStart = referenceStart
+        if insertionColumns is not None:
+            inRange = (insertionColumns.positions >= referenceStart) & (insertionColumns.positions <= referenceEnd)
+            np.maximum.at(self.widths, insertionColumns.positions[inRange] - referenceStart, insertionColumns.widths[inRange])
+            self.columnStart = insertionColumns.paddedPosition(referenceStart)
+        self.referenceColumns = np.arange(self.size, dtype = np.int64) + np.cumsum(self.widths) - self.widths #the padded column of each reference position
+        self.columnCount = self.referenceColumns[-1] + self.widths[-1] + 1
+        self.isAligned = (operations == cigarOperations.index('M')) | (operations == cigarOperations.index('=')) | (operations == cigarOperations.index('X'))
+        self.isBaseInsertion = self.isInsertion & (operations == cigarOperations.index('I'))
+        self.insertionOperationColumns = self.referenceColumns[self.insertionPoints] + 1 + self.slots[self.isInsertion] #the first column of each I or P operation
+        self.insertionIsBase = self.isBaseInsertion[self.isInsertion]
+    def bases(self, sequenceOffsets):
+        '''Returns the column, the position in the sequence buffer and the read of every aligned or inserted base, given the offset
+        of each read in the sequence buffer.'''
+        steps = np.where(cigarQueryCodes[self.operations], self.lengths, 0)
+        before = np.cumsum(steps) - steps
+        operationQueryStarts = sequenceOffsets[self.readIndexes] + before - before[self.firstOperations]
+        isAligned, isBaseInsertion, lengths = self.isAligned, self.isBaseInsertion, self.lengths
+        columns = np.concatenate((self.referenceColumns[expandRuns(self.operationStarts[isAligned] - self.referenceStart, lengths[isAligned])],
+                                  expandRuns(self.insertionOperationColumns[self.insertionIsBase], lengths[isBaseInsertion])))
+        queryPositions = np.concatenate((expandRuns(operationQueryStarts[isAligned], lengths[isAligned]),
+                                         expandRuns(operationQueryStarts[isBaseInsertion], lengths[isBaseInsertion])))
+        reads = np.concatenate((np.repeat(self.readIndexes[isAligned], lengths[isAligned]), np.repeat(self.readIndexes[isBaseInsertion], lengths[isBaseInsertion])))
+        return (columns, queryPositions, reads)
+    def spacers(self, letter):
+        '''Returns the column and the read of every reference position skipped by the cigar operation specified (D or N).'''
+        isSpacer = self.operations == cigarOperations.index(letter)
+        return (self.referenceColumns[expandRuns(self.operationStarts[isSpacer] - self.referenceStart, self.lengths[isSpacer])],
+                np.repeat(self.readIndexes[isSpacer], self.lengths[isSpacer]))
+
+class ColumnCounts(object):
+    '''Version 1.0
+    A positions x symbols matrix of the number of times each symbol in consensusSymbols occurs in each column of a padded pileup.
+    The matrix is built from the cigar strings of the alignments in one vectorized pass instead of iterating the pileup one column at a time.
+    Columns are in the same padded coordinates as Pileup.indexIter; insertion columns are placed after the reference position they follow.'''
+    symbols = consensusSymbols
+    def __init__(self, counts, start = 0, weights = None):
+        self.counts = counts
+        self.start = start
+        self.weights = weights #optional matrix of the summed base qualities of each symbol, used for majority calls
+    def __len__(self):
+        return self.counts.shape[0]
+    def end(self):
+        return self.start + len(self) - 1
+    def __getitem__(self, position):
+        '''Returns the symbol counts of the column at the pileup position specified.'''
+        return self.counts[position - self.start]
+    def region(self, start = None, end = None):
+        '''Version 1.0
+        Returns a ColumnCounts matrix of the columns between the pileup positions specified (inclusive). Columns outside of the matrix are empty.'''
+        if start is None: start = self.start
+        if end is None: end = self.end()
+        if start == self.start and end == self.end(): return self
+        overlapStart, overlapEnd = max(start, self.start), min(end, self.end())
+        def regionOf(matrix):
+            if matrix is None: return None
+            region = np.zeros((max(end - start + 1, 0), len(self.symbols)), dtype = matrix.dtype)
+            if overlapStart <= overlapEnd:
+                region[overlapStart - start : overlapEnd - start + 1] = matrix[overlapStart - self.start : overlapEnd - self.start + 1]
+            return region
+        return ColumnCounts(regionOf(self.counts), start, regionOf(self.weights))
+    def consensus(self, baseFilters = None, positionFilters = None, maskingFilters = None, maskingChar = 'N', IUPAC = True):
+        '''Version 1.1
+        Returns the consensus sequence of the columns as a string (see Pileup.makeConsensus). Filters are applied to the whole matrix:
+        base filters through their filterCounts method and masking filters through their columnMask method if they have one
+        (see CustomizedFunction and AttributeFilter), otherwise by calling them on each column. Position filters are accepted but,
+        as their results have never excluded positions from the consensus, they are not evaluated. If the matrix has weights, majority
+        calls are made on the weights of the symbols left by the base filters; filters always see the counts.'''
         if baseFilters == None: baseFilters = []
-        if positionFilters == None: positionFilters = []
         if maskingFilters == None: maskingFilters = []
-        for positionData in self.indexIter():
-            ##Apply base filters; ignores bases in individual alignments that do not pass all filters supplied
-            positionData = zip(*positionData) #changes format from [[alignment, ...], [index, ...], [cigar, ...]] to [[alignment, index, cigar], ...]
-            for baseFilter in baseFilters:
-                positionData = baseFilter(positionData) #remove bases that dont pass filters 
-            ##Apply position filters; excludes postions in the consensus that do not pass all filters supplied
-            positionFilterResults = [positionFilter(positionData) for positionFilter in positionFilters]
-            #if False in positionFilterResults:
-            #    continue #if the position does not pass all filters, then it is not included in the consensus
-            ##Apply masking filters; mask positons in the consensus that do not pass all filters supplied
-            maskingFilterResults = [maskingFilter(positionData) for maskingFilter in maskingFilters]
-            if False in maskingFilterResults:
-                consensus.append(maskingChar)
+        counts = self.counts
+        ##Apply base filters; ignores bases that do not pass all filters supplied
+        for baseFilter in baseFilters:
+            if hasattr(baseFilter, 'filterCounts'): counts = baseFilter.filterCounts(counts)
+            else: counts = np.array([baseFilter(columnCounts) for columnCounts in counts]).reshape(counts.shape)
+        ##Apply masking filters; mask positons in the consensus that do not pass all filters supplied
+        masked = np.zeros(len(counts), dtype = bool)
+        for maskingFilter in maskingFilters:
+            if hasattr(maskingFilter, 'columnMask'): masked |= ~maskingFilter.columnMask(counts)
+            else: masked |= ~np.array([maskingFilter(columnCounts) for columnCounts in counts], dtype = bool)
+        if self.weights is not None and not IUPAC:
+            weights = np.where(counts > 0, self.weights, 0)
+            counts = np.where(weights.any(axis = 1)[:, np.newaxis], weights, counts) #columns of only quality 0 bases are called by count
+        consensus = np.frombuffer(callConsensus(counts, IUPAC = IUPAC), dtype = np.uint8)
+        return np.where(masked, ord(maskingChar), consensus).astype(np.uint8).tostring()
+    @classmethod
+    def empty(cls, length, start = 0):
+        '''Returns a matrix of columns with no symbols.'''
+        return cls(np.zeros((max(length, 0), len(cls.symbols)), dtype = np.int32), start)
+    def depth(self):
+        '''Returns the number of symbols, including spacers, in each column.'''
+        return self.counts.sum(axis = 1)
+    def alignedDepth(self):
+        '''Returns the number of read bases, excluding spacers, in each column.'''
+        return self.counts[:, sequenceSymbolCodes].sum(axis = 1)
+    @staticmethod
+    def columnBases(counts):
+        '''Returns the list of symbols represented by the counts of a single column.'''
+        return list(''.join([symbol * count for symbol, count in zip(consensusSymbols, counts)]))
+    def baseIter(self):
+        '''Returns a list of bases for each column.'''
+        for counts in self.counts: yield self.columnBases(counts)
+    @classmethod
+    def fromAlignments(cls, alignments, insertionColumns = None, minimumQuality = None, weighted = False):
+        '''Version 1.2
+        Counts the symbols of a list of alignments positioned by their start attributes and cigar strings. Base qualities are read from
+        the phred_quality letter annotations of the alignments when a quality threshold or weighting is requested (see fromArrays).'''
+        storeRows = PileupAlignmentView.storeRows(alignments)
+        if storeRows is not None:
+            return storeRows[0].columnCounts(storeRows[1], insertionColumns, minimumQuality, weighted)
+        alignments = [alignment for alignment in alignments if alignment.cigar is not None]
+        if len(alignments) == 0:
+            return cls(np.zeros((0, len(consensusSymbols)), dtype = np.int32))
+        operations, lengths, operationCounts = cigarArrays([alignment.cigar for alignment in alignments])
+        sequences = [str(alignment.seq) for alignment in alignments]
+        sequenceLengths = np.array(map(len, sequences), dtype = np.int64)
+        sequenceBuffer = np.frombuffer(''.join(sequences), dtype = np.uint8)
+        starts = np.array([alignment.start for alignment in alignments], dtype = np.int64)
+        qualityBuffer = None
+        if minimumQuality is not None or weighted:
+            qualities = [alignment.letter_annotations.get('phred_quality') for alignment in alignments]
+            qualityBuffer = np.concatenate([np.full(length, ReadStore.missingQuality, dtype = np.uint8) if quality is None else np.asarray(quality, dtype = np.uint8)
+                                            for quality, length in zip(qualities, sequenceLengths)])
+        return cls.fromArrays(starts, operations, lengths, operationCounts, sequenceBuffer, np.cumsum(sequenceLengths) - sequenceLengths, insertionColumns,
+                              qualityBuffer, minimumQuality, weighted)
+    @classmethod
+    def fromArrays(cls, starts, operations, lengths, operationCounts, sequenceBuffer, sequenceOffsets, insertionColumns = None,
+                   qualityBuffer = None, minimumQuality = None, weighted = False):
+        '''Version 1.2
+        Counts the symbols of reads described by arrays: reference start positions, cigar operation codes and lengths (all reads concatenated),
+        the number of cigar operations of each read, a buffer with every read sequence concatenated and the offset of each read in that buffer.
+        If an InsertionColumns table is supplied, its insertion columns are included and its padded coordinates are used.
+        A buffer of base qualities at the same offsets as the sequences (ReadStore.missingQuality where a base has none) can be given with
+        a minimum quality, below which bases are not counted, and/or weighted = True, which adds a weights matrix of the summed qualities
+        of each symbol. Spacers and bases without qualities have no quality of their own and are weighted by the mean quality of the
+        bases in their column.'''
+        symbolCount = len(consensusSymbols)
+        layout = ColumnLayout(starts, operations, lengths, operationCounts, insertionColumns)
+        referenceStart, size, widths, referenceColumns, columnCount = layout.referenceStart, layout.size, layout.widths, layout.referenceColumns, layout.columnCount
+        readIndexes, operationStarts, ends, isInsertion = layout.readIndexes, layout.operationStarts, layout.ends, layout.isInsertion
+        insertionOperationColumns, insertionIsBase = layout.insertionOperationColumns, layout.insertionIsBase
+        ##Count read bases
+        columns, queryPositions, baseReads = layout.bases(sequenceOffsets)
+        codes = symbolCodes[sequenceBuffer[queryPositions]]
+        if qualityBuffer is not None and (minimumQuality is not None or weighted):
+            baseQualities = qualityBuffer[queryPositions]
+            hasQuality = baseQualities != ReadStore.missingQuality
+            if minimumQuality is not None:
+                passing = ~hasQuality | (baseQualities >= minimumQuality)
+                columns, codes, baseQualities, hasQuality = columns[passing], codes[passing], baseQualities[passing], hasQuality[passing]
+        else:
+            weighted = False
+        counts = np.bincount(columns * symbolCount + codes, minlength = columnCount * symbolCount).reshape((columnCount, symbolCount))
+        ##Count deletions and skipped regions
+        for letter in ('D', 'N'):
+            isSpacer = operations == cigarOperations.index(letter)
+            spacerStarts = operationStarts[isSpacer] - referenceStart
+            spacerDifferences = np.bincount(spacerStarts, minlength = size + 1) - np.bincount(spacerStarts + lengths[isSpacer], minlength = size + 1)
+            counts[referenceColumns, consensusSymbols.index(cigarInsertTypes[letter])] += np.cumsum(spacerDifferences)[:size]
+        ##Count padding; alignments that span an insertion column without contributing a base to it are padded
+        spanning = np.cumsum(np.bincount(starts - referenceStart, minlength = size + 1) - np.bincount(ends - referenceStart, minlength = size + 1))[:size]
+        points = np.nonzero(widths)[0]
+        blockStarts = referenceColumns[points] + 1
+        paddingDifferences = np.bincount(blockStarts, weights = spanning[points], minlength = columnCount + 1) - \
+                             np.bincount(blockStarts + widths[points], weights = spanning[points], minlength = columnCount + 1)
+        insertionLengths = lengths[isInsertion]
+        isSpanned = operationStarts[isInsertion] - 1 < ends[readIndexes[isInsertion]]
+        removed = isSpanned & insertionIsBase #padding replaced by inserted bases
+        added = ~isSpanned & ~insertionIsBase #padding present in the cigar string of reads that end with it
+        for mask, sign in ((removed, -1), (added, 1)):
+            paddingDifferences += sign * (np.bincount(insertionOperationColumns[mask], minlength = columnCount + 1) - \
+                                          np.bincount(insertionOperationColumns[mask] + insertionLengths[mask], minlength = columnCount + 1))
+        counts[:, consensusSymbols.index(cigarInsertTypes['P'])] += np.cumsum(paddingDifferences)[:columnCount].astype(counts.dtype)
+        ##Weight symbols by base quality
+        weights = None
+        if weighted:
+            qualityColumns, qualities = columns[hasQuality], baseQualities[hasQuality].astype(np.float64)
+            knownCounts = np.bincount(qualityColumns, minlength = columnCount)
+            meanQualities = np.bincount(qualityColumns, weights = qualities, minlength = columnCount) / np.maximum(knownCounts, 1)
+            meanQualities[knownCounts == 0] = 1
+            weights = counts * meanQualities[:, np.newaxis] + \
+                      np.bincount(qualityColumns * symbolCount + codes[hasQuality], weights = qualities - meanQualities[qualityColumns],
+                                  minlength = columnCount * symbolCount).reshape((columnCount, symbolCount))
+        return cls(counts.astype(np.int32), layout.columnStart, weights)
+
+class IntervalIndex(object):
+    '''Version 2.0
+    Finds the intervals that overlap a range. The intervals are sorted by start and split into blocks of blockSize intervals; a
+    binary tree holds the largest end of the blocks under each of its nodes (as in cgranges), so a query only descends into the
+    nodes that can reach the range. It visits O(log n) nodes for each block holding an overlapping interval, however long the
+    longest interval is, and checks the intervals of those blocks together. When a binary search on the running maximum of the
+    ends already leaves only a few blocks to check, they are checked without the tree. Intervals are identified by their index in
+    the sequence the index was made from.'''
+    blockSize = 64
+    scanBlocks = 4 #ranges of at most this many blocks are checked directly
+    def __init__(self, starts, ends):
+        starts, ends = np.asarray(starts, dtype = np.int64), np.asarray(ends, dtype = np.int64)
+        self.order = np.argsort(starts, kind = 'mergesort')
+        self.starts, self.ends = starts[self.order], ends[self.order]
+        self.maxEnds = np.maximum.accumulate(self.ends) if len(self.ends) > 0 else self.ends
+        blockEnds = np.maximum.reduceat(self.ends, np.arange(0, len(self.ends), self.blockSize)) if len(self.ends) > 0 else self.ends
+        self.levels = [blockEnds] #the largest end under each node, from the blocks up to the root
+        while len(self.levels[-1]) > 1:
+            level = self.levels[-1]
+            if len(level) % 2 == 1: level = np.append(level, level[-1])
+            self.levels.append(np.maximum(level[0::2], level[1::2]))
+    def __len__(self):
+        return len(self.order)
+    def end(self):
+        return int(self.levels[-1][0])
+    def overlapping(self, start, end = None):
+        '''Version 2.0
+        Returns the sorted indexes of the intervals with at least one position between start and end (inclusive).
+        If end is None, all intervals ending at or after start are returned.'''
+        last = len(self.starts) if end is None else int(np.searchsorted(self.starts, end, side = 'right')) #intervals after last start after the range
+        first = int(np.searchsorted(self.maxEnds, start, side = 'left')) #intervals before first end before the range
+        if first >= last: return []
+        if last - first <= self.scanBlocks * self.blockSize:
+            indexes = self.order[first:last][self.ends[first:last] >= start]
+            indexes.sort()
+            return indexes.tolist()
+        lastBlock, blocks = (last - 1) // self.blockSize, []
+        nodes = [(len(self.levels) - 1, 0)] #(level, index) of the nodes to visit; a node of level L covers the blocks from index << L
+        while len(nodes) > 0:
+            level, node = nodes.pop()
+            if node << level > lastBlock or self.levels[level][node] < start: continue
+            if level == 0:
+                blocks.append(node)
                 continue
-            bases = []
-            posDatLen = len(positionData) #############
-            for read, index, cigar in positionData:
-                if cigar in cigarInsertTypes:
-                    bases.append(cigarInsertTypes[cigar])
+            for child in (2 * node + 1, 2 * node): #the left child is visited first, so blocks are found in order
+                if child < len(self.levels[level - 1]): nodes.append((level - 1, child))
+        if len(blocks) == 0: return []
+        rows = np.concatenate([np.arange(block * self.blockSize, min((block + 1) * self.blockSize, last)) for block in blocks])
+        indexes = self.order[rows[self.ends[rows] >= start]]
+        indexes.sort()
+        return indexes.tolist()
+    @classmethod
+    def fromAlignments(cls, alignments):
+        '''Indexes the aligned positions of a list of PileupAlignments.'''
+        return cls([alignment.alignedStart() for alignment in alignments], [alignment.alignedEnd() for alignment in alignments])
+
+class InsertionColumns(object):
+    '''Version 1.0
+    The insertion columns of a padded pileup, stored as the reference positions they follow and their widths instead of as padding
+    inserted into every alignment. The padded view of an alignment is computed from this table when it is needed. A reference
+    position is moved right in padded coordinates by the widths of all the insertion columns before it.'''
+    def __init__(self, positions = None, widths = None):
+        if positions is None: positions, widths = [], []
+        self.positions = np.asarray(positions, dtype = np.int64)
+        self.widths = np.asarray(widths, dtype = np.int64)
+        self.positionList, self.widthList = self.positions.tolist(), self.widths.tolist()
+        self.offsets = np.concatenate(([0], np.cumsum(self.widths))) #the number of insertion columns before each entry
+        self.offsetList = self.offsets.tolist()
+    def __len__(self):
+        return len(self.positionList)
+    def columnCount(self):
+        return self.offsetList[-1]
+    def width(self, position):
+        '''Returns the number of insertion columns following the reference position specified.'''
+        index = bisect.bisect_left(self.positionList, position)
+        if index < len(self.positionList) and self.positionList[index] == position: return self.widthList[index]
+        return 0
+    def paddedPosition(self, position):
+        '''Returns the padded coordinate of a reference position.'''
+        return position + self.offsetList[bisect.bisect_left(self.positionList, position)]
+    def paddedPositions(self, positions):
+        '''Returns the padded coordinates of an array of reference positions.'''
+        positions = np.asarray(positions, dtype = np.int64)
+        return positions + self.offsets[np.searchsorted(self.positions, positions, side = 'left')]
+    def runs(self, start, cigar):
+        '''Version 1.0
+        Yields the padded view of an alignment as runs of (unaligned_sequence_index, length, cigar_letter), in the same format as
+        PileupAlignment.alignedIndexs but one run at a time. The index is None for spacers; padding is given the cigar letter 'P'.'''
+        reference, sequenceIndex, ownInsertion = start, 0, 0
+        for length, letter in cigarPattern.findall(cigar):
+            length = int(length)
+            if letter in cigarIgnoredTypes:
+                sequenceIndex += length
+            elif letter in cigarAbsentTypes:
+                continue
+            elif letter in cigarExtraTypes:
+                if reference == start: #insertions before the first reference position are not aligned
+                    if letter == 'I': sequenceIndex += length
+                    continue
+                if letter == 'I':
+                    yield (sequenceIndex, length, letter)
+                    sequenceIndex += length
                 else:
-                    try:
-                        bases.append(read.seq[index])
-                    except:
-                        print read.id, index, cigar, read.cigar ##########
-                        print 'len(positionData)', posDatLen #######
-                        print 'len(read.seq)', len(read.seq)
-                        raise
-            if IUPAC:
-                consensusBase = getIUPAC(bases, deletionCharacter = cigarInsertTypes['D'], paddingCharacter = cigarInsertTypes['P'], skippedCharacter = cigarInsertTypes['N'])
+                    yield (None, length, letter)
+                ownInsertion += length
             else:
-                consensusBase = getMajority(bases)
-            consensus.append(consensusBase)
-        
-        return PileupAlignment(Seq(''.join(consensus)), start = self.start(), id=self.name)
-        
+                if reference > start: #pads the rest of the insertion columns following the last reference position
+                    padding = self.width(reference - 1) - ownInsertion
+                    if padding > 0: yield (None, padding, 'P')
+                ownInsertion = 0
+                isAligned = letter in cigarAlignedTypes
+                runStart = reference
+                index = bisect.bisect_left(self.positionList, reference)
+                while index < len(self.positionList) and self.positionList[index] < reference + length - 1: #insertion columns within this operation
+                    runLength = self.positionList[index] - runStart + 1
+                    yield (sequenceIndex if isAligned else None, runLength, letter)
+                    if isAligned: sequenceIndex += runLength
+                    yield (None, self.widthList[index], 'P')
+                    runStart += runLength
+                    index += 1
+                yield (sequenceIndex if isAligned else None, reference + length - runStart, letter)
+                if isAligned: sequenceIndex += reference + length - runStart
+                reference += length
+    def alignedIndexs(self, start, cigar):
+        '''Returns the padded aligned indexes of an alignment (see PileupAlignment.alignedIndexs).'''
+        output = []
+        for index, length, letter in self.runs(start, cigar):
+            if index is None: output.extend([(None, letter)] * length)
+            else: output.extend([(index + offset, letter) for offset in range(length)])
+        return output
+    def paddedSequence(self, start, cigar, sequence):
+        '''Returns the padded aligned sequence of an alignment as a string.'''
+        return ''.join([cigarInsertTypes[letter] * length if index is None else sequence[index : index + length] for index, length, letter in self.runs(start, cigar)])
+    def paddedLength(self, start, cigar):
+        '''Returns the number of padded columns an alignment spans.'''
+        return sum([length for index, length, letter in self.runs(start, cigar)])
+    @classmethod
+    def fromArrays(cls, starts, operations, lengths, operationCounts):
+        '''Version 1.0
+        Makes the table of the reads described by arrays of start positions and cigar operations (see ColumnCounts.fromArrays).'''
+        if len(starts) == 0: return cls()
+        readIndexes, firstOperations, operationStarts, ends, isInsertion, slots = placeCigarOperations(starts, operations, lengths, operationCounts)
+        points, extents = operationStarts[isInsertion] - 1, slots[isInsertion] + lengths[isInsertion]
+        if len(points) == 0: return cls()
+        order = np.lexsort((-extents, points))
+        points, extents = points[order], extents[order]
+        isFirst = np.concatenate(([True], points[1:] != points[:-1])) #after sorting, the first extent of each position is the widest
+        return cls(points[isFirst], extents[isFirst])
+    @classmethod
+    def fromAlignments(cls, alignments):
+        '''Version 1.0
+        Makes the table of a list of alignments positioned by their start attributes and cigar strings.'''
+        storeRows = PileupAlignmentView.storeRows(alignments)
+        if storeRows is not None:
+            return storeRows[0].insertionColumns(storeRows[1])
+        alignments = [alignment for alignment in alignments if alignment.cigar is not None]
+        operations, lengths, operationCounts = cigarArrays([alignment.cigar for alignment in alignments])
+        return cls.fromArrays(np.array([alignment.start for alignment in alignments], dtype = np.int64), operations, lengths, operationCounts)
+
+_consensusWorkerState = None
+def _initializeConsensusWorker(sharedStore, rows, insertionColumns, consensusArguments, qualityArguments = (None, False)):
+    '''Sets up a worker process of Pileup.makeConsensus with the shared reads of the pileup.'''
+    global _consensusWorkerState
+    store = ReadStore.fromShared(sharedStore)
+    _consensusWorkerState = (store, rows, store.ends()[rows], insertionColumns, consensusArguments, qualityArguments)
+
+def _windowConsensus(window):
+    '''Returns the consensus of the columns of one window of a pileup (see Pileup.makeConsensus). Windows are given as
+    (referenceStart, referenceEnd, paddedStart, paddedEnd); an end of None includes the rest of the pileup.'''
+    store, rows, ends, insertionColumns, consensusArguments, qualityArguments = _consensusWorkerState
+    referenceStart, referenceEnd, paddedStart, paddedEnd = window
+    overlapping = ends >= referenceStart
+    if referenceEnd is not None: overlapping &= store.starts[rows] <= referenceEnd
+    counts = store.columnCounts(rows[overlapping], insertionColumns, *qualityArguments)
+    return counts.region(paddedStart, paddedEnd).consensus(*consensusArguments)
+
+###Read Storage Classes###
+class ReadStore(object):
+    '''Version 1.0
+    The reads of a pileup stored as a few flat arrays instead of one SeqRecord per read. Cigar strings are stored as operation codes
+    (indexes of cigarOperations) and lengths, every sequence is stored in one buffer and every base quality in a second buffer at
+    the same offsets (255 where a read has no qualities). Rows are addressed by start and length, so several rows can share a sequence.
+    PileupAlignmentView objects present a row as a PileupAlignment.'''
+    missingQuality = 255
+    columnCache = None #the (InsertionColumns, ColumnCounts) of all the rows, e.g. read from a PileupCache; cleared when a row is changed
+    changeCount = 0 #the number of times a row was changed, so indexes of the rows (e.g. Pileup.intervalIndex) can tell they are stale
+    maxOrphanedShare = 0.5 #the share of the used cigar operations that may be replaced ones before setCigar compacts the operation arrays
+    def __init__(self, ids, references, starts, flags, mappingQualities, mates, mateStarts, cigarOperations, cigarLengths, cigarCounts,
+                 sequences, qualities, sequenceLengths, tags = None, sequenceStarts = None, templateLengths = None):
+        self.ids, self.references, self.mates = ids, references, mates
+        self.starts = np.asarray(starts, dtype = np.int64)
+        self.flags = np.asarray(flags, dtype = np.uint16)
+        self.mappingQualities = np.asarray(mappingQualities, dtype = np.int16)
+        self.mateStarts = np.asarray(mateStarts, dtype = np.int64)
+        if templateLengths is None: templateLengths = np.zeros(len(ids), dtype = np.int64) #TLEN
+        self.templateLengths = np.asarray(templateLengths, dtype = np.int64)
+        self.cigarOperations, self.cigarLengths = cigarOperations, cigarLengths
+        self.cigarCounts = np.asarray(cigarCounts, dtype = np.int64)
+        self.cigarStarts = np.cumsum(self.cigarCounts) - self.cigarCounts
+        self.cigarUsed, self.orphanedOperations = len(cigarOperations), 0 #the operations past cigarUsed are spare capacity
+        self.sequences, self.qualities = sequences, qualities
+        self.sequenceLengths = np.asarray(sequenceLengths, dtype = np.int64)
+        if sequenceStarts is None: sequenceStarts = np.cumsum(self.sequenceLengths) - self.sequenceLengths #sequences stored one after another
+        self.sequenceStarts = np.asarray(sequenceStarts, dtype = np.int64)
+        if tags is None: tags = [None] * len(ids)
+        self.tags = tags #the unparsed optional fields of each read
+        self.referenceLengths = self._referenceLengths(np.arange(len(ids)))
+    def __len__(self):
+        return len(self.ids)
+    def _operationIndexes(self, rows):
+        return expandRuns(self.cigarStarts[rows], self.cigarCounts[rows])
+    def _referenceLengths(self, rows):
+        operationIndexes = self._operationIndexes(rows)
+        steps = np.where(cigarReferenceCodes[self.cigarOperations[operationIndexes]], self.cigarLengths[operationIndexes], 0)
+        rowIndexes = np.repeat(np.arange(len(rows)), self.cigarCounts[rows])
+        return np.bincount(rowIndexes, weights = steps, minlength = len(rows)).astype(np.int64)
+    def ends(self):
+        '''Returns the last reference position of every row.'''
+        return self.starts + self.referenceLengths - 1
+    def sequence(self, row):
+        start = self.sequenceStarts[row]
+        return self.sequences[start : start + self.sequenceLengths[row]].tostring()
+    def phredQualities(self, row):
+        '''Returns the base qualities of a row as a view of the quality buffer, or None if the read has no qualities.'''
+        start = self.sequenceStarts[row]
+        qualities = self.qualities[start : start + self.sequenceLengths[row]]
+        if len(qualities) > 0 and qualities[0] == self.missingQuality: return None
+        return qualities
+    def cigar(self, row):
+        if self.cigarCounts[row] == 0: return None
+        start = self.cigarStarts[row]
+        operations = self.cigarOperations[start : start + self.cigarCounts[row]].tolist()
+        lengths = self.cigarLengths[start : start + self.cigarCounts[row]].tolist()
+        return ''.join(['%d%s' % (length, cigarOperations[operation]) for operation, length in zip(operations, lengths)])
+    def setCigar(self, row, cigar):
+        '''Version 1.1
+        Replaces the cigar string of a row. The new operations overwrite the old ones if they fit in their place, otherwise they are
+        appended after the used operations, doubling the operation arrays when they are full. The operations left behind are
+        counted and the arrays are compacted once they are more than maxOrphanedShare of the used operations.'''
+        if cigar is None:
+            operations, lengths, counts = np.zeros(0, dtype = np.uint8), np.zeros(0, dtype = np.int64), [0]
+        else:
+            operations, lengths, counts = cigarArrays([cigar])
+        count, oldCount = int(counts[0]), int(self.cigarCounts[row])
+        if count <= oldCount:
+            start = self.cigarStarts[row]
+            self.orphanedOperations += oldCount - count
+        else:
+            if self.orphanedOperations > self.maxOrphanedShare * self.cigarUsed: self.compactCigars()
+            start = self.cigarUsed
+            if start + count > len(self.cigarOperations):
+                spare = max(len(self.cigarOperations), count)
+                self.cigarOperations = np.concatenate((self.cigarOperations, np.zeros(spare, dtype = self.cigarOperations.dtype)))
+                self.cigarLengths = np.concatenate((self.cigarLengths, np.zeros(spare, dtype = self.cigarLengths.dtype)))
+            self.cigarUsed += count
+            self.orphanedOperations += oldCount
+        self.cigarOperations[start : start + count] = operations
+        self.cigarLengths[start : start + count] = lengths
+        self.cigarStarts[row] = start
+        self.cigarCounts[row] = count
+        self.referenceLengths[row] = self._referenceLengths(np.array([row]))[0]
+        self.rowChanged()
+    def compactCigars(self):
+        '''Version 1.0
+        Stores the cigar operations of the rows one after another in row order, dropping the operations replaced by setCigar and
+        the spare capacity. Arrays saved or shared without cigarStarts (see toShared and PileupCache) need this layout.'''
+        compactStarts = np.cumsum(self.cigarCounts) - self.cigarCounts
+        if len(self.cigarOperations) == self.cigarCounts.sum() and np.array_equal(self.cigarStarts, compactStarts): return
+        operationIndexes = self._operationIndexes(np.arange(len(self.cigarCounts)))
+        self.cigarOperations, self.cigarLengths = self.cigarOperations[operationIndexes], self.cigarLengths[operationIndexes]
+        self.cigarStarts = compactStarts
+        self.cigarUsed, self.orphanedOperations = len(operationIndexes), 0
+    def rowChanged(self):
+        '''Clears the column cache and counts the change, so indexes made from the rows are remade.'''
+        self.columnCache = None
+        self.changeCount += 1
+    def alignment(self, row):
+        return PileupAlignmentView(self, row)
+    def alignments(self):
+        '''Returns a PileupAlignmentView of every row.'''
+        return [PileupAlignmentView(self, row) for row in range(len(self))]
+    def _cachedColumns(self, rows):
+        '''Returns the column cache if the rows specified are all the rows of the store, in any order, otherwise None.'''
+        if self.columnCache is None: return None
+        if rows is not None and (len(rows) != len(self) or not (np.sort(rows) == np.arange(len(self))).all()): return None
+        return self.columnCache
+    def _placedRows(self, rows):
+        if rows is None: rows = np.arange(len(self))
+        rows = np.asarray(rows, dtype = np.int64)
+        return rows[self.cigarCounts[rows] > 0]
+    def columnCounts(self, rows = None, insertionColumns = None, minimumQuality = None, weighted = False):
+        '''Version 1.3
+        Returns the ColumnCounts matrix of the rows specified (Default: all rows) using the arrays of the store directly.
+        The quality buffer is only used if a minimum quality or weighting is requested (see ColumnCounts.fromArrays).
+        The counts of the column cache are returned for all the rows in the padding of its insertion columns without quality options.'''
+        cachedColumns = self._cachedColumns(rows)
+        if cachedColumns is not None and insertionColumns is cachedColumns[0] and minimumQuality is None and not weighted: return cachedColumns[1]
+        rows = self._placedRows(rows)
+        if len(rows) == 0:
+            return ColumnCounts(np.zeros((0, len(consensusSymbols)), dtype = np.int32))
+        operationIndexes = self._operationIndexes(rows)
+        return ColumnCounts.fromArrays(self.starts[rows], self.cigarOperations[operationIndexes], self.cigarLengths[operationIndexes],
+                                       self.cigarCounts[rows], self.sequences, self.sequenceStarts[rows], insertionColumns,
+                                       self.qualities if minimumQuality is not None or weighted else None, minimumQuality, weighted)
+    def insertionColumns(self, rows = None):
+        '''Version 1.1
+        Returns the InsertionColumns table of the rows specified (Default: all rows), from the column cache if it is of the same rows.'''
+        cachedColumns = self._cachedColumns(rows)
+        if cachedColumns is not None: return cachedColumns[0]
+        rows = self._placedRows(rows)
+        operationIndexes = self._operationIndexes(rows)
+        return InsertionColumns.fromArrays(self.starts[rows], self.cigarOperations[operationIndexes], self.cigarLengths[operationIndexes], self.cigarCounts[rows])
+    def realigned(self, rows, insertionColumns, sequence, start, name):
+        '''Version 1.0
+        Returns a new ReadStore of the rows specified (Default: all rows) aligned to a sequence laid out in the columns of their pileup
+        (see ColumnLayout), that starts at the padded position start, and named name. The columns where the sequence has a spacer are
+        not part of the new reference: bases of a read in them become insertions and spacers of a read in them are dropped. Spacers are
+        also removed from the read sequences, so reads that lose any have no base qualities in the new store. Clipped bases and bases
+        inserted before the first aligned position of a read are soft clipped. Rows without bases in the pileup are left out.'''
+        rows = self._placedRows(rows)
+        symbols = np.frombuffer(sequence, dtype = np.uint8)
+        isSequenceBase = ~spacerCodes[symbols]
+        basesBefore = np.concatenate(([0], np.cumsum(isSequenceBase)))
+        M, I, D, N, S, H = [cigarOperations.index(letter) for letter in 'MIDNSH']
+        if len(rows) == 0:
+            return ReadStore([], [], [], [], [], [], [], np.zeros(0, dtype = np.uint8), np.zeros(0, dtype = np.int64), [],
+                             np.zeros(0, dtype = np.uint8), np.zeros(0, dtype = np.uint8), [], [])
+        operationIndexes = self._operationIndexes(rows)
+        operations, lengths = self.cigarOperations[operationIndexes], self.cigarLengths[operationIndexes]
+        layout = ColumnLayout(self.starts[rows], operations, lengths, self.cigarCounts[rows], insertionColumns)
+        def hasBase(columns):
+            indexes = columns + (layout.columnStart - start)
+            inside = (indexes >= 0) & (indexes < len(symbols))
+            output = np.zeros(len(columns), dtype = bool)
+            output[inside] = isSequenceBase[indexes[inside]]
+            return output
+        ##Give every base, spacer and padding symbol of the reads a cigar operation in the new alignment (-1 if it is dropped)
+        columns, queryPositions, reads = layout.bases(self.sequenceStarts[rows])
+        querySymbols = self.sequences[queryPositions]
+        isQueryBase = ~spacerCodes[querySymbols]
+        events = [(reads, columns, np.where(hasBase(columns), np.where(isQueryBase, M, np.where(querySymbols == ord('~'), N, D)), np.where(isQueryBase, I, -1)),
+                   np.where(isQueryBase, queryPositions, -1))]
+        for letter in ('D', 'N'):
+            columns, reads = layout.spacers(letter)
+            events.append((reads, columns, np.where(hasBase(columns), cigarOperations.index(letter), -1), np.zeros(len(reads), dtype = np.int64) - 1))
+        insertionReads, insertionLengths = layout.readIndexes[layout.isInsertion], lengths[layout.isInsertion]
+        insertionColumnIndexes = expandRuns(layout.insertionOperationColumns, insertionLengths)
+        insertionColumnReads = np.repeat(insertionReads, insertionLengths)
+        isPadding = np.repeat(~layout.insertionIsBase, insertionLengths)
+        columns, reads = insertionColumnIndexes[isPadding], insertionColumnReads[isPadding]
+        events.append((reads, columns, np.where(hasBase(columns), D, -1), np.zeros(len(reads), dtype = np.int64) - 1))
+        ##Reads that span an insertion column where the sequence has a base, without a symbol of their own in it, are padded
+        isReferenceColumn = np.zeros(layout.columnCount, dtype = bool)
+        isReferenceColumn[layout.referenceColumns] = True
+        insertedColumns = np.nonzero(~isReferenceColumn)[0]
+        insertedColumns = insertedColumns[hasBase(insertedColumns)]
+        if len(insertedColumns) > 0:
+            points = np.searchsorted(layout.referenceColumns, insertedColumns, side = 'right') - 1
+            spans = IntervalIndex(self.starts[rows] - layout.referenceStart, layout.ends - layout.referenceStart - 1)
+            spanningReads = [spans.overlapping(point, point) for point in points.tolist()]
+            reads = np.fromiter(itertools.chain.from_iterable(spanningReads), dtype = np.int64)
+            columns = np.repeat(insertedColumns, map(len, spanningReads))
+            ownSymbols = np.in1d(reads * layout.columnCount + columns, insertionColumnReads * layout.columnCount + insertionColumnIndexes)
+            reads, columns = reads[~ownSymbols], columns[~ownSymbols]
+            events.append((reads, columns, np.zeros(len(reads), dtype = np.int64) + D, np.zeros(len(reads), dtype = np.int64) - 1))
+        reads, columns, newOperations, queryPositions = [np.concatenate(values) for values in zip(*events)]
+        kept = newOperations >= 0
+        order = np.argsort(reads[kept] * layout.columnCount + columns[kept]) #each read has at most one symbol per column
+        reads, columns, newOperations, queryPositions = reads[kept][order], columns[kept][order], newOperations[kept][order], queryPositions[kept][order]
+        ##Trim each read to its first and last base
+        queryEvents = np.nonzero(queryPositions >= 0)[0]
+        placed = np.bincount(reads[queryEvents], minlength = len(rows)) > 0
+        readIndexes = np.nonzero(placed)[0]
+        firsts = queryEvents[np.searchsorted(reads[queryEvents], readIndexes, side = 'left')]
+        lasts = queryEvents[np.searchsorted(reads[queryEvents], readIndexes, side = 'right') - 1]
+        firstEvents, lastEvents = np.zeros(len(rows), dtype = np.int64) + len(reads), np.zeros(len(rows), dtype = np.int64) - 1
+        firstEvents[readIndexes], lastEvents[readIndexes] = firsts, lasts
+        eventIndexes = np.arange(len(reads))
+        inside = (eventIndexes >= firstEvents[reads]) & (eventIndexes <= lastEvents[reads])
+        positions = basesBefore[np.clip(columns[firsts] + layout.columnStart - start, 0, len(symbols))] + 1
+        reads, newOperations = reads[inside], newOperations[inside]
+        isRunStart = np.ones(len(reads), dtype = bool)
+        isRunStart[1:] = (reads[1:] != reads[:-1]) | (newOperations[1:] != newOperations[:-1])
+        runStarts = np.nonzero(isRunStart)[0]
+        runReads, runOperations, runLengths = reads[runStarts], newOperations[runStarts], np.diff(np.append(runStarts, len(reads)))
+        ##Remove spacers from the sequences
+        outputRows = rows[placed]
+        sequenceStarts, sequenceLengths = self.sequenceStarts[outputRows], self.sequenceLengths[outputRows]
+        basePositions = expandRuns(sequenceStarts, sequenceLengths)
+        bases = self.sequences[basePositions]
+        isSpacer = spacerCodes[bases]
+        spacersBefore = np.concatenate(([0], np.cumsum(isSpacer)))
+        offsets = np.cumsum(sequenceLengths) - sequenceLengths
+        removed = spacersBefore[offsets + sequenceLengths] - spacersBefore[offsets]
+        qualities = self.qualities[basePositions]
+        qualities[np.repeat(removed > 0, sequenceLengths)] = self.missingQuality
+        ##Clip the bases outside the aligned part and keep hard clips
+        leadingClips = queryPositions[firsts] - sequenceStarts
+        trailingClips = sequenceStarts + sequenceLengths - 1 - queryPositions[lasts]
+        leadingClips -= spacersBefore[offsets + leadingClips] - spacersBefore[offsets]
+        trailingClips -= spacersBefore[offsets + sequenceLengths] - spacersBefore[offsets + sequenceLengths - trailingClips]
+        cigarStarts = (np.cumsum(self.cigarCounts[rows]) - self.cigarCounts[rows])[placed]
+        cigarEnds = cigarStarts + self.cigarCounts[outputRows] - 1
+        leadingHard, trailingHard = operations[cigarStarts] == H, operations[cigarEnds] == H
+        parts = [(runReads, np.zeros(len(runReads), dtype = np.int64) + 2, runOperations, runLengths)]
+        for mask, part, operation, clipLengths in ((leadingHard, 0, H, lengths[cigarStarts]), (leadingClips > 0, 1, S, leadingClips),
+                                                   (trailingClips > 0, 3, S, trailingClips), (trailingHard, 4, H, lengths[cigarEnds])):
+            parts.append((readIndexes[mask], np.zeros(mask.sum(), dtype = np.int64) + part, np.zeros(mask.sum(), dtype = np.int64) + operation, clipLengths[mask]))
+        cigarReads, cigarParts, newOperations, newLengths = [np.concatenate(values) for values in zip(*parts)]
+        order = np.argsort((cigarReads * 5 + cigarParts) * len(cigarReads) + np.arange(len(cigarReads)))
+        cigarReads, newOperations, newLengths = cigarReads[order], newOperations[order], newLengths[order]
+        outputRowList = outputRows.tolist()
+        return ReadStore([self.ids[row] for row in outputRowList], [name] * len(outputRowList), positions, self.flags[outputRows] & 0xf10,
+                         self.mappingQualities[outputRows], [None] * len(outputRowList), np.zeros(len(outputRowList), dtype = np.int64),
+                         newOperations.astype(np.uint8), newLengths.astype(np.int64), np.bincount(np.searchsorted(readIndexes, cigarReads), minlength = len(readIndexes)),
+                         bases[~isSpacer], qualities[~isSpacer], sequenceLengths - removed, [self.tags[row] for row in outputRowList])
+    def placedCopies(self, rows, references, starts, cigarOperations, cigarLengths, cigarCounts):
+        '''Version 1.0
+        Returns a new ReadStore with a row for each row specified, placed on the reference sequences and starts given with the cigar
+        strings given as arrays (see cigarArrays). The new rows share the sequence and quality buffers of this store rather than copying
+        them, so a read can be placed several times (e.g. a contig with more than one nucmer alignment) for the cost of its placement.'''
+        rows = np.asarray(rows, dtype = np.int64)
+        rowList = rows.tolist()
+        return ReadStore([self.ids[row] for row in rowList], references, starts, self.flags[rows], self.mappingQualities[rows],
+                         [self.mates[row] for row in rowList], self.mateStarts[rows], cigarOperations, cigarLengths, cigarCounts,
+                         self.sequences, self.qualities, self.sequenceLengths[rows], [self.tags[row] for row in rowList], self.sequenceStarts[rows],
+                         self.templateLengths[rows])
+    sharedArrays = ('starts', 'cigarOperations', 'cigarLengths', 'cigarCounts', 'sequences', 'sequenceStarts', 'sequenceLengths')
+    def toShared(self, arrays = None):
+        '''Version 1.2
+        Copies the arrays needed to place and count the reads (Default: sharedArrays) into shared memory, to be given to worker processes.
+        Returns a dictionary of (RawArray, dtype, length) by array name.'''
+        if arrays is None: arrays = self.sharedArrays
+        self.compactCigars()
+        shared = {}
+        for name in arrays:
+            array = np.ascontiguousarray(getattr(self, name))
+            rawArray = multiprocessing.RawArray('c', max(array.nbytes, 1))
+            np.frombuffer(rawArray, dtype = np.uint8)[:array.nbytes] = array.view(np.uint8)
+            shared[name] = (rawArray, array.dtype, len(array))
+        return shared
+    @classmethod
+    def fromShared(cls, shared):
+        '''Version 1.2
+        Makes a ReadStore whose arrays are the shared memory made by toShared. Only the placement of reads and the methods that
+        count them (e.g. columnCounts, insertionColumns and ends) can be used; ids and tags are not shared and qualities only if requested.'''
+        instance = cls.__new__(cls)
+        for name, (rawArray, dtype, length) in shared.iteritems():
+            setattr(instance, name, np.frombuffer(rawArray, dtype = dtype, count = length))
+        instance.cigarStarts = np.cumsum(instance.cigarCounts) - instance.cigarCounts
+        instance.cigarUsed, instance.orphanedOperations = len(instance.cigarOperations), 0
+        instance.referenceLengths = instance._referenceLengths(np.arange(len(instance.starts)))
+        return instance
+    @classmethod
+    def fromAlignments(cls, alignments):
+        '''Version 1.0
+        Makes a ReadStore holding a copy of the data of a list of alignments (e.g. Alignment or PileupAlignment objects).
+        Optional fields are stored in their binary form (see alignmentTagsToBam).'''
+        sequences, qualities = [], []
+        for alignment in alignments:
+            sequence = str(alignment.seq) if alignment.seq is not None else ''
+            quality = alignment.letter_annotations.get('phred_quality')
+            sequences.append(sequence)
+            qualities.append(chr(cls.missingQuality) * len(sequence) if quality is None else np.asarray(quality, dtype = np.uint8).tostring())
+        operations, lengths, operationCounts = cigarArrays([alignment.cigar or '' for alignment in alignments])
+        return cls([alignment.id for alignment in alignments], [alignment.reference for alignment in alignments],
+                   [alignment.start or 0 for alignment in alignments], [alignment.flag or 0 for alignment in alignments],
+                   [alignment.quality if alignment.quality is not None else 255 for alignment in alignments], [alignment.mate for alignment in alignments],
+                   [alignment.mateStart or 0 for alignment in alignments], operations, lengths, operationCounts,
+                   np.frombuffer(''.join(sequences), dtype = np.uint8), np.frombuffer(''.join(qualities), dtype = np.uint8),
+                   map(len, sequences), [BamTagData(alignmentTagsToBam(alignment)) for alignment in alignments],
+                   templateLengths = [getattr(alignment, 'templateLength', 0) for alignment in alignments])
+    @classmethod
+    def fromSamRecords(cls, samRecords, qualityEncoding = None):
+        '''Version 1.0
+        Makes a ReadStore from an iterable of SamRecord objects, reading the raw fields of each record only once.'''
+        if qualityEncoding is None: qualityEncoding = 'sanger'
+        conversion = phredConversion[qualityEncoding]
+        ids, flags, references, starts, mappingQualities, cigars, mates, mateStarts, sequences, qualities, tags = [], [], [], [], [], [], [], [], [], [], []
+        templateLengths = []
+        for samRecord in samRecords:
+            fields = samRecord.fields
+            ids.append(fields[0])
+            flags.append(int(fields[1]))
+            references.append(None if fields[2] == '*' else fields[2])
+            starts.append(int(fields[3]))
+            mappingQualities.append(int(fields[4]))
+            cigars.append('' if fields[5] == '*' else fields[5])
+            mates.append(None if fields[6] == '*' else fields[6])
+            mateStarts.append(int(fields[7]))
+            templateLengths.append(int(fields[8]))
+            sequence = '' if fields[9] == '*' else fields[9]
+            sequences.append(sequence)
+            qualities.append(chr(cls.missingQuality) * len(sequence) if fields[10] == '*' else fields[10])
+            tags.append(fields[11] if len(fields) > 11 else None)
+        operations, lengths, operationCounts = cigarArrays(cigars)
+        sequenceLengths = np.array(map(len, sequences), dtype = np.int64)
+        qualityBuffer = np.frombuffer(''.join(qualities), dtype = np.uint8)
+        missing = qualityBuffer == cls.missingQuality
+        qualityBuffer = qualityBuffer - np.uint8(ord(conversion[0]))
+        invalid = (qualityBuffer >= len(conversion)) & ~missing
+        if invalid.any():
+            row = np.searchsorted(np.cumsum(sequenceLengths), invalid.nonzero()[0][0], side = 'right')
+            errorChars = ''.join([char for char in qualities[row] if char not in conversion])
+            raise ValueError('Cant parse quality sequence from read "%s": "%s". The following characters are invalid: %s' % (ids[row], qualities[row], errorChars))
+        qualityBuffer[missing] = cls.missingQuality
+        return cls(ids, references, starts, flags, mappingQualities, mates, mateStarts, operations, lengths, operationCounts,
+                   np.frombuffer(''.join(sequences), dtype = np.uint8), qualityBuffer, sequenceLengths, tags, templateLengths = templateLengths)
+
+class PileupAlignmentView(PileupAlignment):
+    '''Version 1.0
+    A PileupAlignment whose read data is a row of a ReadStore. Only the padding and the sort attribute are held by the view itself;
+    the sequence, qualities and placement are read from (and written to) the store when used.'''
+    name = '<unknown name>'
+    description = '<unknown description>'
+    def __init__(self, store, row, padding = 0, sortAttr = 'start'):
+        self.store, self.row, self.padding, self.sortAttr = store, row, padding, sortAttr
+    def _storeProperty(arrayName, convert = int):
+        def getter(self): return convert(getattr(self.store, arrayName)[self.row])
+        def setter(self, value):
+            getattr(self.store, arrayName)[self.row] = value
+            self.store.rowChanged()
+        return property(getter, setter)
+    start = _storeProperty('starts')
+    flag = _storeProperty('flags')
+    quality = _storeProperty('mappingQualities') #mapping quality
+    mateStart = _storeProperty('mateStarts')
+    templateLength = _storeProperty('templateLengths')
+    id = _storeProperty('ids', convert = str)
+    reference = _storeProperty('references', convert = lambda value: value)
+    mate = _storeProperty('mates', convert = lambda value: value)
+    del _storeProperty
+    def _getCigar(self): return self.store.cigar(self.row)
+    def _setCigar(self, cigar): self.store.setCigar(self.row, cigar)
+    cigar = property(_getCigar, _setCigar)
+    def _getSeq(self): return Seq(self.store.sequence(self.row))
+    seq = property(_getSeq)
+    dbxrefs = property(lambda self: [])
+    features = property(lambda self: [])
+    def _getAnnotations(self):
+        if '_annotations' not in self.__dict__:
+            tags = self.store.tags[self.row]
+            self._annotations = parseSamTags(tags) if tags is not None else {}
+        return self._annotations
+    def _setAnnotations(self, annotations):
+        self._annotations = annotations
+    annotations = property(_getAnnotations, _setAnnotations)
+    def _getLetterAnnotations(self):
+        if '_per_letter_annotations' not in self.__dict__:
+            SeqRecord.letter_annotations.fset(self, {})
+            qualities = self.store.phredQualities(self.row)
+            if qualities is not None:
+                self._per_letter_annotations['phred_quality'] = qualities
+        return self._per_letter_annotations
+    letter_annotations = property(_getLetterAnnotations, SeqRecord.letter_annotations.fset)
+    def __getitem__(self, index):
+        '''Returns the base value at the specified distance from the start of the alignment, reading a single base from the store.'''
+        sequenceIndex, cigarType = self.alignedIndexs[index]
+        if sequenceIndex is None:
+            return cigarInsertTypes[cigarType]
+        return chr(self.store.sequences[self.store.sequenceStarts[self.row] + sequenceIndex])
+    def end(self):
+        return int(self.store.starts[self.row] + self.store.referenceLengths[self.row] - 1)
+    @staticmethod
+    def storeRows(alignments):
+        '''Returns the store and the rows of a list of alignments if they are all views of the same ReadStore, otherwise None.'''
+        if len(alignments) == 0 or not all([isinstance(alignment, PileupAlignmentView) for alignment in alignments]): return None
+        store = alignments[0].store
+        if not all([alignment.store is store for alignment in alignments]): return None
+        return (store, np.array([alignment.row for alignment in alignments], dtype = np.int64))
+    def __deepcopy__(self, memo):
+        '''Copies the view, not the store it refers to.'''
+        instance = PileupAlignmentView(self.store, self.row, self.padding, self.sortAttr)
+        for key, value in self.__dict__.iteritems():
+            if key not in ('store', 'row'):
+                instance.__dict__[key] = copy.deepcopy(value, memo)
+        return instance
+
+class ReferenceAlignment(PileupAlignment):
+    '''Version 1.0
+    A sequence of an IndexedFasta aligned to itself from position 1, whose bases are read from the file when they are used instead of
+    being held in memory. It can be padded in a pileup like other alignments; its padded view is kept as runs (see InsertionColumns.runs)
+    instead of one aligned index per base.'''
+    description = '<unknown description>'
+    def __init__(self, fasta, name, padding = 0, sortAttr = 'start'):
+        self.fasta, self.id, self.name, self.reference = fasta, name, name, name
+        self.start, self.cigar, self.padding, self.sortAttr = 1, '%dM' % fasta.length(name), padding, sortAttr
+        self.mate, self.mateStart, self.flag, self.quality = None, None, None, None
+        self._annotations, self._per_letter_annotations = {}, {}
+    def _getSeq(self): return Seq(self.fasta.fetch(self.id))
+    seq = property(_getSeq)
+    dbxrefs = property(lambda self: [])
+    features = property(lambda self: [])
+    def refreshAlignment(self):
+        PileupAlignment.refreshAlignment(self)
+        self.__dict__.pop('_runTable', None)
+    def _runs(self):
+        '''Returns the runs of the padded view and the padded column each run starts at, with the total number of columns last.'''
+        if '_runTable' not in self.__dict__:
+            if self.insertionColumns is None: runs = [(0, self.fasta.length(self.id), 'M')]
+            else: runs = list(self.insertionColumns.runs(self.start, self.cigar))
+            runStarts = [0]
+            for index, length, letter in runs: runStarts.append(runStarts[-1] + length)
+            self._runTable = (runs, runStarts)
+        return self._runTable
+    def alignedEnd(self):
+        return self.alignedStart() + self._runs()[1][-1] - 1
+    def __getitem__(self, index):
+        '''Returns the base value at the specified distance from the start of the alignment, including padding, reading one base.'''
+        runs, runStarts = self._runs()
+        if index < 0: index += runStarts[-1]
+        if index < 0 or index >= runStarts[-1]: raise IndexError('index %d is outside of the alignment of "%s".' % (index, self.id))
+        runIndex = bisect.bisect_right(runStarts, index) - 1
+        sequenceIndex, length, letter = runs[runIndex]
+        if sequenceIndex is None: return cigarInsertTypes[letter]
+        position = sequenceIndex + index - runStarts[runIndex] + 1
+        return self.fasta.fetch(self.id, position, position)
+    def paddedSequence(self):
+        '''Version 1.0
+        Returns the aligned sequence as a string, reading each run of bases from the file.'''
+        return ''.join([cigarInsertTypes[letter] * length if index is None else self.fasta.fetch(self.id, index + 1, index + length) for index, length, letter in self._runs()[0]])
 
 ###Input/Output Classes###
+class SamRecord(object):
+    '''Version 1.0
+    A tokenized line of a SAM file. The line is split once; optional fields and base qualities are only decoded when requested.'''
+    __slots__ = ('fields', 'qualityEncoding')
+    def __init__(self, line, qualityEncoding = None):
+        if qualityEncoding is None:
+            qualityEncoding = 'sanger'
+        self.fields = line.rstrip('\r\n').split('\t', 11)
+        self.qualityEncoding = qualityEncoding
+    def __getstate__(self):
+        return (self.fields, self.qualityEncoding)
+    def __setstate__(self, state):
+        self.fields, self.qualityEncoding = state
+    def _field(self, index):
+        value = self.fields[index]
+        if value == '*': return None
+        return value
+    id = property(lambda self: self._field(0))
+    flag = property(lambda self: int(self.fields[1]))
+    reference = property(lambda self: self._field(2))
+    start = property(lambda self: int(self.fields[3]))
+    quality = property(lambda self: int(self.fields[4])) #mapping quality
+    cigar = property(lambda self: self._field(5))
+    mate = property(lambda self: self._field(6))
+    mateStart = property(lambda self: int(self.fields[7]))
+    templateLength = property(lambda self: int(self.fields[8]))
+    sequence = property(lambda self: self._field(9))
+    def phredQualities(self):
+        '''Returns the base qualities as a numpy array of unsigned bytes, or None if the record has no qualities.'''
+        qualityString = self.fields[10]
+        if qualityString == '*': return None
+        conversion = phredConversion[self.qualityEncoding]
+        qualities = np.frombuffer(qualityString, dtype = np.uint8) - np.uint8(ord(conversion[0]))
+        if len(qualities) > 0 and qualities.max() >= len(conversion):
+            errorChars = ''.join([char for char in qualityString if char not in conversion])
+            raise ValueError('Cant parse quality sequence from read "%s": "%s". The following characters are invalid: %s' % (self.fields[0], qualityString, errorChars))
+        return qualities
+    def tags(self):
+        '''Returns the optional fields of the record as a dictionary.'''
+        if len(self.fields) > 11:
+            return parseSamTags(self.fields[11])
+        return {}
+    def end(self):
+        '''Returns the last reference position covered by the record.'''
+        referenceLength = sum([int(length) for length, letter in cigarPattern.findall(self.fields[5]) if letter in 'MDN=X'])
+        return self.start + max(referenceLength, 1) - 1
+
+class SamIndex(object):
+    '''Version 1.0
+    A byte offset index of a SAM file. The records of each reference are located by the byte range they occupy; within that range
+    the offset of the first record overlapping each bin of binSize reference positions is kept (a linear index, as in the BAM format),
+    so a region can be read by seeking to the bin containing its start. If the records of a reference are sorted by position,
+    reading stops at the first record starting after the region. A reference whose records are not contiguous has one range per block.
+    The index is saved next to the SAM file and is remade if the size or modification time of the file change.'''
+    extension = '.sri'
+    formatVersion = '2'
+    binSize = 16384
+    def __init__(self, blocks = None, fileSize = None, fileTime = None, binSize = None):
+        if blocks is None: blocks = []
+        if binSize is not None: self.binSize = binSize
+        self.blocks = blocks #list of [reference, startOffset, endOffset, isSorted, binOffsets, recordCount]
+        self.fileSize, self.fileTime = fileSize, fileTime
+    def references(self):
+        '''Returns the reference names in the order they first occur in the file.'''
+        output = []
+        for block in self.blocks:
+            if block[0] not in output: output.append(block[0])
+        return output
+    def chunks(self, reference, start = None, end = None):
+        '''Returns the (startOffset, endOffset, isSorted) byte ranges that contain all the records of a reference overlapping the region.'''
+        output = []
+        for blockReference, startOffset, endOffset, isSorted, binOffsets, recordCount in self.blocks:
+            if blockReference != reference: continue
+            if start is not None and len(binOffsets) > 0:
+                binIndex = max(start, 0) // self.binSize
+                if binIndex >= len(binOffsets): continue #all records of this block end before the region
+                startOffset = binOffsets[binIndex]
+            if startOffset < endOffset: output.append((startOffset, endOffset, isSorted))
+        return output
+    def isCurrent(self, samPath):
+        status = os.stat(samPath)
+        return self.fileSize == status.st_size and self.fileTime == int(status.st_mtime)
+    @classmethod
+    def build(cls, samPath, binSize = None):
+        '''Version 1.0
+        Makes the index of a SAM file by reading it once.'''
+        instance = cls(binSize = binSize)
+        status = os.stat(samPath)
+        instance.fileSize, instance.fileTime = status.st_size, int(status.st_mtime)
+        offset, block = 0, None
+        with open(samPath, 'rb') as handle:
+            for line in handle:
+                lineOffset, offset = offset, offset + len(line)
+                if line[0] == '@' or line.strip() == '': continue
+                record = SamRecord(line)
+                if block is None or record.fields[2] != block[0]:
+                    if block is not None: instance.blocks.append(block)
+                    block, lastStart = [record.fields[2], lineOffset, offset, True, [], 0], None
+                block[2] = offset
+                block[5] += 1
+                start = record.start
+                if lastStart is not None and start < lastStart: block[3] = False
+                lastStart = start
+                binOffsets = block[4]
+                lastBin = record.end() // instance.binSize
+                if lastBin >= len(binOffsets): binOffsets.extend([None] * (lastBin - len(binOffsets) + 1))
+                for binIndex in range(max(start, 0) // instance.binSize, lastBin + 1):
+                    if binOffsets[binIndex] is None: binOffsets[binIndex] = lineOffset
+        if block is not None: instance.blocks.append(block)
+        for block in instance.blocks: #reading from the offset of a bin must reach the records of all later bins, even if unsorted
+            binOffsets, nextOffset = block[4], block[2]
+            for binIndex in reversed(range(len(binOffsets))):
+                if binOffsets[binIndex] is not None: nextOffset = min(nextOffset, binOffsets[binIndex])
+                binOffsets[binIndex] = nextOffset
+        return instance
+    def write(self, indexPath):
+        with open(indexPath, 'w') as handle:
+            handle.write('#readtools sam index\t%d\t%d\t%d\t%s\n' % (self.fileSize, self.fileTime, self.binSize, self.formatVersion))
+            for reference, startOffset, endOffset, isSorted, binOffsets, recordCount in self.blocks:
+                handle.write('%s\t%d\t%d\t%d\t%s\t%d\n' % (reference, startOffset, endOffset, isSorted, ','.join(map(str, binOffsets)), recordCount))
+    @classmethod
+    def read(cls, indexPath):
+        with open(indexPath, 'r') as handle:
+            header = handle.readline().rstrip('\n').split('\t')
+            if header[0] != '#readtools sam index' or len(header) != 5 or header[4] != cls.formatVersion:
+                raise InputValidationError('"%s" is not a readtools SAM index.' % indexPath)
+            instance = cls(fileSize = int(header[1]), fileTime = int(header[2]), binSize = int(header[3]))
+            for line in handle:
+                reference, startOffset, endOffset, isSorted, binOffsets, recordCount = line.rstrip('\n').split('\t')
+                binOffsets = [int(binOffset) for binOffset in binOffsets.split(',')] if binOffsets != '' else []
+                instance.blocks.append([reference, int(startOffset), int(endOffset), isSorted == '1', binOffsets, int(recordCount)])
+        return instance
+    @classmethod
+    def forFile(cls, samPath):
+        '''Version 1.0
+        Returns the index of a SAM file, reading the saved index if it is current and otherwise making and saving a new one.
+        If the index can not be saved (e.g. the directory is read only), it is only kept in memory.'''
+        indexPath = samPath + cls.extension
+        if os.path.exists(indexPath):
+            try:
+                index = cls.read(indexPath)
+            except InputValidationError: #an index made by an older version is remade
+                index = None
+            if index is not None and index.isCurrent(samPath): return index
+        index = cls.build(samPath)
+        try:
+            index.write(indexPath)
+        except IOError:
+            logging.warning('Could not save the SAM index "%s"; it will be remade when next used.' % indexPath)
+        return index
+
+class FastaIndex(object):
+    '''Version 1.0
+    The index of a FASTA file in the format of samtools faidx (.fai): the name, length and byte offset of each sequence with the number
+    of bases and bytes on each of its lines, from which the byte offset of any base is computed. Every line of a sequence but the last
+    must have the same length. The index is saved next to the FASTA file and is remade if the file is newer than it.'''
+    extension = '.fai'
+    def __init__(self, entries = None):
+        if entries is None: entries = []
+        self.entries = entries #list of [name, length, offset, lineBases, lineWidth]
+    @classmethod
+    def build(cls, fastaPath):
+        '''Version 1.0
+        Makes the index of a FASTA file by reading it once.'''
+        instance = cls()
+        offset, entry = 0, None
+        with open(fastaPath, 'rb') as handle:
+            for line in handle:
+                lineOffset, offset = offset, offset + len(line)
+                if line[0] == '>':
+                    if entry is not None: instance.entries.append(entry[:5])
+                    entry = [line[1:].split()[0] if line[1:].strip() else '', 0, offset, 0, 0, False] #the last field is true after a short line
+                    continue
+                if entry is None: continue #text before the first header
+                bases = len(line.rstrip('\r\n'))
+                if bases == 0:
+                    entry[5] = True
+                    continue
+                if entry[3] == 0: entry[3], entry[4] = bases, len(line)
+                elif entry[5] or bases > entry[3] or (bases == entry[3] and len(line) != entry[4]):
+                    raise InputValidationError('The sequence lines of "%s" in "%s" are not all the same length, so the file can not be indexed.' % (entry[0], fastaPath))
+                if bases < entry[3]: entry[5] = True
+                entry[1] += bases
+        if entry is not None: instance.entries.append(entry[:5])
+        return instance
+    def write(self, indexPath):
+        with open(indexPath, 'w') as handle:
+            for entry in self.entries: handle.write('%s\t%d\t%d\t%d\t%d\n' % tuple(entry))
+    @classmethod
+    def read(cls, indexPath):
+        instance = cls()
+        with open(indexPath, 'r') as handle:
+            for line in handle:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 5: raise InputValidationError('"%s" is not a FASTA index.' % indexPath)
+                instance.entries.append([fields[0]] + map(int, fields[1:5]))
+        return instance
+    @classmethod
+    def forFile(cls, fastaPath):
+        '''Version 1.0
+        Returns the index of a FASTA file, reading the saved index if it is current and otherwise making and saving a new one.
+        If the index can not be saved (e.g. the directory is read only), it is only kept in memory.'''
+        indexPath = fastaPath + cls.extension
+        if os.path.exists(indexPath) and os.path.getmtime(indexPath) >= os.path.getmtime(fastaPath):
+            try:
+                return cls.read(indexPath)
+            except (InputValidationError, ValueError): #a damaged index is remade
+                pass
+        index = cls.build(fastaPath)
+        try:
+            index.write(indexPath)
+        except IOError:
+            logging.warning('Could not save the FASTA index "%s"; it will be remade when next used.' % indexPath)
+        return index
+
+class IndexedFasta(object):
+    '''Version 1.0
+    Reads the sequences of a FASTA file through its index (see FastaIndex) from a memory map of the file, so only the parts of the
+    sequences that are used are read, and the operating system, not the process, holds the file in memory.'''
+    def __init__(self, path):
+        self.path, self.index = path, FastaIndex.forFile(path)
+        self.entries = dict([(entry[0], entry) for entry in self.index.entries])
+        self.handle = open(path, 'rb')
+        self.data = mmap.mmap(self.handle.fileno(), 0, access = mmap.ACCESS_READ) if os.path.getsize(path) > 0 else ''
+    def references(self):
+        '''Returns the (name, length) of each sequence in file order.'''
+        return [(entry[0], entry[1]) for entry in self.index.entries]
+    def _entry(self, name):
+        try:
+            return self.entries[name]
+        except KeyError:
+            raise InputValidationError('"%s" is not the name of a sequence in "%s".' % (name, self.path))
+    def length(self, name):
+        return self._entry(name)[1]
+    def fetch(self, name, start = 1, end = None):
+        '''Returns the bases of a sequence between the positions specified (one based and inclusive; Default: the whole sequence).'''
+        name, length, offset, lineBases, lineWidth = self._entry(name)
+        start = max(start, 1)
+        if end is None or end > length: end = length
+        if end < start: return ''
+        byteOffset = lambda index: offset + index // lineBases * lineWidth + index % lineBases
+        return self.data[byteOffset(start - 1) : byteOffset(end - 1) + 1].translate(None, '\r\n')
+    def alignment(self, name):
+        '''Returns a sequence as a ReferenceAlignment.'''
+        return ReferenceAlignment(self, name)
+    def close(self):
+        if self.data != '': self.data.close()
+        self.handle.close()
+
+class PileupCache(object):
+    '''Version 1.0
+    The parsed pileups of a SAM file saved next to it as arrays that are memory mapped when read, so reading the file again (e.g. when
+    alignreads is rerun on the same YASRA output) loads the arrays instead of parsing every read. The ReadStore of each pileup is saved
+    with the insertion columns and symbol counts of all its reads (see ReadStore.columnCache), so padding the pileup and counting it
+    again are not repeated either while none of its reads are removed or changed. The cache is only used if it is newer than the
+    SAM file and the size and modification time of the file are those it was made from.'''
+    extension = '.pileups'
+    formatVersion = '2'
+    storeArrays = ('starts', 'flags', 'mappingQualities', 'mateStarts', 'cigarOperations', 'cigarLengths', 'cigarCounts', 'sequences', 'qualities',
+                   'sequenceLengths', 'sequenceStarts', 'templateLengths')
+    storeLists = ('ids', 'references', 'mates', 'tags') #saved as text, one line per row
+    noneText = '\x00'
+    def __init__(self, samPath):
+        self.samPath = samPath
+        self.directory = samPath + self.extension
+        self.indexPath = os.path.join(self.directory, 'index.txt')
+    def isCurrent(self):
+        try:
+            with open(self.indexPath, 'r') as handle:
+                header = handle.readline().rstrip('\n').split('\t')
+            cacheTime = os.path.getmtime(self.indexPath)
+        except (IOError, OSError):
+            return False
+        status = os.stat(self.samPath)
+        return header == ['#readtools pileup cache', str(status.st_size), str(int(status.st_mtime)), self.formatVersion] and cacheTime >= status.st_mtime
+    @staticmethod
+    def _path(directory, index, name):
+        return os.path.join(directory, '%d.%s' % (index, name))
+    def read(self):
+        '''Version 1.0
+        Yields the unpadded Pileup of each reference in the order of the SAM file, with the column cache of its ReadStore set.'''
+        with open(self.indexPath, 'r') as handle:
+            handle.readline()
+            entries = [line.rstrip('\n').split('\t') for line in handle]
+        for index, (rowCount, countsStart) in enumerate(entries):
+            arrays = {}
+            for name in self.storeArrays + ('insertionPositions', 'insertionWidths', 'columnCounts'):
+                arrayPath = self._path(self.directory, index, name + '.npy')
+                try:
+                    arrays[name] = np.load(arrayPath, mmap_mode = 'c')
+                except ValueError: #empty arrays can not be memory mapped
+                    arrays[name] = np.load(arrayPath)
+            lists = {}
+            for name in self.storeLists:
+                with open(self._path(self.directory, index, name + '.txt'), 'rb') as handle:
+                    lists[name] = [None if item == self.noneText else item for item in handle.read().split('\n')[:-1]]
+            store = ReadStore(lists['ids'], lists['references'], arrays['starts'], arrays['flags'], arrays['mappingQualities'], lists['mates'],
+                              arrays['mateStarts'], arrays['cigarOperations'], arrays['cigarLengths'], arrays['cigarCounts'], arrays['sequences'],
+                              arrays['qualities'], arrays['sequenceLengths'], lists['tags'], arrays['sequenceStarts'], arrays['templateLengths'])
+            store.columnCache = (InsertionColumns(arrays['insertionPositions'], arrays['insertionWidths']), ColumnCounts(arrays['columnCounts'], int(countsStart)))
+            yield Pileup(alignments = store.alignments(), padAlignments = False, name = store.references[0])
+    def write(self, pileups):
+        '''Version 1.1
+        Yields the unpadded pileups given (see PileupIO.readSam) as each is saved to a new cache, which replaces the current one when
+        all of them are saved. The column cache of the ReadStore of each pileup is set when it is saved. If the cache can not be saved
+        (e.g. the directory is read only), the pileups are still yielded.'''
+        status = os.stat(self.samPath)
+        temporaryDirectory = '%s.%d.tmp' % (self.directory, os.getpid())
+        entries, saving = [], True
+        try:
+            if os.path.exists(temporaryDirectory): shutil.rmtree(temporaryDirectory)
+            os.mkdir(temporaryDirectory)
+        except OSError:
+            saving = False
+        try:
+            for index, pileup in enumerate(pileups):
+                storeRows = PileupAlignmentView.storeRows(pileup.alignments)
+                if storeRows is None or len(storeRows[1]) != len(storeRows[0]): saving = False
+                if saving:
+                    store = storeRows[0]
+                    store.compactCigars() #the cache rebuilds cigarStarts from cigarCounts
+                    insertionColumns = store.insertionColumns()
+                    store.columnCache = (insertionColumns, store.columnCounts(None, insertionColumns))
+                    try:
+                        for name in self.storeArrays:
+                            np.save(self._path(temporaryDirectory, index, name + '.npy'), np.asarray(getattr(store, name)))
+                        np.save(self._path(temporaryDirectory, index, 'insertionPositions.npy'), insertionColumns.positions)
+                        np.save(self._path(temporaryDirectory, index, 'insertionWidths.npy'), insertionColumns.widths)
+                        np.save(self._path(temporaryDirectory, index, 'columnCounts.npy'), store.columnCache[1].counts)
+                        for name in self.storeLists:
+                            with open(self._path(temporaryDirectory, index, name + '.txt'), 'wb') as handle:
+                                handle.write(''.join([(self.noneText if item is None else item) + '\n' for item in getattr(store, name)]))
+                        entries.append((len(store), store.columnCache[1].start))
+                    except (IOError, OSError):
+                        saving = False
+                yield pileup
+            if saving:
+                try:
+                    with open(os.path.join(temporaryDirectory, 'index.txt'), 'w') as handle:
+                        handle.write('#readtools pileup cache\t%d\t%d\t%s\n' % (status.st_size, int(status.st_mtime), self.formatVersion))
+                        for rowCount, countsStart in entries: handle.write('%d\t%d\n' % (rowCount, countsStart))
+                    if os.path.exists(self.directory): shutil.rmtree(self.directory)
+                    os.rename(temporaryDirectory, self.directory)
+                except (IOError, OSError):
+                    saving = False
+        finally:
+            if os.path.exists(temporaryDirectory): shutil.rmtree(temporaryDirectory, ignore_errors = True)
+        if not saving:
+            logging.warning('Could not save the pileup cache "%s"; "%s" will be parsed again when next read.' % (self.directory, self.samPath))
+
+class BgzfReader(object):
+    '''Version 1.0
+    Reads the decompressed data of a BGZF file (the blocked gzip format of BAM files). Each block is a separate gzip member whose
+    compressed size is stored in its header, so blocks are read without decompressing them and are decompressed on a pool of
+    threads; zlib releases the global interpreter lock while it decompresses, so the threads run at the same time.'''
+    blocksPerTask = 16
+    def __init__(self, handleOrPath, threads = None):
+        if type(handleOrPath) == str: handleOrPath = open(handleOrPath, 'rb')
+        if threads is None: threads = multiprocessing.cpu_count()
+        self.handle, self.threads = handleOrPath, max(threads, 1)
+    def compressedBlocks(self):
+        '''Yields the compressed data and uncompressed size of each block, in file order.'''
+        while True:
+            header = self.handle.read(12)
+            if len(header) == 0: break
+            if len(header) < 12 or header[:4] != '\x1f\x8b\x08\x04':
+                raise InputValidationError('"%s" is not a BGZF file or is truncated.' % getattr(self.handle, 'name', self.handle))
+            extra = self.handle.read(struct.unpack('<H', header[10:12])[0])
+            offset, blockSize = 0, None
+            while offset + 4 <= len(extra):
+                subfieldId, subfieldLength = extra[offset : offset + 2], struct.unpack('<H', extra[offset + 2 : offset + 4])[0]
+                if subfieldId == 'BC': blockSize = struct.unpack('<H', extra[offset + 4 : offset + 6])[0] + 1
+                offset += 4 + subfieldLength
+            if blockSize is None: raise InputValidationError('A block of "%s" has no BGZF block size.' % getattr(self.handle, 'name', self.handle))
+            data = self.handle.read(blockSize - 12 - len(extra))
+            yield (data[:-8], struct.unpack('<I', data[-4:])[0])
+    @staticmethod
+    def inflate(block):
+        data, size = block
+        data = zlib.decompress(data, -15)
+        if len(data) != size: raise InputValidationError('A BGZF block decompressed to %d bytes instead of %d.' % (len(data), size))
+        return data
+    def blocks(self):
+        '''Yields the decompressed data of each block, in file order.'''
+        if self.threads == 1:
+            for block in self.compressedBlocks(): yield self.inflate(block)
+            return
+        pool = ThreadPool(self.threads)
+        try:
+            for data in pool.imap(self.inflate, self.compressedBlocks(), chunksize = self.blocksPerTask): yield data
+        finally:
+            pool.terminate()
+
+class BgzfWriter(object):
+    '''Version 1.0
+    Writes data as BGZF blocks (see BgzfReader). The data is cut into blocks that are compressed on a pool of threads and written
+    in order. The file ends with the empty block that marks the end of a BGZF file.'''
+    blockSize = 0xff00 #leaves room for data that does not compress in a block of at most 64 kilobytes
+    blocksPerTask = 16
+    eofBlock = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+    def __init__(self, handleOrPath, threads = None, level = 6):
+        if type(handleOrPath) == str: handleOrPath = open(handleOrPath, 'wb')
+        if threads is None: threads = multiprocessing.cpu_count()
+        self.handle, self.threads, self.level = handleOrPath, max(threads, 1), level
+        self.parts, self.size, self.pending = [], 0, []
+        self.pool = ThreadPool(self.threads) if self.threads > 1 else None
+    def deflate(self, data):
+        '''Returns the BGZF block of a string of at most blockSize bytes.'''
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, ord('B'), ord('C'), 2, len(compressed) + 25)
+        return header + compressed + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= self.blockSize * self.blocksPerTask: self._compress(final = False)
+    def _compress(self, final):
+        '''Compresses the buffered data in whole blocks, and the last partial block if final is True.'''
+        data = ''.join(self.parts)
+        usable = len(data) if final else len(data) - len(data) % self.blockSize
+        blocks = [data[offset : offset + self.blockSize] for offset in range(0, usable, self.blockSize)]
+        self.parts, self.size = [data[usable:]], len(data) - usable
+        if self.pool is None:
+            for block in blocks: self.handle.write(self.deflate(block))
+            return
+        self.pending.append(self.pool.map_async(self.deflate, blocks))
+        while len(self.pending) > (0 if final else self.threads):
+            for block in self.pending.pop(0).get(): self.handle.write(block)
+    def flush(self):
+        '''Writes all of the data given so far, ending the last block early.'''
+        self._compress(final = True)
+    def close(self, writeEof = True):
+        self.flush()
+        if writeEof: self.handle.write(self.eofBlock)
+        self.handle.close()
+        if self.pool is not None: self.pool.terminate()
+
+bamFixedFields = np.dtype([('blockSize', '<i4'), ('referenceId', '<i4'), ('position', '<i4'), ('nameLength', 'u1'), ('mappingQuality', 'u1'),
+                           ('bin', '<u2'), ('cigarCount', '<u2'), ('flag', '<u2'), ('sequenceLength', '<i4'), ('mateReferenceId', '<i4'),
+                           ('matePosition', '<i4'), ('templateLength', '<i4')]) #the fixed length start of a BAM record
+bamBases = np.frombuffer('=ACMGRSVTWYHKDBN', dtype = np.uint8) #converts the 4 bit base codes of BAM sequences to characters
+bamBaseCodes = np.zeros(256, dtype = np.uint8) + 15 #converts characters to the 4 bit base codes of BAM sequences; other characters are 'N'
+for baseCode, base in enumerate(bamBases.tostring()): bamBaseCodes[ord(base)] = bamBaseCodes[ord(base.lower())] = baseCode
+bamTagFormats = {'c' : 'b', 'C' : 'B', 's' : 'h', 'S' : 'H', 'i' : 'i', 'I' : 'I', 'f' : 'f'} #struct formats of the numeric BAM tag types
+
+samTagPattern = re.compile('^[A-Za-z][A-Za-z0-9]$')
+
+def samTagsToBam(tags):
+    '''Version 1.0
+    Converts a dictionary of optional fields (see parseSamTags) to the binary fields of a BAM record. Integers, floats and strings
+    are stored as the types 'i' (or 'I' if too large), 'f' and 'Z'. Keys that are not two character tags are skipped.'''
+    data = []
+    for tag in sorted(tags.keys()):
+        if samTagPattern.match(tag) is None: continue #not an optional field (e.g. an annotation added by Biopython)
+        value = tags[tag]
+        if isinstance(value, bool) or isinstance(value, (int, long, np.integer)):
+            data.append(tag + ('i' + struct.pack('<i', value) if value < 2 ** 31 else 'I' + struct.pack('<I', value)))
+        elif isinstance(value, (float, np.floating)): data.append(tag + 'f' + struct.pack('<f', value))
+        else: data.append(tag + 'Z' + str(value) + '\x00')
+    return ''.join(data)
+
+def alignmentTagsToBam(alignment):
+    '''Version 1.0
+    Returns the binary optional fields of a BAM record for an alignment. The fields of an alignment read from a SAM or BAM file are
+    encoded from the text of the record (see samTextTagsToBam), so they keep their types and order; only the fields that were added
+    or changed since the record was read are typed from their values (see samTagsToBam).'''
+    samRecord = alignment.__dict__.get('samRecord')
+    if samRecord is None or len(samRecord.fields) < 12 or samRecord.fields[11] == '': return samTagsToBam(alignment.annotations)
+    text = samRecord.fields[11]
+    if alignment.__dict__.get('_annotations') is None: return samTextTagsToBam(text) #the fields have not been decoded, so are unchanged
+    annotations, original = alignment.annotations, parseSamTags(text)
+    data = [samTextTagsToBam(field) for field in text.split('\t') if field[:2] in annotations and annotations[field[:2]] == original[field[:2]]]
+    changed = dict([(tag, value) for tag, value in annotations.iteritems() if tag not in original or original[tag] != value])
+    return ''.join(data) + samTagsToBam(changed)
+
+def samTextTagsToBam(text):
+    '''Version 1.0
+    Converts the tab-delimited optional fields of a SAM line to the binary fields of a BAM record, keeping their types.'''
+    data = []
+    for field in text.split('\t'):
+        tag, valueType, value = field.split(':', 2)
+        if valueType == 'i':
+            value = int(value)
+            data.append(tag + ('I' + struct.pack('<I', value) if value >= 2 ** 31 else 'i' + struct.pack('<i', value)))
+        elif valueType == 'f': data.append(tag + 'f' + struct.pack('<f', float(value)))
+        elif valueType == 'A': data.append(tag + 'A' + value[:1])
+        elif valueType in 'ZH': data.append(tag + valueType + value + '\x00')
+        elif valueType == 'B':
+            values = value.split(',')
+            subtype, values = values[0], values[1:]
+            convert = float if subtype == 'f' else int
+            data.append(tag + 'B' + subtype + struct.pack('<i%d%s' % (len(values), bamTagFormats[subtype]), len(values), *map(convert, values)))
+        else:
+            raise InputValidationError('Unknown SAM optional field type "%s" in tag "%s".' % (valueType, tag))
+    return ''.join(data)
+
+def bamBin(start, end):
+    '''Returns the BAM index bin of the zero based, half open range of reference positions specified.'''
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if start >> shift == end >> shift: return offset + (start >> shift)
+    return 0
+
+class BamTagData(str):
+    '''The binary optional fields of a BAM record, kept undecoded until they are parsed (see parseSamTags).'''
+    pass
+
+def bamTagsToSam(data):
+    '''Version 1.0
+    Converts the binary optional fields of a BAM record to the tab-delimited text of a SAM line.'''
+    fields, offset = [], 0
+    while offset < len(data):
+        tag, valueType = data[offset : offset + 2], data[offset + 2]
+        offset += 3
+        if valueType == 'A':
+            fields.append('%s:A:%s' % (tag, data[offset]))
+            offset += 1
+        elif valueType in bamTagFormats:
+            valueFormat = '<' + bamTagFormats[valueType]
+            value = struct.unpack_from(valueFormat, data, offset)[0]
+            fields.append('%s:%s:%s' % (tag, 'f' if valueType == 'f' else 'i', repr(value) if valueType == 'f' else value))
+            offset += struct.calcsize(valueFormat)
+        elif valueType in 'ZH':
+            end = data.index('\x00', offset)
+            fields.append('%s:%s:%s' % (tag, valueType, data[offset:end]))
+            offset = end + 1
+        elif valueType == 'B':
+            subtype, count = data[offset], struct.unpack_from('<i', data, offset + 1)[0]
+            valueFormat = '<%d%s' % (count, bamTagFormats[subtype])
+            values = struct.unpack_from(valueFormat, data, offset + 5)
+            fields.append('%s:B:%s' % (tag, ','.join([subtype] + map(str, values))))
+            offset += 5 + struct.calcsize(valueFormat)
+        else:
+            raise InputValidationError('Unknown BAM optional field type "%s" in tag "%s".' % (valueType, tag))
+    if len(fields) == 0: return None
+    return '\t'.join(fields)
+
+class BamReader(object):
+    '''Version 1.0
+    Reads a BAM file without samtools. Blocks are decompressed by a BgzfReader and the records of each stretch of decompressed data
+    are decoded together with numpy into the columns of a ReadStore, so neither a text line nor a SamRecord is made for each read.
+    SamRecords can still be made from the columns for code that works one record at a time (see samRecords).'''
+    batchSize = 4 * 1024 * 1024 #bytes of decompressed records decoded at once
+    def __init__(self, handleOrPath, threads = None):
+        self.bgzf = BgzfReader(handleOrPath, threads)
+        self.blocks = self.bgzf.blocks()
+        self.buffer = ''
+        if self.read(4) != 'BAM\x01': raise InputValidationError('"%s" is not a BAM file.' % getattr(self.bgzf.handle, 'name', self.bgzf.handle))
+        self.headerText = self.read(struct.unpack('<i', self.read(4))[0]).rstrip('\x00')
+        self.references, self.referenceLengths = [], []
+        for index in range(struct.unpack('<i', self.read(4))[0]):
+            self.references.append(self.read(struct.unpack('<i', self.read(4))[0]).rstrip('\x00'))
+            self.referenceLengths.append(struct.unpack('<i', self.read(4))[0])
+    def _fill(self, size):
+        '''Adds decompressed blocks to the buffer until it holds at least size bytes or the file ends.'''
+        parts = [self.buffer]
+        length = len(self.buffer)
+        for data in self.blocks:
+            parts.append(data)
+            length += len(data)
+            if length >= size: break
+        self.buffer = ''.join(parts)
+    def read(self, size):
+        if len(self.buffer) < size: self._fill(size)
+        if len(self.buffer) < size: raise InputValidationError('The BAM file "%s" is truncated.' % getattr(self.bgzf.handle, 'name', self.bgzf.handle))
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+    def batches(self):
+        '''Yields stretches of decompressed data holding whole records, with the offset of each record in the stretch.'''
+        while True:
+            self._fill(self.batchSize)
+            data, offset, offsets = self.buffer, 0, []
+            while offset + 4 <= len(data):
+                end = offset + 4 + struct.unpack_from('<i', data, offset)[0]
+                if end > len(data): break
+                offsets.append(offset)
+                offset = end
+            if len(offsets) == 0:
+                if len(data) > 0: raise InputValidationError('The BAM file "%s" is truncated.' % getattr(self.bgzf.handle, 'name', self.bgzf.handle))
+                return
+            self.buffer = data[offset:]
+            yield (data, np.array(offsets, dtype = np.int64))
+    def decode(self, data, offsets):
+        '''Version 1.0
+        Decodes the records at the offsets of a stretch of data into a dictionary of ReadStore columns (see ReadStore.__init__),
+        plus the reference index of each record.'''
+        raw = np.frombuffer(data, dtype = np.uint8)
+        fixedSize = bamFixedFields.itemsize
+        fixed = raw[(offsets[:, np.newaxis] + np.arange(fixedSize)).ravel()].view(bamFixedFields)
+        nameStarts = offsets + fixedSize
+        cigarStarts = nameStarts + fixed['nameLength']
+        cigarCounts = fixed['cigarCount'].astype(np.int64)
+        sequenceStarts = cigarStarts + 4 * cigarCounts
+        sequenceLengths = fixed['sequenceLength'].astype(np.int64)
+        packedLengths = (sequenceLengths + 1) // 2
+        qualityStarts = sequenceStarts + packedLengths
+        tagStarts = qualityStarts + sequenceLengths
+        recordEnds = offsets + 4 + fixed['blockSize']
+        cigar = raw[expandRuns(cigarStarts, 4 * cigarCounts)].view('<u4')
+        packed = raw[expandRuns(sequenceStarts, packedLengths)]
+        bases = np.empty(2 * len(packed), dtype = np.uint8)
+        bases[0::2], bases[1::2] = packed >> 4, packed & 15
+        bases = bamBases[bases[expandRuns(2 * (np.cumsum(packedLengths) - packedLengths), sequenceLengths)]] #drops the unused half byte of odd lengths
+        qualities = raw[expandRuns(qualityStarts, sequenceLengths)].copy()
+        missing = np.repeat(raw[np.minimum(qualityStarts, len(raw) - 1)] == 255, sequenceLengths) #a missing quality string is stored as 255s
+        qualities[missing] = ReadStore.missingQuality
+        referenceIds, mateReferenceIds = fixed['referenceId'], fixed['mateReferenceId']
+        def referenceName(referenceId): return self.references[referenceId] if referenceId >= 0 else None
+        return {'referenceIds' : referenceIds,
+                'ids' : [data[start : start + length - 1] for start, length in zip(nameStarts.tolist(), fixed['nameLength'].tolist())],
+                'references' : [referenceName(referenceId) for referenceId in referenceIds.tolist()],
+                'starts' : fixed['position'].astype(np.int64) + 1, 'flags' : fixed['flag'], 'mappingQualities' : fixed['mappingQuality'],
+                'mates' : [('=' if mateId == referenceId else referenceName(mateId)) if mateId >= 0 else None
+                           for mateId, referenceId in zip(mateReferenceIds.tolist(), referenceIds.tolist())],
+                'mateStarts' : fixed['matePosition'].astype(np.int64) + 1, 'templateLengths' : fixed['templateLength'],
+                'cigarOperations' : (cigar & 15).astype(np.uint8), 'cigarLengths' : (cigar >> 4).astype(np.int64), 'cigarCounts' : cigarCounts,
+                'sequences' : bases, 'qualities' : qualities, 'sequenceLengths' : sequenceLengths,
+                'tags' : [BamTagData(data[start:end]) if end > start else None for start, end in zip(tagStarts.tolist(), recordEnds.tolist())]}
+    storeColumns = ('ids', 'references', 'starts', 'flags', 'mappingQualities', 'mates', 'mateStarts', 'cigarOperations', 'cigarLengths', 'cigarCounts',
+                    'sequences', 'qualities', 'sequenceLengths', 'tags', 'templateLengths') #the arguments of ReadStore.__init__
+    def readStores(self):
+        '''Version 1.0
+        Yields a ReadStore of each run of consecutive records aligned to the same reference.'''
+        parts = []
+        def makeStore():
+            return ReadStore(**dict([(name, np.concatenate([part[name] for part in parts]) if isinstance(parts[0][name], np.ndarray) else sum([part[name] for part in parts], []))
+                                     for name in self.storeColumns]))
+        for data, offsets in self.batches():
+            columns = self.decode(data, offsets)
+            breaks = (np.nonzero(np.diff(columns['referenceIds']))[0] + 1).tolist()
+            for start, end in zip([0] + breaks, breaks + [len(offsets)]):
+                if len(parts) > 0 and parts[-1]['referenceIds'][-1] != columns['referenceIds'][start]:
+                    yield makeStore()
+                    parts = []
+                parts.append(self.sliceColumns(columns, start, end))
+        if len(parts) > 0: yield makeStore()
+    @staticmethod
+    def sliceColumns(columns, start, end):
+        '''Returns the columns of the records from start to end (exclusive).'''
+        cigarBefore, sequenceBefore = columns['cigarCounts'][:start].sum(), columns['sequenceLengths'][:start].sum()
+        cigarEnd, sequenceEnd = cigarBefore + columns['cigarCounts'][start:end].sum(), sequenceBefore + columns['sequenceLengths'][start:end].sum()
+        output = {}
+        for name, values in columns.iteritems():
+            if name in ('cigarOperations', 'cigarLengths'): output[name] = values[cigarBefore:cigarEnd]
+            elif name in ('sequences', 'qualities'): output[name] = values[sequenceBefore:sequenceEnd]
+            else: output[name] = values[start:end]
+        return output
+    def samRecords(self):
+        '''Version 1.0
+        Yields a SamRecord of each record, made from the decoded columns rather than from text.'''
+        for data, offsets in self.batches():
+            columns = self.decode(data, offsets)
+            cigarStarts = (np.cumsum(columns['cigarCounts']) - columns['cigarCounts']).tolist()
+            sequenceStarts = (np.cumsum(columns['sequenceLengths']) - columns['sequenceLengths']).tolist()
+            operations, lengths = columns['cigarOperations'].tolist(), columns['cigarLengths'].tolist()
+            sequences = columns['sequences'].tostring()
+            qualities = (columns['qualities'] + np.uint8(ord(phredConversion['sanger'][0]))).tostring()
+            missing = columns['qualities'] == ReadStore.missingQuality
+            for row, (cigarStart, cigarCount, sequenceStart, sequenceLength) in enumerate(zip(cigarStarts, columns['cigarCounts'].tolist(), sequenceStarts, columns['sequenceLengths'].tolist())):
+                cigar = ''.join(['%d%s' % (lengths[index], cigarOperations[operations[index]]) for index in range(cigarStart, cigarStart + cigarCount)])
+                quality = qualities[sequenceStart : sequenceStart + sequenceLength]
+                fields = [columns['ids'][row], str(columns['flags'][row]), columns['references'][row] or '*', str(columns['starts'][row]),
+                          str(columns['mappingQualities'][row]), cigar or '*', columns['mates'][row] or '*', str(columns['mateStarts'][row]),
+                          str(columns['templateLengths'][row]), sequences[sequenceStart : sequenceStart + sequenceLength] or '*',
+                          '*' if sequenceLength == 0 or missing[sequenceStart] else quality]
+                if columns['tags'][row] is not None: fields.append(bamTagsToSam(columns['tags'][row]))
+                samRecord = SamRecord.__new__(SamRecord)
+                samRecord.fields, samRecord.qualityEncoding = fields, 'sanger'
+                yield samRecord
+
+class BamWriter(object):
+    '''Version 1.1
+    Writes alignments to a BGZF compressed BAM file. The references of the header can be given when the writer is made, or added
+    while alignments are written (see addReference) when they are only known once their alignments have been made; the records
+    are then held in a temporary file next to the output until close puts the header in front of them. The header says the file
+    is sorted by coordinate: each call to write sorts its alignments by reference and position, and the alignments of a call must
+    not come before those already written (e.g. the alignments of each reference are written in the order of the references).'''
+    rowsPerChunk = 16384 #the number of ReadStore rows encoded together (see encodeRows)
+    unplacedId = 1 << 31 #sorts unplaced alignments after those of every reference
+    def __init__(self, path, references = None, threads = None, level = 6, headerText = None):
+        self.path, self.threads, self.level, self.headerText = path, threads, level, headerText
+        self.lastPosition = (-1, 0) #the (reference index, start) of the last alignment written
+        self.references, self.referenceIndexes = [], {}
+        if references is not None:
+            for name, length in references: self.addReference(name, length)
+            self.recordPath = None
+            self.bgzf = BgzfWriter(path, threads, level)
+            self.bgzf.write(self.header())
+        else:
+            self.recordPath = path + '.records.tmp'
+            self.bgzf = BgzfWriter(self.recordPath, threads, level)
+    def addReference(self, name, length):
+        if self.__dict__.get('recordPath', True) is None: raise ValueError('The header of "%s" has already been written.' % self.path)
+        self.referenceIndexes[name] = len(self.references)
+        self.references.append((name, length))
+    def header(self):
+        if self.headerText is None:
+            text = '@HD\tVN:1.6\tSO:coordinate\n' + ''.join(['@SQ\tSN:%s\tLN:%d\n' % reference for reference in self.references])
+        else: text = self.headerText
+        data = ['BAM\x01', struct.pack('<i', len(text)), text, struct.pack('<i', len(self.references))]
+        for name, length in self.references: data += [struct.pack('<i', len(name) + 1), name + '\x00', struct.pack('<i', length)]
+        return ''.join(data)
+    def referenceIndex(self, name):
+        if name is None: return -1
+        return self.referenceIndexes[name]
+    def encode(self, alignment):
+        '''Version 1.1
+        Returns the BAM record of an alignment. The optional fields keep the types they were read with (see alignmentTagsToBam).'''
+        referenceId = self.referenceIndex(alignment.reference)
+        position = alignment.start - 1 if alignment.start else -1
+        operations = cigarPattern.findall(alignment.cigar) if alignment.cigar else []
+        cigar = np.array([int(length) << 4 | cigarOperations.index(letter) for length, letter in operations], dtype = '<u4')
+        referenceLength = sum([int(length) for length, letter in operations if letter in 'MDN=X'])
+        sequence = str(alignment.seq) if alignment.seq is not None else ''
+        if sequence == '*': sequence = ''
+        codes = bamBaseCodes[np.frombuffer(sequence, dtype = np.uint8)]
+        if len(codes) % 2 == 1: codes = np.concatenate((codes, [0]))
+        qualities = alignment.letter_annotations.get('phred_quality')
+        if qualities is None: qualities = '\xff' * len(sequence)
+        else: qualities = np.asarray(qualities, dtype = np.uint8).tostring()
+        tags = None
+        if isinstance(alignment, PileupAlignmentView) and '_annotations' not in alignment.__dict__: tags = alignment.store.tags[alignment.row]
+        if tags is None: tags = alignmentTagsToBam(alignment)
+        elif not isinstance(tags, BamTagData): tags = samTextTagsToBam(tags)
+        mate = alignment.mate
+        if mate == '=': mateId = referenceId
+        else: mateId = self.referenceIndexes.get(mate, -1)
+        name = alignment.id + '\x00'
+        fixed = struct.pack('<iiBBHHHiiii', referenceId, position, len(name), min(alignment.quality if alignment.quality is not None else 255, 255),
+                            bamBin(position, position + max(referenceLength, 1)) if position >= 0 else 4680, len(cigar), alignment.flag or 0,
+                            len(sequence), mateId, alignment.mateStart - 1 if alignment.mateStart else -1, getattr(alignment, 'templateLength', 0))
+        record = ''.join([fixed, name, cigar.tostring(), (codes[0::2] << 4 | codes[1::2]).astype(np.uint8).tostring(), qualities, tags])
+        return struct.pack('<i', len(record)) + record
+    def encodeRows(self, store, rows):
+        '''Version 1.0
+        Returns the BAM records of rows of a ReadStore as one string. The fields of every row are encoded together, which is much
+        faster than encoding views of the rows one at a time.'''
+        rows = np.asarray(rows, dtype = np.int64)
+        rowList = rows.tolist()
+        names = [store.ids[row] + '\x00' for row in rowList]
+        tags = []
+        for row in rowList:
+            tag = store.tags[row]
+            if tag is None: tags.append('')
+            elif isinstance(tag, BamTagData): tags.append(tag)
+            else: tags.append(samTextTagsToBam(tag))
+        ##Cigar strings, sequences packed two bases per byte and qualities
+        operationIndexes = store._operationIndexes(rows)
+        cigars = store.cigarLengths[operationIndexes].astype('<u4') << 4 | store.cigarOperations[operationIndexes].astype('<u4')
+        sequenceLengths = store.sequenceLengths[rows]
+        basePositions = expandRuns(store.sequenceStarts[rows], sequenceLengths)
+        packedLengths = (sequenceLengths + 1) // 2
+        paddedOffsets = np.cumsum(2 * packedLengths) - 2 * packedLengths
+        codes = np.zeros(2 * packedLengths.sum(), dtype = np.uint8)
+        codes[expandRuns(paddedOffsets, sequenceLengths)] = bamBaseCodes[store.sequences[basePositions]]
+        packed = codes[0::2] << 4 | codes[1::2]
+        ##Fixed length fields
+        referenceIds = np.array([self.referenceIndex(store.references[row]) for row in rowList], dtype = np.int64)
+        mates = [store.mates[row] for row in rowList]
+        mateIds = np.array([referenceId if mate == '=' else self.referenceIndexes.get(mate, -1) for referenceId, mate in zip(referenceIds.tolist(), mates)], dtype = np.int64)
+        positions = np.where(store.starts[rows] > 0, store.starts[rows] - 1, -1)
+        lastPositions = positions + np.maximum(store.referenceLengths[rows], 1) - 1
+        bins = np.zeros(len(rows), dtype = np.int64)
+        binned = positions < 0
+        bins[binned] = 4680
+        for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+            inBin = ~binned & (positions >> shift == lastPositions >> shift)
+            bins[inBin] = offset + (positions[inBin] >> shift)
+            binned |= inBin
+        nameLengths = np.array(map(len, names), dtype = np.int64)
+        tagLengths = np.array(map(len, tags), dtype = np.int64)
+        cigarCounts = store.cigarCounts[rows]
+        fixed = np.zeros(len(rows), dtype = bamFixedFields)
+        fixed['blockSize'] = bamFixedFields.itemsize - 4 + nameLengths + 4 * cigarCounts + packedLengths + sequenceLengths + tagLengths
+        fixed['referenceId'], fixed['position'], fixed['nameLength'] = referenceIds, positions, nameLengths
+        fixed['mappingQuality'] = np.clip(store.mappingQualities[rows], 0, 255)
+        fixed['bin'], fixed['cigarCount'], fixed['flag'], fixed['sequenceLength'] = bins, cigarCounts, store.flags[rows], sequenceLengths
+        fixed['mateReferenceId'] = mateIds
+        fixed['matePosition'] = np.where(store.mateStarts[rows] > 0, store.mateStarts[rows] - 1, -1)
+        fixed['templateLength'] = store.templateLengths[rows]
+        ##Interleave the parts of the records
+        partBuffers = [fixed.view(np.uint8), np.frombuffer(''.join(names), dtype = np.uint8), cigars.view(np.uint8), packed,
+                       store.qualities[basePositions], np.frombuffer(''.join(tags), dtype = np.uint8)]
+        partLengths = [np.zeros(len(rows), dtype = np.int64) + bamFixedFields.itemsize, nameLengths, 4 * cigarCounts, packedLengths, sequenceLengths, tagLengths]
+        bufferOffsets = np.cumsum([0] + [len(buffer) for buffer in partBuffers])
+        partStarts = np.column_stack([bufferOffset + np.cumsum(lengths) - lengths for bufferOffset, lengths in zip(bufferOffsets, partLengths)]).ravel()
+        return np.concatenate(partBuffers)[expandRuns(partStarts, np.column_stack(partLengths).ravel())].tostring()
+    def checkOrder(self, firstPosition, lastPosition):
+        '''Version 1.0
+        Raises a ValueError if the first (reference index, start) of a call to write comes before the last one already written.'''
+        if firstPosition < self.lastPosition:
+            raise ValueError('The alignments written to "%s" are not sorted: (reference %d, position %d) follows (reference %d, position %d).' %
+                             (self.path, firstPosition[0], firstPosition[1], self.lastPosition[0], self.lastPosition[1]))
+        self.lastPosition = lastPosition
+    def write(self, alignments):
+        '''Version 1.2
+        Writes alignments sorted by reference (in the order of the header) and position; unplaced alignments are written last.
+        Alignments that are all views of one ReadStore are encoded together (see encodeRows). A ValueError is raised if the
+        alignments come before those written by an earlier call, since the file would not be sorted.'''
+        if len(alignments) == 0: return
+        storeRows = PileupAlignmentView.storeRows(alignments)
+        if storeRows is None or any(['_annotations' in alignment.__dict__ for alignment in alignments]):
+            def sortKey(alignment):
+                referenceId = self.referenceIndex(alignment.reference)
+                if referenceId < 0: return (self.unplacedId, 0)
+                return (referenceId, alignment.start)
+            alignments = sorted(alignments, key = sortKey)
+            self.checkOrder(sortKey(alignments[0]), sortKey(alignments[-1]))
+            for alignment in alignments: self.bgzf.write(self.encode(alignment))
+            return
+        store, rows = storeRows
+        referenceIds = np.array([self.referenceIndex(store.references[row]) for row in rows.tolist()], dtype = np.int64)
+        unplaced = referenceIds < 0
+        referenceIds[unplaced] = self.unplacedId
+        starts = np.where(unplaced, 0, store.starts[rows])
+        order = np.lexsort((starts, referenceIds))
+        rows = rows[order]
+        self.checkOrder((int(referenceIds[order[0]]), int(starts[order[0]])), (int(referenceIds[order[-1]]), int(starts[order[-1]])))
+        for chunkStart in range(0, len(rows), self.rowsPerChunk):
+            self.bgzf.write(self.encodeRows(store, rows[chunkStart : chunkStart + self.rowsPerChunk]))
+    def close(self):
+        if self.recordPath is None:
+            self.bgzf.close()
+            return
+        self.bgzf.close(writeEof = False)
+        self.bgzf = BgzfWriter(self.path, self.threads, self.level)
+        self.bgzf.write(self.header())
+        self.bgzf.flush()
+        with open(self.recordPath, 'rb') as records: shutil.copyfileobj(records, self.bgzf.handle)
+        os.remove(self.recordPath)
+        self.recordPath = None
+        self.bgzf.close()
+
 class AlignmentIO:
-    '''Version 1.0'''
+    '''Version 1.1'''
     @classmethod
     def parseSam(cls, text, qualityEncoding = None):
-        '''Verison 1.1
-        Alternate constructor function that makes an instance of alignment using the information from a sam file or string in sam format.'''
-        if qualityEncoding == None:
-            qualityEncoding = 'sanger'
-        attributeOrder = ['id', 'flag', 'reference', 'start', 'quality', 'cigar', 'mate', 'mateStart'] #names of alignment atrributes in the order they appear in a sam file
-        attributeType = [str, int, str, int, int, str, str, int]
-        optionalTypeParsingFuncs = {'A':str, 'i':int, 'f':float, 'Z':str, 'H':str, 'B': str}
-        data = text.strip().split('\t')
-        for index in range(0,len(data)):
-            if data[index] == '*':
-                data[index] = None            
-        kwargDict = {}
-        seq = Seq(data[9])
-        for attrName, attrType, columnData in zip(attributeOrder, attributeType, data[:8]):
-            kwargDict[attrName] = attrType(columnData)
-        if data[10] is not None:
-            try:
-                kwargDict['letter_annotations'] = {'phred_quality' : [phredConversion[qualityEncoding].index(score) for score in data[10]]}
-            except ValueError:
-                errorChars = ''.join([char for char in data[10] if char not in phredConversion[qualityEncoding]])
-                raise ValueError('Cant parse quality sequence from read "%s": "%s". The following characters are invalid: %s' % (data[0], data[10], errorChars))
-        kwargDict['annotations'] = {}
-        for option in data[11:]:
-            tag, optionType, value = option.split(':')
-            kwargDict['annotations'][tag] = optionalTypeParsingFuncs[optionType](value)
-        return Alignment(seq, **kwargDict)
+        '''Verison 1.2
+        Alternate constructor function that makes an instance of alignment using the information from a sam file or string in sam format.
+        Optional fields and base qualities are decoded when they are first used.'''
+        return Alignment.fromSamRecord(SamRecord(text, qualityEncoding))
     @classmethod
-    def readSamFile(cls, path, qualityEncoding = None):
-        '''Version 1.1'''
-        with open(path, 'r') as handle:
-            for line in handle: 
+    def readSamRecords(cls, path, qualityEncoding = None):
+        '''Version 1.0
+        Returns the SamRecord of each alignment in a sam file, skipping the header.'''
+        with open(path, 'rb') as handle:
+            for line in handle:
                 if line[0] != '@':
+                    yield SamRecord(line, qualityEncoding)
                     break
-            yield AlignmentIO.parseSam(line, qualityEncoding = qualityEncoding)
             for line in handle:
-                yield AlignmentIO.parseSam(line, qualityEncoding = qualityEncoding)
+                yield SamRecord(line, qualityEncoding)
     @classmethod
-    def readBamFile(cls, path, qualityEncoding = None):
-        '''Version 1.0'''
-        process = subprocess.Popen(['samtools','view', path], stdout=subprocess.PIPE)
-        while True:
-            line = process.stdout.readline()
-            if line != '':
-                yield AlignmentIO.parseSam(line, qualityEncoding = qualityEncoding)
-            else:
-                raise StopIteration
-                break
+    def readSamFile(cls, path, qualityEncoding = None):
+        '''Version 1.2'''
+        for samRecord in cls.readSamRecords(path, qualityEncoding = qualityEncoding):
+            yield Alignment.fromSamRecord(samRecord)
+    @classmethod
+    def readSamRange(cls, path, startOffset, endOffset, qualityEncoding = None):
+        '''Version 1.0
+        Returns the SamRecord of each alignment in the byte range of a sam file specified (e.g. a block of a SamIndex).'''
+        with open(path, 'rb') as handle:
+            handle.seek(startOffset)
+            offset = startOffset
+            while offset < endOffset:
+                line = handle.readline()
+                if line == '': break
+                offset += len(line)
+                if line.strip() != '': yield SamRecord(line, qualityEncoding)
+    @classmethod
+    def fetchSamRecords(cls, path, reference, start = None, end = None, qualityEncoding = None, index = None):
+        '''Version 1.0
+        Returns the SamRecord of each alignment to the reference that overlaps the region between start and end (inclusive,
+        Default: the whole reference). Only the parts of the file that can contain these records are read (see SamIndex).'''
+        if index is None: index = SamIndex.forFile(path)
+        for startOffset, endOffset, isSorted in index.chunks(reference, start, end):
+            for samRecord in cls.readSamRange(path, startOffset, endOffset, qualityEncoding):
+                if end is not None and samRecord.start > end:
+                    if isSorted: break
+                    continue
+                if start is not None and samRecord.end() < start: continue
+                yield samRecord
+    @classmethod
+    def fetch(cls, path, reference, start = None, end = None, qualityEncoding = None):
+        '''Version 1.0
+        Returns the alignments to the reference that overlap the region specified (see fetchSamRecords).'''
+        for samRecord in cls.fetchSamRecords(path, reference, start, end, qualityEncoding = qualityEncoding):
+            yield Alignment.fromSamRecord(samRecord)
+    @classmethod
+    def readBamFile(cls, path, qualityEncoding = None, threads = None):
+        '''Version 2.0
+        Reads a BAM file directly (see BamReader); samtools is not needed. BAM qualities are always phred scores, so the
+        quality encoding is ignored.'''
+        for samRecord in BamReader(path, threads).samRecords():
+            yield Alignment.fromSamRecord(samRecord)
     @classmethod
     def writeFastaPileup(cls, alignments, handle, spacer = '_', includeUnalignedSequence = False):
         '''Version 1.0
@@ -833,10 +2816,10 @@ class AlignmentIO:
                 print alignment.id, alignment.start, alignment.alignedStart(), alignment.end(), alignment.padding, alignment.cigar
                 unalignedStart = alignment.getUnalignedStart().lower()
                 unalignedEnd = alignment.getUnalignedEnd().lower()
-                sequence = unalignedStart + ''.join(alignment.alignedSeq()) + unalignedEnd
+                sequence = unalignedStart + alignment.paddedSequence() + unalignedEnd
                 offsetString = spacer * (alignment.alignedStart() - len(unalignedStart) + offsetCorrection)
             else:
-                sequence = ''.join(alignment.alignedSeq())
+                sequence = alignment.paddedSequence()
                 offsetString = spacer * (alignment.alignedStart() + offsetCorrection)
             handle.write('>%s\n%s%s\n' % (alignment.id, offsetString, sequence))                
     @classmethod
@@ -860,8 +2843,27 @@ class AlignmentIO:
             for record in SeqIO.parse(path, fileFormat):
                 yield Alignment.fromRecord(record)
     @classmethod
+    def writeBam(cls, alignments, path, references = None, threads = None):
+        '''Version 1.0
+        Writes alignments to a sorted BAM file (see BamWriter). The references are a list of (name, length); if they are not given, the
+        references of the alignments are used in the order they first appear, with the last position aligned to as their length.'''
+        alignments = list(alignments)
+        if references is None:
+            names, lengths = [], {}
+            for alignment in alignments:
+                if alignment.reference is None or alignment.cigar is None: continue
+                end = alignment.start + sum([int(length) for length, letter in cigarPattern.findall(alignment.cigar) if letter in 'MDN=X']) - 1
+                if alignment.reference not in lengths: names.append(alignment.reference)
+                lengths[alignment.reference] = max(lengths.get(alignment.reference, 0), end)
+            references = [(name, lengths[name]) for name in names]
+        writer = BamWriter(path, references, threads)
+        writer.write(alignments)
+        writer.close()
+    @classmethod
     def write(cls, alignments, handleOrPath, fileFormat, overwrite = False, includeUnalignedSequence = False):
-        '''Version 1.0'''
+        '''Version 1.1'''
+        if fileFormat.lower() == 'bam':
+            return cls.writeBam(alignments, handleOrPath)
         formatWriters = {'fasta-pileup' : cls.writeFastaPileup}
         if type(handleOrPath) == str:
             isHandle = True
@@ -920,28 +2922,70 @@ class PileupIO:
 
     @classmethod
     def readSam(cls, handle, applyPadding = True, alignPileups = True, group = True):
-        '''Version 1.0'''
-        ##Move past header
-        #line = handle.readline()
-        #while line != '' and line[0] == '@':
-        #    header.append(line)
-        #    line = handle.readline()
+        '''Version 1.1
+        The reads of each reference are held in a ReadStore; the alignments of each pileup are views of its rows.'''
+        def samRecords():
+            for line in handle:
+                if line[0] != '@':
+                    yield SamRecord(line)
+                    break
+            for line in handle:
+                yield SamRecord(line)
         ##Group alignments into pileups based on reference name 
-        pileupAlignments = []
-        headers = []
-        #for alignment in PileupAlignmentIO.readSamFile(handle):
-        for line in handle:
-            if line[0] == '@': headers.append(line)
-            else:
-                pileupAlignments.append(PileupAlignmentIO.parseSam(line))
-                break
-        for line in handle:
-            alignment = PileupAlignmentIO.parseSam(line)
-            if len(pileupAlignments) > 0 and alignment.reference != pileupAlignments[-1].reference:
-                yield Pileup(alignments = pileupAlignments, padAlignments = applyPadding,  name = pileupAlignments[0].reference)
-                pileupAlignments = []
-            pileupAlignments.append(alignment)
-        yield Pileup(alignments = pileupAlignments, padAlignments = applyPadding, name = pileupAlignments[0].reference)
+        for reference, referenceRecords in itertools.groupby(samRecords(), key = lambda samRecord: samRecord.fields[2]):
+            yield cls.fromSamRecords(referenceRecords, applyPadding)
+    @classmethod
+    def readBam(cls, handle, applyPadding = True, threads = None):
+        '''Version 1.0
+        Reads a BAM file into a Pileup of each run of reads aligned to the same reference. The records are decoded straight into
+        the ReadStore of each pileup (see BamReader).'''
+        for store in BamReader(handle, threads).readStores():
+            yield Pileup(alignments = store.alignments(), padAlignments = applyPadding, name = store.references[0])
+    @classmethod
+    def fromSamRecords(cls, samRecords, applyPadding = True, qualityEncoding = None):
+        '''Version 1.0
+        Makes a Pileup of SamRecords aligned to one reference, holding their data in a ReadStore.'''
+        store = ReadStore.fromSamRecords(samRecords, qualityEncoding)
+        return Pileup(alignments = store.alignments(), padAlignments = applyPadding, name = store.references[0])
+    @classmethod
+    def fetch(cls, path, reference, start = None, end = None, applyPadding = True, qualityEncoding = None, index = None):
+        '''Version 1.0
+        Returns a Pileup of the reads of a SAM file aligned to the reference that overlap the region between start and end
+        (inclusive, Default: the whole reference), reading only the parts of the file that contain them. Returns None if
+        there are no such reads.'''
+        samRecords = list(AlignmentIO.fetchSamRecords(path, reference, start, end, qualityEncoding = qualityEncoding, index = index))
+        if len(samRecords) == 0: return None
+        return cls.fromSamRecords(samRecords, applyPadding, qualityEncoding)
+    @classmethod
+    def readSamWindows(cls, samRecords, windowSize, applyPadding = True):
+        '''Version 1.0
+        Makes Pileups of consecutive windows of the reference from SamRecords sorted by reference and position, keeping only the
+        records that overlap the current window in memory. Yields (pileup, start, end) where start and end are the reference
+        positions the window covers (inclusive); a read spanning several windows is in the pileup of each. Windows start at the
+        first read and end at the last position covered by their reads, so reference positions between the end of one window
+        and the start of the next are not covered by any read. A window's reads that extend past its end are included, so the
+        consensus of the window should be limited to Pileup.paddedRegion(start, end).'''
+        def makeWindow(records, start, end):
+            end = min(end, max([record.end() for record in records]))
+            return (cls.fromSamRecords(records, applyPadding), start, end)
+        for reference, referenceRecords in itertools.groupby(samRecords, key = lambda samRecord: samRecord.fields[2]):
+            active, windowStart, lastStart = [], None, None
+            for samRecord in referenceRecords:
+                recordStart = samRecord.start
+                if lastStart is not None and recordStart < lastStart:
+                    raise InputValidationError('The alignments to "%s" are not sorted by position; windows require sorted input.' % reference)
+                lastStart = recordStart
+                if windowStart is None: windowStart = recordStart
+                while recordStart > windowStart + windowSize - 1: #the record starts after the current window
+                    if len(active) > 0: yield makeWindow(active, windowStart, windowStart + windowSize - 1)
+                    windowStart += windowSize
+                    active = [record for record in active if record.end() >= windowStart]
+                    if len(active) == 0: windowStart = max(windowStart, recordStart) #skips positions without reads
+                active.append(samRecord)
+            while len(active) > 0:
+                yield makeWindow(active, windowStart, windowStart + windowSize - 1)
+                windowStart += windowSize
+                active = [record for record in active if record.end() >= windowStart]
     @classmethod
     def readSamYasra(cls, handle, applyPadding = True):
         '''Version 1.0'''
@@ -982,13 +3026,31 @@ class PileupIO:
             del combinedPileup
         for pileup in pileups: yield pileup'''
     @classmethod
-    def parse(cls, handleOrPath, fileFormat, maxSize = None, applyPadding = True):
-        '''Version 1.0'''
-        formatParsers = {'sam' : cls.readSam, 'sam-yasra' : cls.readSamYasra}
+    def parse(cls, handleOrPath, fileFormat, maxSize = None, applyPadding = True, useCache = True, writeCache = False):
+        '''Version 1.2
+        The pileups of a SAM file given by its path are loaded from its PileupCache if it is current, unless useCache is False. If the
+        cache is not current, the pileups are only saved to a new one as they are parsed if writeCache is True. The cache holds every
+        read of the file, whatever read filters are applied to the pileups after they are parsed.'''
+        formatParsers = {'sam' : cls.readSam, 'sam-yasra' : cls.readSamYasra, 'bam' : cls.readBam}
         fileFormat = fileFormat.lower()
+        if type(handleOrPath) == str and fileFormat == 'sam' and useCache:
+            cache = PileupCache(handleOrPath)
+            handle = None
+            if cache.isCurrent():
+                pileups = cache.read()
+            elif writeCache:
+                handle = open(handleOrPath, 'r')
+                pileups = cache.write(cls.readSam(handle, False))
+            else: pileups = None
+            if pileups is not None:
+                for pileup in pileups:
+                    if applyPadding: pileup.padAlignments()
+                    yield pileup
+                if handle is not None: handle.close()
+                return
         if type(handleOrPath) == str:
             isHandle = True
-            handleOrPath = open(handleOrPath, 'r')
+            handleOrPath = open(handleOrPath, 'rb' if fileFormat == 'bam' else 'r')
         else:
             isHandle = False
         for pileup in formatParsers[fileFormat](handleOrPath, applyPadding):
@@ -1004,6 +3066,8 @@ class PileupIO:
         '''Version 1.0
         improvements to be made:
             make parsers for fastq and sam'''
+        if fileFormat.lower() == 'bam':
+            return AlignmentIO.writeBam([alignment for pileup in pileups for alignment in pileup.alignments], handleOrPath)
         formatWriters = {'fasta' : cls.writeFastaPileup}
         if type(handleOrPath) == str:
             isHandle = True
@@ -1025,24 +3089,251 @@ def dictToCommandLine(dictonary):
                 commandLine.append(value)
     return commandLine
 
+def copyProcessOutput(pipe, handle, logName, logLevel):
+    '''Copies the lines of an output pipe of a process to a file and to the log as they are written. Lines are read at most 64 KB at a
+    time, so a process that writes a lot of output, or very long lines, does not use more memory.'''
+    for line in iter(lambda: pipe.readline(1 << 16), ''):
+        handle.write(line)
+        logger.log(logLevel, '%s: %s' % (logName, line.rstrip('\n')))
+    pipe.close()
+
+def stopProcessGroup(process, gracePeriod = 5):
+    '''Stops a process started in its own process group, and the processes it started: they are asked to terminate, and are killed if
+    they are still running after gracePeriod seconds.'''
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        deadline = time.time() + gracePeriod
+        while process.poll() is None and time.time() < deadline: time.sleep(0.05)
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError: #every process of the group has exited
+        pass
+    process.wait()
+
+def runProcess(commandLine, outputPath, errorPath, cwd = None, timeout = None, logName = None, logLevel = logging.DEBUG):
+    '''Version 1.0
+    Runs a command line, saving its standard output and error in the files at outputPath and errorPath and logging each line with the
+    name given (Default: the name of the program) while the process is running. The output is not kept in memory. The process is run in
+    its own process group; if it does not finish in timeout seconds (Default: no limit), or the wait is interrupted (e.g. by Ctrl-C), the
+    process and every process it started are stopped, and ProcessFailure (or the interruption) is raised. Returns the return code.'''
+    if logName is None: logName = os.path.basename(commandLine[0])
+    outputHandle = open(outputPath, 'w')
+    errorHandle = open(errorPath, 'w')
+    try:
+        process = Popen(commandLine, stdout=PIPE, stderr=PIPE, cwd=cwd, preexec_fn=os.setsid, bufsize=-1) #buffered, so lines are not read a byte at a time
+        readers = [threading.Thread(target = copyProcessOutput, args = (pipe, handle, logName, logLevel))\
+                   for pipe, handle in ((process.stdout, outputHandle), (process.stderr, errorHandle))]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            while process.poll() is None:
+                if deadline is not None and time.time() > deadline:
+                    raise ProcessFailure('%s did not finish in %s seconds and was stopped.' % (logName, timeout))
+                time.sleep(0.05)
+        except:
+            logger.error('Stopping %s (process %d)...' % (logName, process.pid))
+            stopProcessGroup(process)
+            raise
+        finally:
+            for reader in readers: reader.join()
+    finally:
+        outputHandle.close()
+        errorHandle.close()
+    return process.returncode
+
 def runNucmer(queryPath, referencePath, nucmer_path='nucmer', mum=False, mumreference=False, maxmatch=False, breaklen=200, mincluster=65, nodelta=False, depend=False,\
               diagfactor=0.12, noextend=False, forward=False, maxgap=90, help=False, minmatch=20, coords=False, nooptimize=False, prefix='out',\
-              reverse=False, nosimplify=False, version=False):
-    '''Version 1.0'''
+              reverse=False, nosimplify=False, version=False, timeout=None):
+    '''Version 1.2
+    The standard output and error of nucmer are saved in the folder of the prefix as nucmer runs. Nucmer is stopped if it does not finish
+    in timeout seconds (Default: no limit).'''
     if mum == False and mumreference == False and maxmatch == False: mumreference = True #only one of the three options should be true
     options = locals()
-    del options['queryPath'], options['referencePath'], options['nucmer_path']
+    del options['queryPath'], options['referencePath'], options['nucmer_path'], options['timeout']
     options = dictToCommandLine(options)
     nucmerCmndLine = [nucmer_path] + options + [referencePath,queryPath] #USAGE: nucmer  [options]  <Reference>  <Query>
     logger.info("Running nucmer with the following command line:\n%s" % ' '.join(nucmerCmndLine))
-    nucmerStdOut = open(os.path.join(os.getcwd(),'nucmer_standard_output.txt'), 'w')
-    nucmerStdErr = open(os.path.join(os.getcwd(),'nucmer_standard_error.txt'), 'w')
-    nucmerProcess = Popen(nucmerCmndLine, stdout=PIPE, stderr=PIPE)
-    nucOutData, nucErrData = nucmerProcess.communicate()
-    nucmerProcess.wait()
-    nucmerStdOut.write(nucOutData)
-    nucmerStdErr.write(nucErrData)
-    nucmerStdOut.close()
-    nucmerStdErr.close()
-    if nucmerProcess.returncode != 0:
-        raise NucmerError('Nucmer returned a non-zero code; it may have not completed successfully')
+    outputDirectory = os.path.dirname(os.path.abspath(prefix))
+    try:
+        returnCode = runProcess(nucmerCmndLine, os.path.join(outputDirectory,'nucmer_standard_output.txt'), os.path.join(outputDirectory,'nucmer_standard_error.txt'),\
+                                timeout = timeout, logName = 'nucmer')
+    except ProcessFailure as error:
+        raise NucmerFailure(error.value)
+    if returnCode != 0:
+        raise NucmerFailure('Nucmer returned a non-zero code; it may have not completed successfully')
+
+fileDigests = {} #digests of files by path, size and modification time (see fileDigest)
+def fileDigest(filePath, chunkSize = 1 << 20):
+    '''Version 1.1
+    Returns the SHA-1 hex digest of the content of a file, reading it only once while it is unchanged.'''
+    status = os.stat(filePath)
+    key = (os.path.abspath(filePath), status.st_size, status.st_mtime)
+    if key not in fileDigests:
+        digest = hashlib.sha1()
+        with open(filePath, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(chunkSize), ''): digest.update(chunk)
+        fileDigests[key] = digest.hexdigest()
+    return fileDigests[key]
+
+def splitNucmerDelta(filePath):
+    '''Version 1.0
+    Returns the alignments of each query sequence in a nucmer delta file as a dictionary of lists of blocks by query name. Each block is
+    the text of one reference and query header line and the alignments under it.'''
+    blocks = {}
+    with open(filePath, 'r') as handle:
+        handle.readline() #the paths of the reference and query files
+        handle.readline() #the program name
+        block = None
+        for line in handle:
+            if line.startswith('>'):
+                block = [line]
+                blocks.setdefault(line.split()[1], []).append(block)
+            elif block is not None:
+                block.append(line)
+    return dict([(name, [''.join(block) for block in queryBlocks]) for name, queryBlocks in blocks.iteritems()])
+
+class NucmerCache(object):
+    '''Version 1.0
+    A directory of the nucmer alignments of single query sequences (e.g. contigs), so that a sequence aligned before to the same
+    reference with the same options is not aligned again (see runCachedNucmer). The delta file blocks of each sequence are saved in
+    a file named by a key made from the sequence, the digest of the reference file and the nucmer options. The query name in saved
+    blocks is the key; it is replaced by the name of the sequence when they are used. A sequence without alignments has an empty file.'''
+    extension = '.delta'
+    def __init__(self, directory, referencePath, options):
+        self.directory = directory
+        if not os.path.isdir(directory): os.makedirs(directory)
+        self.digest = hashlib.sha1('\t'.join([fileDigest(referencePath)] + ['%s=%r' % item for item in sorted(options.items())])).hexdigest()
+    def key(self, sequence):
+        return hashlib.sha1(self.digest + '\t' + sequence).hexdigest()
+    def path(self, key):
+        return os.path.join(self.directory, key + self.extension)
+    def read(self, key):
+        '''Returns the saved blocks of a sequence, or None if it is not in the cache.'''
+        try:
+            with open(self.path(key), 'r') as handle: text = handle.read()
+        except IOError:
+            return None
+        blocks = []
+        for line in text.splitlines(True):
+            if line.startswith('>'): blocks.append(line)
+            else: blocks[-1] += line
+        return blocks
+    def write(self, key, blocks):
+        '''Saves the blocks of a sequence. The file is written under a temporary name first, so runs sharing the cache never read part of one.'''
+        temporaryPath = '%s.%d.tmp' % (self.path(key), os.getpid())
+        with open(temporaryPath, 'w') as handle: handle.write(''.join(blocks))
+        os.rename(temporaryPath, self.path(key))
+
+def runCachedNucmer(queryPath, referencePath, cacheDirectory, nucmer_path = 'nucmer', prefix = 'out', timeout = None, **options):
+    '''Version 1.1
+    Makes the nucmer delta file <prefix>.delta of a FASTA file of query sequences like runNucmer, aligning only the sequences that
+    are not in the NucmerCache kept in cacheDirectory for the reference and options given. The new alignments are added to the cache
+    and the delta file is written from the alignments of every sequence, in the order of the query file. Nucmer is not run if every
+    sequence is cached. The cache is not used if a coords file is requested, since it would only describe the new sequences.'''
+    if options.get('coords'):
+        logger.info('The nucmer cache is not used because a coords file was requested.')
+        runNucmer(queryPath, referencePath, nucmer_path = nucmer_path, prefix = prefix, timeout = timeout, **options)
+        return
+    cache = NucmerCache(cacheDirectory, referencePath, dict(options, nucmer_path = nucmer_path))
+    queries = [(record.id, str(record.seq)) for record in SeqIO.parse(queryPath, 'fasta')]
+    keys = [cache.key(sequence) for name, sequence in queries]
+    savedBlocks = dict([(key, cache.read(key)) for key in set(keys)])
+    ##Align the new sequences, named by their keys
+    newSequences = dict([(key, sequence) for key, (name, sequence) in zip(keys, queries) if savedBlocks[key] is None])
+    logger.info('%d of %d query sequences were found in the nucmer cache "%s".' % (len(queries) - sum([savedBlocks[key] is None for key in keys]), len(queries), cacheDirectory))
+    if len(newSequences) > 0:
+        newPrefix = prefix + '_uncached'
+        with open(newPrefix + '.fa', 'w') as handle:
+            for key in sorted(newSequences): handle.write('>%s\n%s\n' % (key, newSequences[key]))
+        runNucmer(newPrefix + '.fa', referencePath, nucmer_path = nucmer_path, prefix = newPrefix, timeout = timeout, **options)
+        newBlocks = splitNucmerDelta(newPrefix + '.delta')
+        for key in newSequences:
+            savedBlocks[key] = newBlocks.get(key, [])
+            cache.write(key, savedBlocks[key])
+        os.remove(newPrefix + '.fa')
+        os.remove(newPrefix + '.delta')
+    ##Write the alignments of every sequence under its own name
+    with open(prefix + '.delta', 'w') as handle:
+        handle.write('%s %s\nNUCMER\n' % (os.path.abspath(referencePath), os.path.abspath(queryPath)))
+        for (name, sequence), key in zip(queries, keys):
+            for block in savedBlocks[key]:
+                header, alignments = block.split('\n', 1)
+                fields = header.split(' ')
+                fields[1] = name
+                handle.write(' '.join(fields) + '\n' + alignments)
+
+class StageManifest(object):
+    '''Version 1.1
+    A record of the stages of a pipeline run kept in its output folder: whether each stage was started or completed, its parameters,
+    the content digests of its input files and the paths of its output files. A completed stage whose parameters and inputs are
+    unchanged and whose outputs still exist does not have to be run again (see isCurrent). The manifest is saved after every change
+    as a tab-delimited text file, so a run that fails keeps the record of the stages completed before it.'''
+    fileName = 'manifest.txt'
+    header = '#readtools stage manifest'
+    formatVersion = '1'
+    def __init__(self, path):
+        self.path = path
+        self.stages = [] #stage names in the order they were first started
+        self.records = {}
+    @staticmethod
+    def parameterItems(parameters):
+        '''Returns the sorted (name, value text) of a dictionary of parameter values by name; list values are joined by spaces.'''
+        return sorted([(str(name), ' '.join(map(str, value)) if isinstance(value, (list, tuple)) else str(value)) for name, value in parameters.iteritems()])
+    @classmethod
+    def read(cls, path):
+        instance = cls(path)
+        with open(path, 'r') as handle:
+            header = handle.readline().rstrip('\n').split('\t')
+            if header != [cls.header, cls.formatVersion]: raise InputValidationError('"%s" is not a readtools stage manifest.' % path)
+            for line in handle:
+                fields = line.rstrip('\n').split('\t')
+                if fields[0] == 'stage':
+                    instance.stages.append(fields[1])
+                    instance.records[fields[1]] = {'status' : fields[2], 'parameters' : [], 'inputs' : [], 'outputs' : []}
+                elif fields[0] == 'parameter': instance.records[fields[1]]['parameters'].append((fields[2], fields[3]))
+                elif fields[0] == 'input': instance.records[fields[1]]['inputs'].append((fields[2], fields[3]))
+                elif fields[0] == 'output': instance.records[fields[1]]['outputs'].append(fields[2])
+        return instance
+    @classmethod
+    def forFolder(cls, folderPath):
+        '''Version 1.0
+        Returns the manifest of an output folder, or an empty one if it has none. A damaged manifest is replaced by an empty one.'''
+        path = os.path.join(folderPath, cls.fileName)
+        if os.path.exists(path):
+            try:
+                return cls.read(path)
+            except (InputValidationError, IndexError, KeyError):
+                logging.warning('The stage manifest "%s" could not be read; every stage will be run again.' % path)
+        return cls(path)
+    def write(self):
+        temporaryPath = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(temporaryPath, 'w') as handle:
+            handle.write('%s\t%s\n' % (self.header, self.formatVersion))
+            for name in self.stages:
+                record = self.records[name]
+                handle.write('stage\t%s\t%s\n' % (name, record['status']))
+                for parameter, value in record['parameters']: handle.write('parameter\t%s\t%s\t%s\n' % (name, parameter, value))
+                for inputPath, digest in record['inputs']: handle.write('input\t%s\t%s\t%s\n' % (name, inputPath, digest))
+                for outputPath in record['outputs']: handle.write('output\t%s\t%s\n' % (name, outputPath))
+        os.rename(temporaryPath, self.path)
+    def start(self, name, inputPaths, parameters):
+        '''Version 1.1
+        Records that a stage was started with the input files and parameters (a dictionary of values by option name) given.'''
+        if name not in self.records: self.stages.append(name)
+        self.records[name] = {'status' : 'started', 'parameters' : self.parameterItems(parameters), 'outputs' : [],
+                              'inputs' : [(os.path.abspath(path), fileDigest(path)) for path in inputPaths]}
+        self.write()
+    def complete(self, name, outputPaths):
+        '''Records that a stage was completed, making the output files given.'''
+        self.records[name]['status'] = 'complete'
+        self.records[name]['outputs'] = [os.path.abspath(path) for path in outputPaths]
+        self.write()
+    def isCurrent(self, name, inputPaths, parameters):
+        '''Version 1.1
+        Returns True if the stage was completed with the same parameters (in any order) and input file contents (in the same order,
+        wherever the files are) and all of its outputs still exist.'''
+        record = self.records.get(name)
+        if record is None or record['status'] != 'complete' or record['parameters'] != self.parameterItems(parameters): return False
+        if len(record['inputs']) != len(inputPaths) or not all([os.path.exists(path) for path in record['outputs']]): return False
+        return [digest for path, digest in record['inputs']] == [fileDigest(path) for path in inputPaths]
@@ -3,24 +3,28 @@
 ###Exception Classes###
 class InputValidationError(Exception):
     def __init__(self, value):
+        Exception.__init__(self, value) #sets args, so the exception can be pickled (e.g. returned from a worker process)
         self.value = value
     def __str__(self):
         return repr(self.value)
 
 class ProcessFailure(Exception):
     def __init__(self, value):
+        Exception.__init__(self, value)
         self.value = value
     def __str__(self):
         return repr(self.value)
 
 class YasraFailure(Exception):
     def __init__(self, value):
+        Exception.__init__(self, value)
         self.value = value
     def __str__(self):
         return repr(self.value)
 
 class NucmerFailure(Exception):
     def __init__(self, value):
+        Exception.__init__(self, value)
         self.value = value
     def __str__(self):
         return repr(self.value)
@@ -23,84 +23,91 @@ logger = logging.getLogger('')
 ####
 
 ###Variable Initialization############################################################################################################################
-timeStamp = datetime.now().ctime().replace(' ','-')  #Ex: 'Mon-Jun-14-11:08:55-2010'
-commandLine = copy.deepcopy(sys.argv)
 defaultYasraPath = '/usr/bin'
 defaultLastzPath = '/usr/bin'
-cwd = os.getcwd()
 program_name, program_version, progArgNum = ('runyasra','2.2.3', 2)
 progUsage = 'python %s <Reads> <Reference> [options]' % program_name
 accepted_lastz_versions = ['1.03.03']
 ######################################################################################################################################################
 
 ###Command Line Parser################################################################################################################################
-if '--touch' not in commandLine:
-    try:
-        cmndLineParser  = OptionParser(usage=progUsage, version="Version %s" % program_version)
-        cmndLineParser.add_option('-t', '--read-type',          action='store',         default='solexa',   type='choice',  choices=['solexa','454'],\
-                                  help="Specify the type of reads. (Default: solexa)")
-        cmndLineParser.add_option('-o', '--orientation',        action='store',         default='circular', type='choice',  choices=['circular','linear'],\
-                                  help="Specify orientation of the sequence. (Default: circular")
-        cmndLineParser.add_option('-p', '--percent-identity',   action='store',         default='same',     type='choice',  choices=['same','high','medium','low','verylow','desperate'],\
-                                  help="The percent identity (PID in yasra). The settings correspond to different percent values depending on the read type (-t). (Defalt: same)")
-        cmndLineParser.add_option('-n', '--contig-overlap',     action='store',         default=10,     type='int',\
-                                  help="The number of bases that must align (either match or mismatch) between contigs to be merged. (Defalt: 10)")
-        cmndLineParser.add_option('-i', '--overlap-percent-identity',     action='store',         default=95,     type='float',\
-                                  help="Percent identity in the aligned region (match * 100.0 / (match + mismatch)) between contigs to be merged. (Defalt: 95)")
-        cmndLineParser.add_option('-c', '--overlap-continuity',     action='store',         default=95,     type='float',\
-                                  help="Continuity ((match + mismatch) * 100.0 / (match + mismatch + gaps)) between contigs to be merged. (Defalt: 95)")
-        cmndLineParser.add_option('-m', '--makefile-path',      action='store',         default=None,       type='string',  metavar='PATH',\
-                                  help="Specify path to external makefile used by YASRA. (Default: use the makefile built in to runyasra)")
-        cmndLineParser.add_option('-b', '--yasra-binary-path',  action='store',         default = defaultYasraPath,       type='string',  metavar='PATH',\
-                                  help="Specify the path YASRA's folder. (Default: %s)" % defaultYasraPath)
-        cmndLineParser.add_option('-z', '--lastz-binary-path',  action='store',         default = defaultLastzPath,       type='string',  metavar='PATH',\
-                                  help="Specify the path to lastz. (Default: lastz)")
-        cmndLineParser.add_option('-s', '--single-step',        action='store_true',    default=False,\
-                                  help="Activate yasra's single_step option (Default: run yasra normally)")
-        cmndLineParser.add_option('-v', '--verbose',            action='store_true',    default=False,\
-                                  help='Print relevant statistics and progresss reports. (Default: run silently)')
-        cmndLineParser.add_option('-r', '--remove-dots-reads',  action='store_true',    default=False,\
-                                  help='Replace dots with Ns in the reads file before runnning yasra. The modified file is placed in the output filder.(Default: create a link to the original file)')
-        cmndLineParser.add_option('-f', '--remove-dots-ref',    action='store_true',    default=False,\
-                                  help='Replace dots with Ns in the reference file before runnning yasra. The modified file is placed in the output filder.(Default: create a link to the original file)')
-        cmndLineParser.add_option('-d', '--dos2unix-ref',       action='store_true',    default=False,\
-                                  help='Run dos2unix on the reference file before yasra. The modified file is placed in the output filder. (Default: create a link to the priginal reference)')
-        cmndLineParser.add_option(      '--touch',       action='store_true',    default=False,\
-                                  help='Load silently and do nothing.')
-        cmndLineParser.add_option("-y", "--output-directory", action="store", default=os.getcwd(), type="string", metavar="PATH",\
-                               help="Specify where the output directory will be made. (Default: current working directory)")
-        (options, args) = cmndLineParser.parse_args(commandLine)
-        if len(args) == 1:
-            cmndLineParser.print_help()
-            sys.exit(0)
-        if len(args) - 1 != progArgNum:
-            raise TypeError('%s takes exactly %d argument(s); %d supplied' % (program_name, progArgNum, len(args) - 1), 0)
-        readsPath = os.path.join(cwd, args[-2])
-        refPath = os.path.join(cwd, args[-1])
-        if os.path.exists(readsPath) == False:
-            raise TypeError('Invalid path to the reads file: %s' % readsPath,0)
-        if os.path.exists(refPath) == False:
-            raise TypeError('Invalid path to the reference file: %s' % refPath,0)
-        outDirName = '%s_%s_%s' % (os.path.basename(readsPath), os.path.basename(refPath), timeStamp)
-        outDirPath = os.path.join(os.getcwd(),outDirName)   #output directory is located in the current working directory
-    except SystemExit:
-        raise
-    except:
-        print "An error occured during command line parseing:\n%s" % sys.exc_info()[0]
-        raise
-    ######################################################################################################################################################
+cmndLineParser  = OptionParser(usage=progUsage, version="Version %s" % program_version)
+cmndLineParser.add_option('-t', '--read-type',          action='store',         default='solexa',   type='choice',  choices=['solexa','454'],\
+                          help="Specify the type of reads. (Default: solexa)")
+cmndLineParser.add_option('-o', '--orientation',        action='store',         default='circular', type='choice',  choices=['circular','linear'],\
+                          help="Specify orientation of the sequence. (Default: circular")
+cmndLineParser.add_option('-p', '--percent-identity',   action='store',         default='same',     type='choice',  choices=['same','high','medium','low','verylow','desperate'],\
+                          help="The percent identity (PID in yasra). The settings correspond to different percent values depending on the read type (-t). (Defalt: same)")
+cmndLineParser.add_option('-n', '--contig-overlap',     action='store',         default=10,     type='int',\
+                          help="The number of bases that must align (either match or mismatch) between contigs to be merged. (Defalt: 10)")
+cmndLineParser.add_option('-i', '--overlap-percent-identity',     action='store',         default=95,     type='float',\
+                          help="Percent identity in the aligned region (match * 100.0 / (match + mismatch)) between contigs to be merged. (Defalt: 95)")
+cmndLineParser.add_option('-c', '--overlap-continuity',     action='store',         default=95,     type='float',\
+                          help="Continuity ((match + mismatch) * 100.0 / (match + mismatch + gaps)) between contigs to be merged. (Defalt: 95)")
+cmndLineParser.add_option('-m', '--makefile-path',      action='store',         default=None,       type='string',  metavar='PATH',\
+                          help="Specify path to external makefile used by YASRA. (Default: use the makefile built in to runyasra)")
+cmndLineParser.add_option('-b', '--yasra-binary-path',  action='store',         default = defaultYasraPath,       type='string',  metavar='PATH',\
+                          help="Specify the path YASRA's folder. (Default: %s)" % defaultYasraPath)
+cmndLineParser.add_option('-z', '--lastz-binary-path',  action='store',         default = defaultLastzPath,       type='string',  metavar='PATH',\
+                          help="Specify the path to lastz. (Default: lastz)")
+cmndLineParser.add_option('-s', '--single-step',        action='store_true',    default=False,\
+                          help="Activate yasra's single_step option (Default: run yasra normally)")
+cmndLineParser.add_option('-v', '--verbose',            action='store_true',    default=False,\
+                          help='Print relevant statistics and progresss reports. (Default: run silently)')
+cmndLineParser.add_option('-r', '--remove-dots-reads',  action='store_true',    default=False,\
+                          help='Replace dots with Ns in the reads file before runnning yasra. The modified file is placed in the output filder.(Default: create a link to the original file)')
+cmndLineParser.add_option('-f', '--remove-dots-ref',    action='store_true',    default=False,\
+                          help='Replace dots with Ns in the reference file before runnning yasra. The modified file is placed in the output filder.(Default: create a link to the original file)')
+cmndLineParser.add_option('-d', '--dos2unix-ref',       action='store_true',    default=False,\
+                          help='Run dos2unix on the reference file before yasra. The modified file is placed in the output filder. (Default: create a link to the priginal reference)')
+cmndLineParser.add_option(      '--touch',       action='store_true',    default=False,\
+                          help='Load silently and do nothing.')
+cmndLineParser.add_option("-y", "--output-directory", action="store", default=None, type="string", metavar="PATH",\
+                       help="Specify where the output directory will be made. (Default: current working directory)")
+cmndLineParser.add_option(      '--timeout',     action='store',         default=None,       type='float',   metavar='MINUTES',\
+                          help="Stop YASRA if it has not finished after MINUTES minutes. (Default: no limit)")
+######################################################################################################################################################
+
+###Input Data Vaildation##############################################################################################################################
+def validateFastaForYasra(path):
+    with open(path, 'r') as handle:
+        count = 0
+        for line in handle.readlines():
+            if line[0] == '>':
+                if line[1] == '@':
+                    raise readtools.InputValidationError('The file at "%s" has reads that begin with the character "@" on line %d. This causes the output SAM file from YASRA to have incorrect syntax. Remove the "@" from the start of the specifed file and try again.' % (path, count))
+            elif '.' in line:
+                raise readtools.InputValidationError('The file at "%s" has reads contain the character "." in their sequence on line %d. This is equivalnt to a "N" in the IUPAC convention, but is not recgnoized by YASRA. Replace every "." with "N" in the specifed file and try again.' % (path, count))
+            count += 1
+######################################################################################################################################################
+
+def outputFolderPath(readsPath, refPath, outputDirectory = None):
+    '''Version 1.0
+    Returns the path of the folder YASRA is run in: a folder named after the input files and the current time in the output directory
+    (Default: the current working directory).'''
+    timeStamp = datetime.now().ctime().replace(' ','-')  #Ex: 'Mon-Jun-14-11:08:55-2010'
+    outDirName = '%s_%s_%s' % (os.path.basename(readsPath), os.path.basename(refPath), timeStamp)
+    if outputDirectory is None: outputDirectory = os.getcwd()
+    return os.path.join(os.path.abspath(outputDirectory), outDirName)
+
+def run(readsPath, refPath, outDirPath = None, **optionValues):
+    '''Version 1.1
+    Runs YASRA on a FASTA file of reads and a FASTA file of the reference in the folder given, which is made if it does not exist
+    (Default: a new folder in the output directory; see outputFolderPath). The options are given by the names the command line options
+    are saved as (e.g. read_type or percent_identity); options not given have their default values. Returns the path of the folder and
+    the paths of the output files of YASRA in it.'''
+    options = cmndLineParser.get_default_values()
+    for name, value in optionValues.iteritems():
+        if not hasattr(options, name): raise TypeError("run() got an unexpected keyword argument '%s'" % name)
+        setattr(options, name, value)
+    readsPath = os.path.abspath(readsPath)
+    refPath = os.path.abspath(refPath)
+    if os.path.exists(readsPath) == False:
+        raise TypeError('Invalid path to the reads file: %s' % readsPath,0)
+    if os.path.exists(refPath) == False:
+        raise TypeError('Invalid path to the reference file: %s' % refPath,0)
+    if outDirPath is None: outDirPath = outputFolderPath(readsPath, refPath, options.output_directory)
 
-    ###Input Data Vaildation##############################################################################################################################
-    def validateFastaForYasra(path):
-        with open(path, 'r') as handle:
-            count = 0
-            for line in handle.readlines():
-                if line[0] == '>':
-                    if line[1] == '@':
-                        raise readtools.InputValidationError('The file at "%s" has reads that begin with the character "@" on line %d. This causes the output SAM file from YASRA to have incorrect syntax. Remove the "@" from the start of the specifed file and try again.' % (path, count))
-                elif '.' in line:
-                    raise readtools.InputValidationError('The file at "%s" has reads contain the character "." in their sequence on line %d. This is equivalnt to a "N" in the IUPAC convention, but is not recgnoized by YASRA. Replace every "." with "N" in the specifed file and try again.' % (path, count))
-                count += 1
     try:
         validateFastaForYasra(readsPath)
         validateFastaForYasra(refPath)
@@ -117,8 +124,8 @@ if '--touch' not in commandLine:
     
     ###Initialize output directory########################################################################################################################
     try:
-        os.mkdir(outDirPath)   #create output directory
-        os.chdir(outDirPath)   #move into the output directory
+        if not os.path.isdir(outDirPath): os.mkdir(outDirPath)   #create output directory
+        existingNames = tuple(os.listdir(outDirPath)) #files already in the folder (e.g. a stage manifest) are not output of YASRA
     except:
         print "An error occured during output directory creation:\n%s" % sys.exc_info()[0]
         raise
@@ -324,7 +331,7 @@ clean:
 ''' +'\t'+ '''rm Final_Assembly alignments.sam contigs.ace'''
             logger.debug('YASRA makefile created.')
         else:
-            makefileHandle = open(options.makefile_path, 'w')
+            makefileHandle = open(options.makefile_path, 'r')
             makefileData = makefileHandle.read()
             makefileHandle.close()
         makefilePath = os.path.join(outDirPath, 'Makefile')
@@ -336,50 +343,39 @@ clean:
         raise
     ######################################################################################################################################################
 
-    def printProcess(process):
-        '''Prints the standard ouput and error messages of a process while the process ia running.'''
-        outLen = 0
-        errLen = 0
-        out = ''
-        err = ''
-        while process.poll() is None:  #while it hasnt finished...
-            (outData, errData) = process.communicate()
-            outDiff =  len(outData) - outLen
-            errDiff =  len(errData) - errLen
-            if outDiff > 0:
-                outLen += outDiff
-                out += outData[-outDiff:]
-                print outData[-outDiff:]
-            if errDiff > 0:
-                errLen += errDiff
-                err += errData[-errDiff:]
-                print errData[-errDiff:]
-        return (out, err)
-
     ###Run yasra##########################################################################################################################################
     makeCmndLine = ['make','TYPE=' + options.read_type,'ORIENT=' + options.orientation,'PID=' + options.percent_identity]
     if options.single_step:
         makeCmndLine.insert(1,'single_step')
-    makeStdOut = open(os.path.join(outDirPath, 'yasra_standard_output.txt'), 'w')
-    makeStdErr = open(os.path.join(outDirPath, 'yasra_standard_error.txt'), 'w')
-    makeProcess = Popen(makeCmndLine, stdout=PIPE, stderr=PIPE)
-    #if options.verbose:
-    #    (outData, errData) = printProcess(makeProcess)
-    #else:
-    (outData, errData) = printProcess(makeProcess)  
-    makeProcess.wait()
-    makeStdOut.write(outData)
-    makeStdErr.write(errData)
-    makeStdOut.close()
-    makeStdErr.close()
-    if makeProcess.returncode == 0:   #yasra completed normally
+    timeout = None if options.timeout is None else options.timeout * 60
+    try:
+        returnCode = readtools.runProcess(makeCmndLine, os.path.join(outDirPath, 'yasra_standard_output.txt'), os.path.join(outDirPath, 'yasra_standard_error.txt'),\
+                                          cwd = outDirPath, timeout = timeout, logName = 'yasra', logLevel = logging.INFO)
+    except readtools.ProcessFailure as error:
+        raise readtools.YasraFailure(error.value)
+    if returnCode == 0:   #yasra completed normally
         if options.verbose:
             print 'yasra output saved in the directory: %s' % outDirPath
     else:
-        raise Exception('yasra returned a non-zero code; it may have not completed succesfully', 0)
-    dontChange = ('Makefile',os.path.basename(readsPath), os.path.basename(refPath))
-    outPaths = [os.path.join(outDirPath, path) for path in os.listdir(outDirPath) if os.path.isfile(path) and path not in dontChange]
-    renamedPaths = [os.path.join(outDirPath, '%s_%s_%s%s' % (os.path.splitext(path)[0], os.path.basename(readsPath), os.path.basename(refPath), os.path.splitext(path)[1])) for path in os.listdir(outDirPath) if os.path.isfile(path) and path not in dontChange]
+        raise readtools.YasraFailure('yasra returned a non-zero code; it may have not completed succesfully')
+    dontChange = ('Makefile',os.path.basename(readsPath), os.path.basename(refPath)) + existingNames
+    outNames = [name for name in os.listdir(outDirPath) if os.path.isfile(os.path.join(outDirPath, name)) and name not in dontChange]
+    outPaths = [os.path.join(outDirPath, name) for name in outNames]
+    renamedPaths = [os.path.join(outDirPath, '%s_%s_%s%s' % (os.path.splitext(name)[0], os.path.basename(readsPath), os.path.basename(refPath), os.path.splitext(name)[1])) for name in outNames]
     for index in range(0,len(outPaths)):
         os.rename(outPaths[index],renamedPaths[index])
-    ######################################################################################################################################################
+    return (outDirPath, renamedPaths)
+######################################################################################################################################################
+
+###Command Line Interface#############################################################################################################################
+if __name__ == '__main__':
+    (options, args) = cmndLineParser.parse_args(sys.argv)
+    if options.touch is False:
+        logging.basicConfig(level = logging.INFO, format = '%(message)s') #the output of YASRA is printed as it runs
+        if len(args) == 1:
+            cmndLineParser.print_help()
+            sys.exit(0)
+        if len(args) - 1 != progArgNum:
+            raise TypeError('%s takes exactly %d argument(s); %d supplied' % (program_name, progArgNum, len(args) - 1), 0)
+        run(args[-2], args[-1], **vars(options))
+######################################################################################################################################################
@@ -0,0 +1,111 @@
+'''Round trip tests of the SAM and BAM readers and writers of readtools. Run with "python -m unittest test_readtools".'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import readtools
+
+samLines = ['r1\t99\tref\t1\t60\t4M\t=\t7\t10\tACGT\tIIII\tNM:i:0\tXA:A:x\tXZ:Z:some text\tXH:H:1AE3\tXB:B:s,-1,2,300\tXF:f:0.5',
+            'r2\t147\tref\t7\t60\t2M1I1M\t=\t1\t-10\tTTAG\tII#I\tXB:B:f,1.5,-2.5\tMD:Z:3\tAS:i:-4',
+            'r3\t0\tref\t9\t0\t4M\t*\t0\t0\tGGCC\t*']
+
+class BamRoundTripTest(unittest.TestCase):
+    '''Version 1.0'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.samPath = os.path.join(self.directory, 'reads.sam')
+        self.bamPath = os.path.join(self.directory, 'reads.bam')
+        with open(self.samPath, 'w') as handle:
+            handle.write('@SQ\tSN:ref\tLN:20\n')
+            handle.write(''.join([line + '\n' for line in samLines]))
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    def readBamLines(self):
+        return ['\t'.join(samRecord.fields) for samRecord in readtools.BamReader(self.bamPath).samRecords()]
+    def test_unchangedTagsKeepTheirTypes(self):
+        readtools.AlignmentIO.write(readtools.AlignmentIO.parse(self.samPath, 'sam'), self.bamPath, 'bam')
+        self.assertEqual(self.readBamLines(), samLines)
+    def test_decodedTagsKeepTheirTypes(self):
+        alignments = list(readtools.AlignmentIO.parse(self.samPath, 'sam'))
+        for alignment in alignments: alignment.annotations #decodes the optional fields
+        alignments[1].annotations['MD'] = '4'
+        alignments[2].annotations['NM'] = 1
+        readtools.AlignmentIO.write(alignments, self.bamPath, 'bam')
+        expected = [samLines[0], samLines[1].replace('MD:Z:3\t', '') + '\tMD:Z:4', samLines[2] + '\tNM:i:1']
+        self.assertEqual(self.readBamLines(), expected)
+    def test_readStoreRows(self):
+        store = readtools.ReadStore.fromSamRecords(readtools.AlignmentIO.readSamRecords(self.samPath))
+        writer = readtools.BamWriter(self.bamPath, [('ref', 20)])
+        writer.write(store.alignments())
+        writer.close()
+        self.assertEqual(self.readBamLines(), samLines)
+    def test_unsortedWritesRaise(self):
+        alignments = list(readtools.AlignmentIO.parse(self.samPath, 'sam'))
+        writer = readtools.BamWriter(self.bamPath, [('ref', 20)])
+        writer.write(alignments[1:])
+        self.assertRaises(ValueError, writer.write, alignments[:1])
+        writer.close()
+    def test_pysam(self):
+        try: import pysam
+        except ImportError: return
+        readtools.AlignmentIO.write(readtools.AlignmentIO.parse(self.samPath, 'sam'), self.bamPath, 'bam')
+        with pysam.AlignmentFile(self.bamPath, 'rb') as handle:
+            lines = [record.to_string() for record in handle]
+        self.assertEqual(lines, samLines)
+
+class IntervalIndexTest(unittest.TestCase):
+    '''Version 1.0'''
+    def test_matchesScan(self):
+        random = np.random.RandomState(1)
+        for count in (0, 1, 64, 65, 5000):
+            starts = random.randint(0, 10000, count)
+            ends = starts + random.randint(0, 300, count)
+            if count > 3: ends[2] = 20000 #one interval spans the others
+            index = readtools.IntervalIndex(starts, ends)
+            for trial in range(200):
+                start = random.randint(-10, 21000)
+                end = None if trial % 7 == 0 else start + random.randint(0, 500)
+                expected = [row for row in range(count) if ends[row] >= start and (end is None or starts[row] <= end)]
+                self.assertEqual(index.overlapping(start, end), expected)
+    def test_changedViewsAreReindexed(self):
+        lines = ['r%d\t0\tref\t%d\t60\t4M\t*\t0\t0\tACGT\tIIII' % (row, 1 + 10 * row) for row in range(5)]
+        store = readtools.ReadStore.fromSamRecords([readtools.SamRecord(line) for line in lines])
+        pileup = readtools.Pileup(alignments = store.alignments(), padAlignments = False, name = 'ref')
+        self.assertEqual(pileup.alignmentsWithIndex(42), [4])
+        pileup.alignments[0].start = 41
+        self.assertEqual(pileup.alignmentsWithIndex(42), [0, 4])
+        pileup.alignments[1].cigar = '40M'
+        self.assertEqual(pileup.alignmentsWithIndex(42), [0, 1, 4])
+
+class SetCigarTest(unittest.TestCase):
+    '''Version 1.0'''
+    def setUp(self):
+        lines = ['r%d\t0\tref\t%d\t60\t2M1I1M\t*\t0\t0\tACGT\tIIII' % (row, 1 + 10 * row) for row in range(4)]
+        self.store = readtools.ReadStore.fromSamRecords([readtools.SamRecord(line) for line in lines])
+    def test_shorterCigarsAreWrittenInPlace(self):
+        size = len(self.store.cigarOperations)
+        self.store.setCigar(1, '4M')
+        self.store.setCigar(2, None)
+        self.assertEqual(len(self.store.cigarOperations), size)
+        self.assertEqual([self.store.cigar(row) for row in range(4)], ['2M1I1M', '4M', None, '2M1I1M'])
+        self.assertEqual(self.store.ends().tolist(), [3, 14, 20, 33])
+    def test_longerCigarsAreAppended(self):
+        cigars = ['2M1I1M'] * 4
+        for step in range(100):
+            row = step % 4
+            cigars[row] = '1M1D' * (step % 7 + 1) + '1M'
+            self.store.setCigar(row, cigars[row])
+            self.assertEqual([self.store.cigar(row) for row in range(4)], cigars)
+        self.assertTrue(len(self.store.cigarOperations) < 4 * sum([len(cigar) for cigar in cigars]))
+        self.store.compactCigars()
+        self.assertEqual(len(self.store.cigarOperations), self.store.cigarCounts.sum())
+        self.assertEqual([self.store.cigar(row) for row in range(4)], cigars)
+        shared = readtools.ReadStore.fromShared(self.store.toShared())
+        self.assertEqual(shared.ends().tolist(), self.store.ends().tolist())
+
+if __name__ == '__main__':
+    unittest.main()